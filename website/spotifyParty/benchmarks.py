@@ -0,0 +1,765 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.db import connection, connections
+from django.db.models import F
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from . import consumers, metrics, routing, sharding, spotify_client
+from .broadcast import encode_frame
+from .guests import GuestUser
+from .instrumentation import get_handler_stats, handler_stats, reset_handler_stats
+from .models import PartySession, Song, Track, User, UserJoinedPartySession, UserPlaylist, PlaybackDevice, ApiToken
+from .spotify_client import AsyncSpotify, Spotify
+from .write_queue import database_write, write_queue
+
+
+# converts a command line value to an int, a float, a list of those or leaves it as string
+def parse_param(value):
+    if ',' in value:
+        return [parse_param(item) for item in value.split(',')]
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    return value
+
+
+# payload of a typical session_refresh: one playing song and four votable songs
+def example_session_refresh():
+    def song(index):
+        return {
+            "title": "Song title %d" % index,
+            "artist": "First Artist, Second Artist",
+            "length": 215000,
+            "votes": index,
+            "song_id": "4uLU6hMCjMI75M1A2tKUQ%d" % index,
+            "cover_link": "https://i.scdn.co/image/ab67616d0000b273%032d" % index
+        }
+
+    return {
+        "type": "session_refresh",
+        "seq": 42,
+        "playing_song": song(0),
+        "votable_songs": [song(index) for index in range(1, 5)],
+        "playback_started": 1608000000000
+    }
+
+
+# compares the encoding CPU time of one group broadcast:
+# per member json.dumps in every handler against encoding the frame once and forwarding it
+def broadcast_encoding(room_sizes=(10, 100, 500, 1000), repeat=20):
+    if isinstance(room_sizes, int):
+        room_sizes = [room_sizes]
+    data = example_session_refresh()
+    results = []
+    for room_size in room_sizes:
+        start = time.process_time()
+        for _ in range(repeat):
+            [json.dumps({"type": "websocket.send", "text": data}) for _ in range(room_size)]
+        per_member = (time.process_time() - start) / repeat
+
+        start = time.process_time()
+        for _ in range(repeat):
+            frame = encode_frame(data)
+            [frame for _ in range(room_size)]
+        encode_once = (time.process_time() - start) / repeat
+
+        results.append({
+            "room_size": room_size,
+            "per_member_encoding_ms": per_member * 1000,
+            "encode_once_ms": encode_once * 1000,
+            "speedup": per_member / encode_once if encode_once else None
+        })
+    return {"benchmark": "broadcast_encoding", "frame_bytes": len(encode_frame(data)), "results": results}
+
+
+# runs a benchmark against a throwaway test database instead of the configured one
+# sqlite test databases are kept in memory unless a file name is given
+@contextmanager
+def benchmark_database(test_name=None):
+    old_name = connection.settings_dict['NAME']
+    old_test_name = connection.settings_dict['TEST']['NAME']
+    if test_name is not None:
+        connection.settings_dict['TEST']['NAME'] = test_name
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        connection.settings_dict['TEST']['NAME'] = old_test_name
+
+
+# creates a party-session with a playlist of the given size
+def create_benchmark_session(session_code, playlist_size, song_length=215000):
+    party_session = PartySession.objects.create(session_code=session_code)
+    tracks = [Track(spotify_song_id='%s-%d' % (session_code, index), song_name='Song %d' % index,
+                    song_artist='Artist', song_cover_link='https://i.scdn.co/image/%d' % index,
+                    song_length=song_length)
+              for index in range(playlist_size)]
+    Track.objects.bulk_create(tracks, batch_size=500)
+    deck_positions = list(range(playlist_size))
+    random.shuffle(deck_positions)
+    Song.objects.bulk_create([Song(track=track, deck_position=deck_position, party_session=party_session)
+                              for track, deck_position in zip(tracks, deck_positions)], batch_size=500)
+    return party_session
+
+
+# candidate selection before the shuffled deck: 4 passes over all not played songs per round
+def draw_votable_songs_by_random_choice(party_session, count):
+    drawn_songs = []
+    for _ in range(count):
+        songs = Song.objects.filter(party_session=party_session)
+        if not songs.filter(was_played=False, is_playing=False, is_votable=False).exists():
+            for song in songs.filter(is_playing=False):
+                song.was_played = False
+                song.save()
+        random_song = random.choice(list(songs.filter(was_played=False, is_playing=False, is_votable=False)))
+        random_song.is_votable = True
+        random_song.save()
+        drawn_songs.append(random_song)
+    return drawn_songs
+
+
+# ends a round of a benchmark session like close_round_task: the votable songs are marked as played
+def end_benchmark_round(party_session):
+    Song.objects.filter(party_session=party_session, is_votable=True).update(is_votable=False, was_played=True)
+
+
+# compares time and queries per round of the shuffled deck against the old random.choice sampling
+def deck_sampler(playlist_sizes=(50, 500, 5000), rounds=20, count=4):
+    if isinstance(playlist_sizes, int):
+        playlist_sizes = [playlist_sizes]
+    results = []
+    with benchmark_database():
+        for playlist_size in playlist_sizes:
+            result = {"playlist_size": playlist_size}
+            samplers = {
+                "random_choice": draw_votable_songs_by_random_choice,
+                "shuffled_deck": lambda party_session, count: party_session.draw_votable_songs(count)
+            }
+            for name, sampler in samplers.items():
+                party_session = create_benchmark_session('%s%d' % (name[0], playlist_size), playlist_size)
+                with CaptureQueriesContext(connection) as queries:
+                    start = time.perf_counter()
+                    for _ in range(rounds):
+                        sampler(party_session, count)
+                        end_benchmark_round(party_session)
+                    duration = time.perf_counter() - start
+                # end_benchmark_round is not part of the sampler
+                result[name] = {
+                    "ms_per_round": duration / rounds * 1000,
+                    "queries_per_round": len(queries) / rounds - 1
+                }
+            results.append(result)
+    return {"benchmark": "deck_sampler", "rounds": rounds, "results": results}
+
+
+# local stand-in for the web api that answers every request after a fixed latency
+@contextmanager
+def slow_api_server(latency):
+    class Handler(BaseHTTPRequestHandler):
+        def do_PUT(self):
+            time.sleep(latency)
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:%d/' % server.server_address[1]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+# measures how long the event loop is stalled while start_playback calls are in flight:
+# a ticker task records the largest delay between its wake-ups
+async def measure_event_loop_stall(start_playback, calls, tick=0.001):
+    max_stall = 0
+    running = True
+
+    async def ticker():
+        nonlocal max_stall
+        while running:
+            before = time.perf_counter()
+            await asyncio.sleep(tick)
+            max_stall = max(max_stall, time.perf_counter() - before - tick)
+
+    ticker_task = asyncio.create_task(ticker())
+    await asyncio.sleep(tick)
+    start = time.perf_counter()
+    await asyncio.gather(*(start_playback() for _ in range(calls)))
+    duration = time.perf_counter() - start
+    running = False
+    await ticker_task
+    return {"max_event_loop_stall_ms": max_stall * 1000, "total_ms": duration * 1000}
+
+
+# compares blocking start_playback calls inside coroutines with the AsyncSpotify client
+def spotify_stall(latency=0.2, calls=5):
+    uris = ['spotify:track:4uLU6hMCjMI75M1A2tKUQQ']
+    with slow_api_server(latency) as base_url:
+        async def blocking_start_playback():
+            Spotify('token', base_url).start_playback(device_id='device', uris=uris)
+
+        async def async_start_playback():
+            await AsyncSpotify('token', base_url).start_playback(device_id='device', uris=uris)
+
+        results = {
+            "blocking": asyncio.run(measure_event_loop_stall(blocking_start_playback, calls)),
+            "async": asyncio.run(measure_event_loop_stall(async_start_playback, calls))
+        }
+    return {"benchmark": "spotify_stall", "latency_ms": latency * 1000, "calls": calls, "results": results}
+
+
+# returns the value below which the given percentage of the values lies
+def percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+# creates a party-session like the settings view does: a host with playlist, device and token and joined voters
+# returns the host and the voters as read back from the database
+def create_load_room(session_code, voters, playlist_size, song_length):
+    party_session = create_benchmark_session(session_code, playlist_size, song_length)
+    host = User.objects.create_user()
+    UserJoinedPartySession.objects.create(user=host, party_session=party_session, is_session_host=True)
+    UserPlaylist.objects.create(spotify_playlist_id='playlist', playlist_name='Playlist', is_selected=True,
+                                playlist_cover_link='https://i.scdn.co/image/playlist', user=host)
+    PlaybackDevice.objects.create(spotify_device_id='device', device_name='Device', is_selected=True, user=host)
+    ApiToken.objects.create(access_token='token', refresh_token='token', expires_at=2 ** 31 - 1, user=host)
+    voter_pks = []
+    for _ in range(voters):
+        voter = User.objects.create_user()
+        UserJoinedPartySession.objects.create(user=voter, party_session=party_session)
+        voter_pks.append(voter.pk)
+    return User.objects.get(pk=host.pk), list(User.objects.filter(pk__in=voter_pks))
+
+
+# websocket client of the load harness
+class LoadClient:
+    def __init__(self, user, session_code):
+        self.communicator = WebsocketCommunicator(URLRouter(routing.websocket_urlpatterns),
+                                                  '/%s/?protocol=2' % session_code)
+        self.communicator.scope['user'] = user
+        # (time received, message) of session_init and session_refresh messages received while waiting for others
+        self.rounds = []
+        # the communicator cancels its application after a receive timed out, a dead client is skipped from then on
+        self.dead = False
+
+    async def connect(self, timeout=1):
+        connected, _ = await self.communicator.connect(timeout)
+        if not connected:
+            raise RuntimeError('websocket connection was rejected')
+
+    # returns the next message for which accept returns True, messages announcing a round are kept for next_round
+    # raises asyncio.TimeoutError if none arrives within timeout and marks the client as dead
+    async def receive(self, accept, timeout):
+        if self.dead:
+            raise asyncio.TimeoutError()
+        deadline = time.perf_counter() + timeout
+        while True:
+            try:
+                message = json.loads(await self.communicator.receive_from(max(0, deadline - time.perf_counter())))
+            except asyncio.TimeoutError:
+                self.dead = True
+                raise
+            message = message['text']
+            if accept(message):
+                return message
+            if message['type'] in ('session_init', 'session_refresh'):
+                self.rounds.append((time.perf_counter(), message))
+
+    # discards all messages received so far, keeps the ones announcing a round
+    async def drain(self):
+        while not self.dead and not await self.communicator.receive_nothing(timeout=0):
+            message = await self.receive(lambda message: True, 1)
+            if message['type'] in ('session_init', 'session_refresh'):
+                self.rounds.append((time.perf_counter(), message))
+
+    # returns the time the next round was announced and its session_init or session_refresh message,
+    # None if the client is dead
+    async def next_round(self, timeout):
+        if not self.rounds:
+            try:
+                message = await self.receive(lambda message: message['type'] in ('session_init', 'session_refresh'),
+                                             timeout)
+            except asyncio.TimeoutError:
+                return None
+            return time.perf_counter(), message
+        return self.rounds.pop(0)
+
+    async def disconnect(self):
+        if not self.dead:
+            await self.communicator.disconnect()
+
+
+# sum of the queries of the handlers that process votes
+def vote_path_queries():
+    return sum(handler_stats['SessionConsumer.' + name].queries
+               for name in ('receive', 'new_vote_task', 'refresh_votes_task', 'votes_refresh'))
+
+
+# votes of one voter in one round: every vote is sent after a random pause within the burst
+# and counts as broadcast once the voter receives a votes delta containing the voted song
+# the votes of a client that died are counted as lost
+async def run_voter_round(client, song_ids, votes_per_round, burst, latencies, timeout):
+    lost_votes = 0
+    for vote in range(votes_per_round):
+        if client.dead:
+            return lost_votes + votes_per_round - vote
+        await asyncio.sleep(random.uniform(0, burst / votes_per_round))
+        song_id = random.choice(song_ids)
+        # deltas already received were caused by earlier votes
+        await client.drain()
+        sent = time.perf_counter()
+        await client.communicator.send_to(text_data=song_id)
+        try:
+            await client.receive(lambda message: message['type'] == 'votes_delta' and song_id in message['votes'],
+                                 timeout)
+            latencies.append(time.perf_counter() - sent)
+        except asyncio.TimeoutError:
+            lost_votes += 1
+    return lost_votes
+
+
+async def run_load(rooms, rounds, votes_per_round, burst, song_length, timeout):
+    tracemalloc.start()
+    memory_before = tracemalloc.get_traced_memory()[0]
+    hosts = []
+    voters = []
+    for session_code, (host, room_voters) in rooms.items():
+        hosts.append(LoadClient(host, session_code))
+        voters.extend(LoadClient(voter, session_code) for voter in room_voters)
+    for client in hosts + voters:
+        await client.connect()
+    connections = len(hosts) + len(voters)
+    memory_per_connection = (tracemalloc.get_traced_memory()[0] - memory_before) / connections
+    tracemalloc.stop()
+
+    for host in hosts:
+        await host.communicator.send_to(text_data='start_party_session')
+    latencies = []
+    lost_votes = 0
+    queries = 0
+    vote_time = 0
+    vote_cpu_time = 0
+    # time from the end of a song until the hosts receive the next session_refresh
+    round_transitions = []
+    round_started = {}
+    for _ in range(rounds):
+        host_rounds = await asyncio.gather(*(host.next_round(timeout) for host in hosts))
+        for host, host_round in zip(hosts, host_rounds):
+            if host_round is None:
+                continue
+            received, message = host_round
+            if host in round_started:
+                round_transitions.append(received - round_started[host] - song_length / 1000)
+            round_started[host] = received
+        voter_rounds = await asyncio.gather(*(client.next_round(timeout) for client in voters))
+
+        votes_started = time.perf_counter()
+        votes_cpu_started = time.process_time()
+        queries_before = vote_path_queries()
+        lost_votes += sum(await asyncio.gather(*(
+            run_voter_round(client, [song['song_id'] for song in voter_round[1]['votable_songs']], votes_per_round,
+                            burst, latencies, timeout)
+            for client, voter_round in zip(voters, voter_rounds) if voter_round is not None)))
+        lost_votes += votes_per_round * voter_rounds.count(None)
+        vote_time += time.perf_counter() - votes_started
+        vote_cpu_time += time.process_time() - votes_cpu_started
+        queries += vote_path_queries() - queries_before
+
+    dead_clients = sum(client.dead for client in hosts + voters)
+    for client in hosts + voters:
+        await client.disconnect()
+
+    votes = len(latencies)
+    return {
+        "connections": connections,
+        "dead_clients": dead_clients,
+        "memory_per_connection_bytes": memory_per_connection,
+        "votes": votes,
+        "lost_votes": lost_votes,
+        "votes_per_second": votes / vote_time if vote_time else None,
+        "vote_time_s": vote_time,
+        # votes per second of processor time, the throughput of a worker that has a processor to itself
+        "votes_per_cpu_second": votes / vote_cpu_time if vote_cpu_time else None,
+        "vote_to_broadcast_ms": {
+            "p50": percentile(latencies, 50) * 1000 if latencies else None,
+            "p99": percentile(latencies, 99) * 1000 if latencies else None,
+            "max": max(latencies) * 1000 if latencies else None
+        },
+        "queries_per_vote": queries / (votes + lost_votes) if votes + lost_votes else None,
+        "round_transition_ms": {
+            "p50": percentile(round_transitions, 50) * 1000 if round_transitions else None,
+            "max": max(round_transitions) * 1000 if round_transitions else None
+        }
+    }
+
+
+# drives SessionConsumer through the channels testing communicator:
+# R rooms with V voters each vote in bursts at the start of every round, rounds end after song_length milliseconds
+# the vote closes lead_time seconds before, the winner is handed to spotify as set by handoff ('queue' or 'start')
+# the channel layer is in memory, spotify answers every request with 204 no content after api_latency seconds
+def load_harness(rooms=10, voters=20, rounds=3, votes_per_round=3, burst=1.0, song_length=3000, playlist_size=30,
+                 timeout=10, lead_time=1.0, handoff='queue', api_latency=0.0):
+    no_content = mock.Mock(status_code=204, content=b'')
+
+    def spotify_request(*args, **kwargs):
+        time.sleep(api_latency)
+        return no_content
+
+    with benchmark_database(), \
+            override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+                              ROUND_LEAD_TIME=lead_time, ROUND_HANDOFF=handoff), \
+            mock.patch.object(spotify_client.http_session, 'request', side_effect=spotify_request):
+        load_rooms = {}
+        for index in range(rooms):
+            session_code = 'load%d' % index
+            load_rooms[session_code] = create_load_room(session_code, voters, playlist_size, song_length)
+        reset_handler_stats()
+        track_gaps = {key: list(value[0]) for key, value in metrics.track_gap.values.items()}
+        start = time.perf_counter()
+        # the consumers' connection messages go to stderr to keep the printed results parseable
+        with redirect_stdout(sys.stderr):
+            results = asyncio.run(run_load(load_rooms, rounds, votes_per_round, burst, song_length, timeout))
+        duration = time.perf_counter() - start
+    return {
+        "benchmark": "load_harness",
+        "rooms": rooms,
+        "voters": voters,
+        "rounds": rounds,
+        "votes_per_round": votes_per_round,
+        "song_length_ms": song_length,
+        "lead_time_s": lead_time,
+        "handoff": handoff,
+        "api_latency_s": api_latency,
+        "duration_s": duration,
+        "results": results,
+        "track_gaps": track_gap_summary(track_gaps),
+        "handlers": get_handler_stats()
+    }
+
+
+async def run_join_storm(host, joiners, timeout):
+    host_client = LoadClient(host, 'storm')
+    await host_client.connect()
+    await host_client.communicator.send_to(text_data='start_party_session')
+    await host_client.next_round(timeout)
+    await asyncio.sleep(0.1)
+    reset_handler_stats()
+    clients = [LoadClient(joiner, 'storm') for joiner in joiners]
+    latencies = []
+
+    async def join(client):
+        start = time.perf_counter()
+        await client.connect()
+        await client.receive(lambda message: message['type'] == 'user_session_init', timeout)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(join(client) for client in clients))
+    duration = time.perf_counter() - start
+    stats = get_handler_stats()
+    join_handlers = [name for name in ('SessionConsumer.connect', 'SessionConsumer.collect_session_data',
+                                       'SessionConsumer.send_to_single_user_task') if stats[name]["calls"]]
+    queries = sum(stats[name]["queries"] for name in join_handlers)
+    for client in [host_client] + clients:
+        await client.communicator.disconnect()
+    return {
+        "joins_per_second": len(clients) / duration,
+        "join_ms": {
+            "p50": percentile(latencies, 50) * 1000,
+            "p99": percentile(latencies, 99) * 1000,
+            "max": max(latencies) * 1000
+        },
+        "queries_per_join": queries / len(clients),
+        "handlers": {name: stats[name] for name in join_handlers}
+    }
+
+
+# J clients join a running party-session at the same time, e.g. after its QR code went up,
+# measures the time from opening the websocket until the client received its user_session_init
+# joiners are signed guests (signed_guests=1) or users with an account and a membership row (signed_guests=0)
+def join_storm(joiners=500, playlist_size=30, timeout=60, signed_guests=1):
+    no_content = mock.Mock(status_code=204, content=b'')
+    with benchmark_database(), \
+            override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}), \
+            mock.patch.object(spotify_client.http_session, 'request', return_value=no_content):
+        host, storm_joiners = create_load_room('storm', 0 if signed_guests else joiners, playlist_size, 215000)
+        if signed_guests:
+            storm_joiners = [GuestUser() for _ in range(joiners)]
+        with redirect_stdout(sys.stderr):
+            results = asyncio.run(run_join_storm(host, storm_joiners, timeout))
+    return {"benchmark": "join_storm", "joiners": joiners, "signed_guests": bool(signed_guests), "results": results}
+
+
+# V visitors without an account open the page of a party-session, with signed guests and with a user account
+# and login session per guest (SIGNED_GUESTS=False), counts the queries and writes of the party_session view
+# and the rows left behind
+def guest_join_view(visitors=200, playlist_size=30):
+    results = {}
+    for signed_guests in (False, True):
+        with benchmark_database(), override_settings(SIGNED_GUESTS=signed_guests):
+            session_code = 'view'
+            create_load_room(session_code, 0, playlist_size, 215000)
+            users_before = User.objects.count()
+            url = reverse('party_session', kwargs={'room_name': session_code})
+            start = time.perf_counter()
+            with CaptureQueriesContext(connection) as queries:
+                for _ in range(visitors):
+                    Client().get(url)
+            duration = time.perf_counter() - start
+            writes = [query for query in queries.captured_queries
+                      if query['sql'].split(' ', 1)[0] in ('INSERT', 'UPDATE', 'DELETE')]
+            results['signed_guests' if signed_guests else 'accounts'] = {
+                "joins_per_second": visitors / duration,
+                "queries_per_join": len(queries.captured_queries) / visitors,
+                "writes_per_join": len(writes) / visitors,
+                "users_created": User.objects.count() - users_before,
+                "sessions_created": Session.objects.count()
+            }
+    return {"benchmark": "guest_join_view", "visitors": visitors, "results": results}
+
+
+async def run_room_teardown(session_code, host, guests, timeout):
+    host_client = LoadClient(host, session_code)
+    await host_client.connect()
+    guest_clients = [LoadClient(guest, session_code) for guest in guests]
+    await asyncio.gather(*(client.connect(timeout) for client in guest_clients))
+    await host_client.communicator.send_to(text_data='start_party_session')
+    await host_client.next_round(timeout)
+    await asyncio.sleep(0.1)
+    reset_handler_stats()
+
+    # guests leave when they are disconnected by the host's teardown
+    async def leave(client):
+        while (await client.communicator.receive_output(timeout))['type'] != 'websocket.close':
+            pass
+        await client.communicator.disconnect(timeout=timeout)
+
+    start = time.perf_counter()
+    await host_client.communicator.disconnect(timeout=timeout)
+    host_duration = time.perf_counter() - start
+    await asyncio.gather(*(leave(client) for client in guest_clients))
+    duration = time.perf_counter() - start
+    stats = get_handler_stats()
+    return {
+        "host_disconnect_ms": host_duration * 1000,
+        "teardown_ms": duration * 1000,
+        "queries": stats['SessionConsumer.disconnect']["queries"],
+        "handlers": {name: stats[name] for name in ('SessionConsumer.disconnect', 'SessionConsumer.force_disconnect')}
+    }
+
+
+# the host of a party-session with G guests that all voted disconnects,
+# measures the time until the party-session is deleted and every guest left, and the queries of all disconnects
+def room_teardown(guests=(100, 1000), playlist_size=30, timeout=60):
+    if isinstance(guests, int):
+        guests = [guests]
+    no_content = mock.Mock(status_code=204, content=b'')
+    results = []
+    with benchmark_database(), \
+            override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}), \
+            mock.patch.object(spotify_client.http_session, 'request', return_value=no_content):
+        for guest_count in guests:
+            session_code = 'td%d' % guest_count
+            host, room_guests = create_load_room(session_code, guest_count, playlist_size, 215000)
+            # every guest has a vote stored, as after a flush of the vote tally
+            UserJoinedPartySession.objects.filter(party_session__session_code=session_code, is_session_host=False) \
+                .update(user_vote=Song.objects.filter(party_session__session_code=session_code).first())
+            with redirect_stdout(sys.stderr):
+                result = asyncio.run(run_room_teardown(session_code, host, room_guests, timeout))
+            result["guests"] = guest_count
+            results.append(result)
+    return {"benchmark": "room_teardown", "results": results}
+
+
+# count and percentiles of the track gaps observed since the given bucket counts were taken,
+# percentiles are the upper bounds of the histogram buckets they fall into
+def track_gap_summary(counts_before):
+    summary = {}
+    for (handoff,), (counts, total) in metrics.track_gap.values.items():
+        counts = [count - before for count, before in
+                  zip(counts, counts_before.get((handoff,), [0] * len(counts)))]
+        observations = sum(counts)
+        if not observations:
+            continue
+        bounds = metrics.track_gap.buckets + (float('inf'),)
+        gaps = [bound for bound, count in zip(bounds, counts) for _ in range(count)]
+        summary[handoff] = {"count": observations, "p50_le_s": percentile(gaps, 50), "max_le_s": max(gaps)}
+    return summary
+
+
+# one worker process of the room affinity benchmark: drives the websockets of its rooms, puts its results on the queue
+# its inbox runs from the start like in a server process, the rooms it owns may have no websocket connected to it
+def run_worker_load(ring, worker_id, rooms, results, finished, *args):
+    sharding.ring = ring
+    with override_settings(ROOM_AFFINITY_WORKER_ID=worker_id), redirect_stdout(sys.stderr):
+        results.put(asyncio.run(run_worker(rooms, finished, *args)))
+
+
+async def run_worker(rooms, finished, *args):
+    sharding.start_inbox_at_startup(consumers.room_owner_handlers)
+    result = await run_load(rooms, *args)
+    # rooms driven by other workers may still forward to this worker's inbox
+    await asyncio.get_running_loop().run_in_executor(None, finished.wait)
+    result["forwarded_votes"] = handler_stats['room_vote'].calls
+    return result
+
+
+# splits R rooms with V voters each across 1, 2, 4 ... forked worker processes by consistent hashing,
+# every worker runs the load harness for its rooms, voters vote back to back (burst=0 by default)
+# routing='owner' connects every websocket to the owner of its party-session, like a load balancer with room affinity,
+# routing='spread' deals the rooms to the workers in turn: the votes, guest removals and round ends of rooms
+# owned by another worker are forwarded to the owner's inbox, this needs a channel layer shared by the processes
+# and uses the configured CHANNEL_LAYERS instead of the in-memory one
+# votes_per_second is the aggregate of all workers, it only grows with the workers while they get their own processors,
+# votes_per_cpu_second divides all votes by the processor time of the busiest worker:
+# the aggregate throughput if every worker had a processor of its own
+def room_affinity(workers=(1, 2, 4), rooms=40, voters=10, rounds=1, votes_per_round=5, burst=0.0, song_length=60000,
+                  playlist_size=30, timeout=30, routing='owner'):
+    if isinstance(workers, int):
+        workers = [workers]
+    no_content = mock.Mock(status_code=204, content=b'')
+    context = multiprocessing.get_context('fork')
+    results = {}
+    channel_layers = settings.CHANNEL_LAYERS if routing == 'spread' else \
+        {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+    # every process opens its own connection to the database file
+    with tempfile.TemporaryDirectory() as directory, \
+            benchmark_database(directory + '/benchmark.sqlite3'), \
+            override_settings(CHANNEL_LAYERS=channel_layers), \
+            mock.patch.object(spotify_client.http_session, 'request', return_value=no_content):
+        for worker_count in workers:
+            ring = sharding.HashRing(['worker-%d' % index for index in range(worker_count)])
+            worker_rooms = {worker_id: {} for worker_id in ring.workers}
+            forwarded_rooms = 0
+            for index in range(rooms):
+                session_code = 'affinity%dw%d' % (index, worker_count)
+                owner = ring.owner(session_code)
+                worker_id = ring.workers[index % worker_count] if routing == 'spread' else owner
+                forwarded_rooms += worker_id != owner
+                worker_rooms[worker_id][session_code] = create_load_room(
+                    session_code, voters, playlist_size, song_length)
+            connections.close_all()
+            queue = context.Queue()
+            finished = context.Barrier(worker_count)
+            processes = [context.Process(target=run_worker_load,
+                                         args=(ring, worker_id, rooms_of_worker, queue, finished, rounds,
+                                               votes_per_round, burst, song_length, timeout))
+                         for worker_id, rooms_of_worker in worker_rooms.items()]
+            for process in processes:
+                process.start()
+            worker_results = [queue.get() for _ in processes]
+            for process in processes:
+                process.join()
+            votes = sum(result["votes"] for result in worker_results)
+            results[worker_count] = {
+                "rooms_per_worker": sorted(len(rooms_of_worker) for rooms_of_worker in worker_rooms.values()),
+                "forwarded_rooms": forwarded_rooms,
+                "forwarded_votes": sum(result["forwarded_votes"] for result in worker_results),
+                "votes": votes,
+                "lost_votes": sum(result["lost_votes"] for result in worker_results),
+                "votes_per_second": votes / max(result["vote_time_s"] for result in worker_results),
+                "votes_per_cpu_second": votes / max(result["votes"] / result["votes_per_cpu_second"]
+                                                    for result in worker_results),
+                "vote_to_broadcast_p99_ms": max(result["vote_to_broadcast_ms"]["p99"] for result in worker_results)
+            }
+    single = results.get(1)
+    for result in results.values():
+        if single is not None:
+            result["speedup"] = result["votes_per_second"] / single["votes_per_second"]
+            result["cpu_speedup"] = result["votes_per_cpu_second"] / single["votes_per_cpu_second"]
+    return {"benchmark": "room_affinity", "routing": routing, "processors": len(os.sched_getaffinity(0)),
+            "rooms": rooms, "voters": voters, "rounds": rounds, "votes_per_round": votes_per_round, "results": results}
+
+
+# database writes of a vote before the in-memory tally: the user's vote and the song's vote count
+@database_write
+def write_vote(user_joined_session_pk, song_pk):
+    UserJoinedPartySession.objects.filter(pk=user_joined_session_pk).update(user_vote_id=song_pk)
+    Song.objects.filter(pk=song_pk).update(song_votes=F('song_votes') + 1)
+
+
+# every voter writes its votes one after another, all voters write concurrently
+async def run_vote_writes(user_joined_session_pks, song_pks, votes_per_voter):
+    latencies = []
+
+    async def voter(user_joined_session_pk):
+        for _ in range(votes_per_voter):
+            start = time.perf_counter()
+            await write_vote(user_joined_session_pk, random.choice(song_pks))
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(voter(user_joined_session_pk) for user_joined_session_pk in user_joined_session_pks))
+    duration = time.perf_counter() - start
+    return {
+        "writes_per_second": len(latencies) / duration,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": max(latencies) * 1000
+    }
+
+
+# compares vote writes through database_sync_to_async, one transaction each,
+# with the single writer committing batches on a WAL mode database
+# runs against an sqlite database file, commits to an in-memory database would not reach the disk
+def write_queue_throughput(voters=200, votes_per_voter=20):
+    with tempfile.TemporaryDirectory() as directory, \
+            benchmark_database(directory + '/benchmark.sqlite3'):
+        party_session = create_benchmark_session('writes', 4)
+        song_pks = list(Song.objects.filter(party_session=party_session).values_list('pk', flat=True))
+        users = [User.objects.create_user() for _ in range(voters)]
+        user_joined_session_pks = [UserJoinedPartySession.objects.create(user=user, party_session=party_session).pk
+                                   for user in users]
+        results = {}
+        with override_settings(DATABASE_WRITE_QUEUE=False):
+            results["database_sync_to_async"] = asyncio.run(
+                run_vote_writes(user_joined_session_pks, song_pks, votes_per_voter))
+        batches = write_queue.batches
+        with override_settings(DATABASE_WRITE_QUEUE=True):
+            results["write_queue"] = asyncio.run(
+                run_vote_writes(user_joined_session_pks, song_pks, votes_per_voter))
+        batches = write_queue.batches - batches
+        results["write_queue"]["writes_per_batch"] = voters * votes_per_voter / batches
+    return {"benchmark": "write_queue_throughput", "voters": voters, "votes_per_voter": votes_per_voter,
+            "results": results}
+
+
+BENCHMARKS = {
+    "broadcast_encoding": broadcast_encoding,
+    "deck_sampler": deck_sampler,
+    "guest_join_view": guest_join_view,
+    "join_storm": join_storm,
+    "load_harness": load_harness,
+    "room_affinity": room_affinity,
+    "room_teardown": room_teardown,
+    "spotify_stall": spotify_stall,
+    "write_queue_throughput": write_queue_throughput,
+}
@@ -0,0 +1,36 @@
+import asyncio
+import json
+
+
+# encodes the websocket frame sent to clients, group broadcasts encode it once and members forward it unchanged
+def encode_frame(data):
+    return json.dumps({
+        "type": "websocket.send",
+        "text": data
+    })
+
+
+# coalesces vote changes of a party-session into at most one votes_refresh per window:
+# the first change after a broadcast schedules the next one, all later changes inside the window are merged into it
+class VotesRefreshCoalescer:
+    def __init__(self, window, send):
+        self.window = window
+        self.send = send
+        self.pending = None
+
+    # marks the votes as changed, a lone change is broadcast at most one window later
+    def request(self):
+        if self.pending is None:
+            self.pending = asyncio.create_task(self.send_after_window())
+
+    async def send_after_window(self):
+        await asyncio.sleep(self.window)
+        # changes arriving while sending schedule the next window
+        self.pending = None
+        await self.send()
+
+    # drops a scheduled broadcast, e.g. when the party-session is closed
+    def cancel(self):
+        if self.pending is not None:
+            self.pending.cancel()
+            self.pending = None
@@ -1,165 +1,685 @@
 import asyncio
-import json
-import random
+from urllib.parse import parse_qs
+import requests
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from .models import PartySession, UserJoinedPartySession, Song, UserPlaylist, ApiToken, PlaybackDevice
-import spotipy
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from spotipy import SpotifyException
+from spotipy.oauth2 import SpotifyOauthError
+from .models import PartySession, UserJoinedPartySession, Song, UserPlaylist, PlaybackDevice
+from .broadcast import VotesRefreshCoalescer, encode_frame
+from .scheduler import monotonic_time, room_scheduler
+from .room_state import get_room_state, invalidate_room_state
+from .room_store import room_store
+from .sharding import forward_to_owner, is_room_owner
+from .spotify_client import AsyncSpotify
+from .tokens import get_user_token_async
+from .instrumentation import database_sync_to_async, instrument
+from .write_queue import database_write
+from . import metrics
 import time
-from .views import create_spotify_oauth
 
+# number of songs the guests can vote for in each round
+VOTABLE_SONGS_PER_ROUND = 4
+# failures of spotify's web api, of the connection to it or of refreshing the host's token
+SPOTIFY_ERRORS = (SpotifyException, SpotifyOauthError, requests.RequestException)
+# websocket protocol version from which clients receive vote deltas instead of full votes_refresh messages
+VOTES_DELTA_PROTOCOL = 2
+
+# write-behind loops of the vote tallies used by this process, keyed by session code
+vote_flush_tasks = {}
+# debounced votes_refresh broadcasts of all party-sessions handled by this process, keyed by session code
+votes_refresh_coalescers = {}
+# last full votes_refresh frame for clients without delta support as (seq, frame), keyed by session code
+votes_refresh_frames = {}
+# times at which the votes of the next votes delta were applied, keyed by session code
+pending_vote_times = {}
+# timing of the playing song of each party-session whose rounds this worker runs, keyed by session code
+song_timings = {}
+# next round of a party-session, prepared when the vote closed and started when the playing song ends,
+# keyed by session code
+prepared_rounds = {}
+# consumers without a websocket through which this worker runs the party-sessions it owns, keyed by session code
+room_owner_consumers = {}
+# last user_session_init snapshot of each party-session, keyed by session code
+room_snapshots = {}
+# running snapshot builds as (key, task), keyed by session code
+snapshot_builds = {}
+
+
+def get_playing_song_dict(playing_song):
+    return {
+        "title": playing_song.song_name,
+        "artist": playing_song.song_artist,
+        "length": playing_song.song_length,
+        "song_id": playing_song.spotify_song_id,
+        "cover_link": playing_song.song_cover_link
+    }
+
+
+def get_votable_songs_dict(votable_songs, votes):
+    # vote counts are taken from the vote tally, the database might not be flushed yet
+    votable_songs_arr = []
+    for song in votable_songs:
+        votable_songs_arr.append(
+            {
+                "title": song.song_name,
+                "artist": song.song_artist,
+                "length": song.song_length,
+                "votes": votes.get(song.spotify_song_id, song.song_votes),
+                "song_id": song.spotify_song_id,
+                "cover_link": song.song_cover_link
+            }
+        )
+    return votable_songs_arr
+
+
+# encoded user_session_init frame of a running party-session,
+# shared by every late joiner and resync until the room state or the votes change
+class RoomSnapshot:
+    def __init__(self, key, frame):
+        self.key = key
+        self.frame = frame
+
+
+# returns the user_session_init frame of a party-session, built at most once per room state version
+# and vote sequence number, concurrent requests share one build, e.g. when hundreds of guests join at once
+# returns None if the party-session does not exist or is not started yet
+async def get_room_snapshot(session_code):
+    # the version is read before the room state, a snapshot built from an outdated state is never reused
+    version = await room_store.get_room_state_version(session_code)
+    await ensure_vote_tally(session_code)
+    seq, votes = await room_store.get_votes(session_code)
+    key = (version, seq)
+    snapshot = room_snapshots.get(session_code)
+    if snapshot is not None and snapshot.key == key:
+        return snapshot.frame
+    build_key, build = snapshot_builds.get(session_code, (None, None))
+    if build is None or build_key != key:
+        build = asyncio.ensure_future(build_room_snapshot(session_code, key, seq, votes))
+        snapshot_builds[session_code] = (key, build)
+    return await asyncio.shield(build)
+
+
+async def build_room_snapshot(session_code, key, seq, votes):
+    try:
+        room_state = await get_room_state(session_code)
+        if room_state is None or not room_state.is_initialized:
+            return None
+        frame = encode_frame({
+            "type": "user_session_init",
+            "seq": seq,
+            "playing_song": get_playing_song_dict(room_state.playing_song),
+            "votable_songs": get_votable_songs_dict(room_state.votable_songs, votes),
+            "playback_started": room_state.playback_started
+        })
+        metrics.room_snapshot_builds.inc()
+        room_snapshots[session_code] = RoomSnapshot(key, frame)
+        return frame
+    finally:
+        if snapshot_builds.get(session_code, (None, None))[0] == key:
+            del snapshot_builds[session_code]
+
+
+# makes sure the vote tally of a party-session exists in the room store, restores it from the database otherwise,
+# and starts this process' write-behind loop for it, with room affinity only the owning worker writes the tally
+async def ensure_vote_tally(session_code):
+    flush_task = vote_flush_tasks.get(session_code)
+    if flush_task is not None and not flush_task.done():
+        return
+    if not await room_store.has_tally(session_code):
+        song_ids, user_votes = await load_vote_tally(session_code)
+        # a tally created by another task or process while the database was queried is kept
+        await room_store.init_tally(session_code, song_ids, user_votes)
+    flush_task = vote_flush_tasks.get(session_code)
+    if (flush_task is None or flush_task.done()) and is_room_owner(session_code):
+        vote_flush_tasks[session_code] = asyncio.create_task(vote_tally_flush_loop(session_code))
+
+
+# writes the vote tally to the database if votes have changed since the last flush
+async def flush_vote_tally(session_code):
+    snapshot = await room_store.take_snapshot(session_code)
+    if snapshot is not None:
+        votes, user_votes = snapshot
+        await write_vote_tally(session_code, votes, user_votes)
+
+
+# write-behind loop: periodically persists the tally while the party-session exists,
+# with a shared room store only one process takes each snapshot and writes it
+# a failing flush ends the loop, the next vote starts a new one, see ensure_vote_tally
+async def vote_tally_flush_loop(session_code):
+    try:
+        while await room_store.has_tally(session_code):
+            await asyncio.sleep(settings.VOTE_FLUSH_INTERVAL)
+            await flush_vote_tally(session_code)
+    except Exception as error:
+        print('Flushing the vote tally of session %s failed: %r' % (session_code, error))
+    finally:
+        if vote_flush_tasks.get(session_code) is asyncio.current_task():
+            del vote_flush_tasks[session_code]
+
+
+# removes the vote tally of a closed party-session and stops the flush loop of this process
+async def discard_vote_tally(session_code):
+    flush_task = vote_flush_tasks.pop(session_code, None)
+    if flush_task is not None:
+        flush_task.cancel()
+    await room_store.discard_tally(session_code)
+
+
+# stops pending votes_refresh broadcasts of a closed party-session
+def discard_votes_refresh_coalescer(session_code):
+    coalescer = votes_refresh_coalescers.pop(session_code, None)
+    if coalescer is not None:
+        coalescer.cancel()
+    votes_refresh_frames.pop(session_code, None)
+    pending_vote_times.pop(session_code, None)
+
+
+# stops everything this worker runs for a closed party-session
+async def close_room(session_code):
+    await discard_vote_tally(session_code)
+    discard_votes_refresh_coalescer(session_code)
+    room_scheduler.close_room(session_code)
+    song_timings.pop(session_code, None)
+    prepared_rounds.pop(session_code, None)
+    room_owner_consumers.pop(session_code, None)
+    room_snapshots.pop(session_code, None)
+
+
+# returns the consumer through which the owning worker runs a party-session it has no host websocket for,
+# None if the party-session does not exist anymore
+async def get_room_owner_consumer(session_code):
+    consumer = room_owner_consumers.get(session_code)
+    if consumer is None:
+        host = await get_session_host(session_code)
+        if host is None:
+            return None
+        consumer = room_owner_consumers.setdefault(session_code, SessionConsumer.for_room(session_code, host))
+    return consumer
+
+
+# handlers of the messages other workers forward to the owner of a party-session, see sharding.py
+@instrument(max_queries=3)
+async def room_vote(message):
+    consumer = await get_room_owner_consumer(message['room'])
+    if consumer is not None:
+        await consumer.apply_vote(message['user'], message['vote'])
+
+
+@instrument(max_queries=1)
+async def room_remove_user(message):
+    consumer = await get_room_owner_consumer(message['room'])
+    if consumer is not None:
+        await room_store.remove_user(message['room'], message['user'])
+        consumer.request_votes_refresh()
+
+
+@instrument(max_queries=1)
+async def room_schedule_round(message):
+    consumer = await get_room_owner_consumer(message['room'])
+    if consumer is not None:
+        consumer.schedule_round(message['song_id'], message['song_length'])
+
+
+@instrument(max_queries=0)
+async def room_close(message):
+    await close_room(message['room'])
+
+
+room_owner_handlers = {
+    'room_vote': room_vote,
+    'room_remove_user': room_remove_user,
+    'room_schedule_round': room_schedule_round,
+    'room_close': room_close,
+}
+
+
+# playing song of a party-session on the monotonic clock of the event loop, see scheduler.monotonic_time
+class SongTiming:
+    def __init__(self, song_id, song_length, song_end):
+        self.song_id = song_id
+        self.song_length = song_length
+        # corrected by every playback poll that finds spotify more than PLAYBACK_DRIFT_TOLERANCE seconds off
+        self.song_end = song_end
+        self.poll_interval = settings.PLAYBACK_POLL_MIN_INTERVAL
+        self.paused = False
+        # the host started another song on the device, the winner has to be started instead of queued
+        self.skipped = False
+
+    # the vote closes a lead time before the end, at most half of the song
+    @property
+    def vote_end(self):
+        return self.song_end - min(settings.ROUND_LEAD_TIME, self.song_length / 2)
+
+
+# next round prepared while the current song is still playing:
+# its song, the song it replaces and the encoded session_refresh frame announcing it
+class PreparedRound:
+    def __init__(self, playing_song, previous_song, playback_started, frame, queued):
+        self.playing_song = playing_song
+        self.previous_song = previous_song
+        self.playback_started = playback_started
+        self.frame = frame
+        # True if the song was added to spotify's queue and starts without a request at the end of the current song
+        self.queued = queued
+
+
+@database_sync_to_async
+def get_session_host(session_code):
+    host_joined_session = UserJoinedPartySession.objects.filter(
+        party_session__session_code=session_code, is_session_host=True).select_related('user').first()
+    return host_joined_session.user if host_joined_session else None
+
+
+@database_sync_to_async
+def load_vote_tally(session_code):
+    song_ids = list(Song.objects.filter(party_session__session_code=session_code, is_votable=True)
+                    .values_list('track_id', flat=True))
+    user_votes = dict(UserJoinedPartySession.objects.filter(party_session__session_code=session_code,
+                                                            user_vote__isnull=False)
+                      .values_list('user_id', 'user_vote__track_id'))
+    return song_ids, user_votes
+
+
+@database_write
+def write_vote_tally(session_code, votes, user_votes):
+    with transaction.atomic():
+        votable_songs = list(Song.objects.filter(party_session__session_code=session_code, is_votable=True))
+        for song in votable_songs:
+            song.song_votes = votes.get(song.spotify_song_id, 0)
+        Song.objects.bulk_update(votable_songs, ['song_votes'])
+
+        song_pks = {song.spotify_song_id: song.pk for song in votable_songs}
+        joined_users = list(UserJoinedPartySession.objects.filter(party_session__session_code=session_code))
+        for user_joined_session in joined_users:
+            user_joined_session.user_vote_id = song_pks.get(user_votes.get(user_joined_session.user_id))
+        UserJoinedPartySession.objects.bulk_update(joined_users, ['user_vote'])
 
+
+# entry points and tasks are instrumented, see instrumentation.py
+# query budgets are upper bounds for a single call with a cold room state cache, vote tally and a deck reshuffle
 class SessionConsumer(AsyncWebsocketConsumer):
+    # consumer of the session-host without a websocket, used by the owning worker to end rounds and broadcast votes
+    @classmethod
+    def for_room(cls, session_code, host):
+        consumer = cls()
+        consumer.channel_layer = get_channel_layer()
+        consumer.user = host
+        consumer.user_id = host.identifier
+        consumer.room_name = session_code
+        consumer.room_group_name = 'partySession_%s' % session_code
+        consumer.protocol_version = VOTES_DELTA_PROTOCOL
+        consumer.is_host = True
+        consumer.room_closed = False
+        return consumer
+
+    @instrument(max_queries=4)
     async def connect(self):
         self.user = self.scope["user"]
         self.room_name = self.scope['url_route']['kwargs']['room_name']
         self.room_group_name = 'partySession_%s' % self.room_name
         self.user_id = self.user.identifier
+        # clients announce their protocol version in the query string, e.g. ?protocol=2
+        query = parse_qs(self.scope['query_string'].decode())
+        self.protocol_version = VOTES_DELTA_PROTOCOL if query.get('protocol') == [str(VOTES_DELTA_PROTOCOL)] else 1
+        # set when the host closed the party-session
+        self.room_closed = False
 
         print('Connected Session: ' + self.room_name)
         print('Connected User: ' + self.user_id)
 
+        # the user's role does not change while connected, signed guests are never hosts
+        self.is_host = not self.user.is_guest and await self.user_is_session_host(self.user, self.room_name)
+
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
 
         await self.accept()
+        metrics.socket_opened(self.room_name)
 
         # initializes the session for a single, late joining user
-        current_session = await self.get_current_party_session(self.room_name)
-        if current_session.is_initialized:
-            asyncio.create_task(self.collect_session_data('user_session_init'))
+        room_state = await get_room_state(self.room_name)
+        if room_state and room_state.is_initialized:
+            asyncio.create_task(self.send_to_single_user_task())
 
     # differentiates client messages
+    @instrument(max_queries=15)
     async def receive(self, text_data):
         received_data = text_data
-        current_session = await self.get_current_party_session(self.room_name)
+        # clock synchronization: clients send their clock as 'time_sync:<unix time in ms>' and estimate their offset
+        # to the server's clock from the round trip of the answer
+        if str(received_data).startswith('time_sync:'):
+            await self.send(encode_frame({
+                "type": "time_sync",
+                "client_time": str(received_data)[len('time_sync:'):],
+                "server_time": int(time.time() * 1000)
+            }))
+            return
+        # served from the room state cache, votes do not cause any database reads
+        room_state = await get_room_state(self.room_name)
+        if not room_state:
+            return
         # check if message is a session_init and if the messaging user is the session-host
         if str(received_data) == 'start_party_session':
-            if await self.user_is_session_host(self.user, self.room_name):
+            # a party-session can only be started once
+            if not room_state.is_initialized and self.is_host:
                 playing_song = await self.get_first_song(self.room_name)
                 playing_song.is_playing = True
-                await database_sync_to_async(playing_song.save)()
+                await database_write(playing_song.save)()
                 await self.set_votable_songs()
+                await invalidate_room_state(self.room_name)
 
                 asyncio.create_task(self.collect_session_data('session_init'))
 
-        # all strings other than 'start_party_session' are treated as potential spotify-song-ids
+        # clients that missed a vote delta request a new snapshot
+        elif str(received_data) == 'resync':
+            if room_state.is_initialized:
+                asyncio.create_task(self.send_to_single_user_task())
+
+        # all strings other than 'start_party_session' and 'resync' are treated as potential spotify-song-ids
         # only start voting task if voting is currently allowed
-        elif current_session.voting_allowed:
+        elif room_state.voting_allowed:
             asyncio.create_task(self.new_vote_task(received_data))
 
+    @instrument(max_queries=10)
     async def collect_session_data(self, message_type):
-        # get songs selected for playing and voting from database as dictionaries
-        playing_song = await self.get_playing_song_dict(await self.get_playing_song(self.room_name))
-        votable_songs = await self.get_votable_songs_dict(await self.get_votable_songs(self.room_name))
-
-        # create dictionary with data from above
+        # get songs selected for playing and voting from the room state as dictionaries
+        room_state = await get_room_state(self.room_name)
+        playing_song = get_playing_song_dict(room_state.playing_song)
+        await ensure_vote_tally(self.room_name)
+        seq, votes = await room_store.get_votes(self.room_name)
+        votable_songs = get_votable_songs_dict(room_state.votable_songs, votes)
+
+        # create dictionary with data from above,
+        # the sequence number tells clients which vote deltas are already contained in the snapshot
         collected_data = {
             "type": message_type,
+            "seq": seq,
             "playing_song": playing_song,
             "votable_songs": votable_songs
         }
 
         if message_type == 'session_init':
-            current_session = await self.get_current_party_session(self.room_name)
-            current_session.is_initialized = True
-            await database_sync_to_async(current_session.save)()
+            await self.set_session_initialized(self.room_name)
             # send initial data to all users in session
             playback_started = await self.record_playback_start(self.room_name)
+            await invalidate_room_state(self.room_name)
             collected_data["playback_started"] = playback_started
             asyncio.create_task(self.send_to_session_task(collected_data, message_type))
             # start playback
             await self.play_song()
-        elif message_type == 'session_refresh':
-            playback_started = await self.record_playback_start(self.room_name)
-            collected_data["playback_started"] = playback_started
-            asyncio.create_task(self.send_to_session_task(collected_data, message_type))
-            await self.play_song()
-        elif message_type == 'user_session_init':
-            session = await self.get_current_party_session(self.room_name)
-            playback_started = session.playback_started
-            collected_data["playback_started"] = playback_started
-            asyncio.create_task(self.send_to_single_user_task(collected_data))
 
     # starts session and voting on the session-host's command
+    @instrument(max_queries=1)
     async def send_to_session_task(self, received_data, message_type):
         init_data = received_data
-        await self.set_voting_allowed(await self.get_current_party_session(self.room_name), True)
-        # echo dictionary to whole session
-        await self.channel_layer.group_send(
-            self.room_group_name, {
-                "type": message_type,
-                "text": init_data
-            }
-        )
-        # collect votes after song playback is finished
-        asyncio.create_task(self.collect_votes_task())
-
-    # initialize session for single user
-    async def send_to_single_user_task(self, received_data):
-        init_data = received_data
-        await self.send(json.dumps({
-            "type": "websocket.send",
-            "text": init_data
-        }))
-
+        await self.set_voting_allowed(self.room_name, True)
+        await invalidate_room_state(self.room_name)
+        # echo dictionary to whole session, encoded once for all members
+        await self.send_to_group({
+            "type": message_type,
+            "frame": encode_frame(init_data)
+        })
+        song_id = init_data["playing_song"]["song_id"]
+        song_length = init_data["playing_song"]["length"] / 1000
+        if is_room_owner(self.room_name):
+            self.schedule_round(song_id, song_length)
+        else:
+            await forward_to_owner(self.room_name, {"type": "room.schedule_round", "song_id": song_id,
+                                                    "song_length": song_length})
+
+    # initialize session for single user, the snapshot is shared by all users joining the same round
+    # a cold snapshot costs a room state load and a vote tally restore
+    @instrument(max_queries=5)
+    async def send_to_single_user_task(self):
+        frame = await get_room_snapshot(self.room_name)
+        if frame is not None:
+            await self.send(frame)
+
+    @instrument(max_queries=2)
     async def new_vote_task(self, received_data):
         new_vote = str(received_data)
-        # all possible strings are passed to the UserJoinedPartySession change_vote method
-        user_joined_session = await self.get_user_join_party_session(self.user, self.room_name)
+        # with room affinity the owning worker applies the vote and broadcasts the votes delta
+        if not is_room_owner(self.room_name):
+            await forward_to_owner(self.room_name, {"type": "room.vote", "user": self.user.pk, "vote": new_vote})
+            return
+        await self.apply_vote(self.user.pk, new_vote)
+
+    async def apply_vote(self, user_pk, new_vote):
+        # all possible strings are applied to the vote tally, invalid song-ids are rejected
+        await ensure_vote_tally(self.room_name)
         # if vote was valid: refresh votes for whole session
-        if await database_sync_to_async(user_joined_session.change_vote)(new_vote):
-            asyncio.create_task(self.refresh_votes_task())
-
-    # echoes new vote count to whole session
+        if await room_store.vote(self.room_name, user_pk, new_vote):
+            metrics.received_votes.inc(result='accepted')
+            pending_vote_times.setdefault(self.room_name, []).append(time.perf_counter())
+            self.request_votes_refresh()
+        else:
+            metrics.received_votes.inc(result='rejected')
+
+    # schedules a debounced votes_refresh, all vote changes within one window are sent together
+    def request_votes_refresh(self):
+        coalescer = votes_refresh_coalescers.get(self.room_name)
+        if coalescer is None:
+            coalescer = VotesRefreshCoalescer(settings.VOTES_REFRESH_WINDOW, self.refresh_votes_task)
+            votes_refresh_coalescers[self.room_name] = coalescer
+        coalescer.request()
+
+    # echoes the changed vote counts to whole session
+    @instrument(max_queries=0)
     async def refresh_votes_task(self):
-        votable_songs = await self.get_votable_songs_dict(await self.get_votable_songs(self.room_name))
+        delta = await room_store.pop_delta(self.room_name)
+        if delta is None:
+            return
+        seq, votes = delta
+        vote_times = pending_vote_times.pop(self.room_name, [])
         refresh_data = {
-            "type": "votes_refresh",
-            "votable_songs": votable_songs
+            "type": "votes_delta",
+            "seq": seq,
+            "votes": votes
         }
-        await self.channel_layer.group_send(
-            self.room_group_name, {
-                "type": "votes_refresh",
-                "text": refresh_data
-            }
-        )
-
-    async def collect_votes_task(self):
-        playing_song = await self.get_playing_song(self.room_name)
-        wait_time = playing_song.song_length
-        await asyncio.sleep(wait_time / 1000)
+        await self.send_to_group({
+            "type": "votes_refresh",
+            "seq": seq,
+            "frame": encode_frame(refresh_data)
+        })
+        sent = time.perf_counter()
+        for vote_time in vote_times:
+            metrics.vote_broadcast_latency.observe(sent - vote_time)
+
+    # closes the vote of the round a lead time before the playing song ends and starts the next round when it ends,
+    # the room scheduler replaces any deadline that might already exist for this session
+    def schedule_round(self, song_id, song_length, song_started=None):
+        song_end = (song_started or monotonic_time()) + song_length
+        song_timings[self.room_name] = SongTiming(song_id, song_length, song_end)
+        self.schedule_vote_end()
+
+    # polls the playback position until shortly before the vote ends, the last poll is due
+    # PLAYBACK_POLL_MIN_INTERVAL seconds before it, so a poll never moves the vote end into the past
+    def schedule_vote_end(self):
+        timing = song_timings[self.room_name]
+        now = monotonic_time()
+        min_interval = settings.PLAYBACK_POLL_MIN_INTERVAL
+        if settings.PLAYBACK_SYNC and timing.paused:
+            room_scheduler.schedule_at(self.room_name, now + min_interval, self.sync_playback_task)
+        elif settings.PLAYBACK_SYNC and timing.vote_end - now > min_interval:
+            next_poll = now + min(timing.poll_interval, timing.vote_end - now - min_interval)
+            room_scheduler.schedule_at(self.room_name, next_poll, self.sync_playback_task)
+        else:
+            room_scheduler.schedule_at(self.room_name, timing.vote_end, self.close_round_task)
+
+    # reconciles the round deadline with the playback position of the host's device:
+    # corrects it and the clients' progress bars if it drifted, e.g. after a pause or seek,
+    # ends the round if the host skipped the song, polls less often while the deadline matches
+    @instrument(max_queries=3)
+    async def sync_playback_task(self):
+        timing = song_timings.get(self.room_name)
+        if timing is None:
+            return
+        # a failed poll must not leave the room without a deadline, the rounds would stop for good
+        try:
+            await self.reconcile_playback(timing)
+        finally:
+            # the room might have been closed while polling
+            if self.room_name in song_timings:
+                self.schedule_vote_end()
+
+    async def reconcile_playback(self, timing):
+        playback = await self.get_current_playback()
+        now = monotonic_time()
+        # nothing is known if spotify failed or nothing is playing on the host's account
+        if playback is not None and playback.get('item'):
+            if playback['item']['id'] != timing.song_id:
+                print('Playing song was skipped in session: ' + self.room_name)
+                timing.song_end = now
+                timing.skipped = True
+            else:
+                progress = playback['progress_ms'] / 1000
+                song_end = now + playback['item']['duration_ms'] / 1000 - progress
+                drift = song_end - timing.song_end
+                timing.song_end = song_end
+                paused = not playback['is_playing']
+                # while paused the song end moves with the clock, clients are only told when the pause begins or ends
+                if paused == timing.paused and not paused:
+                    metrics.playback_drift.observe(abs(drift))
+                if paused != timing.paused or (not paused and abs(drift) > settings.PLAYBACK_DRIFT_TOLERANCE):
+                    timing.poll_interval = settings.PLAYBACK_POLL_MIN_INTERVAL
+                    timing.paused = paused
+                    await self.sync_playback_start(int(time.time() * 1000 - progress * 1000), paused)
+                elif not paused:
+                    timing.poll_interval = min(2 * timing.poll_interval, settings.PLAYBACK_POLL_MAX_INTERVAL)
+
+    # moves the playback start of the party-session to match spotify's playback position
+    async def sync_playback_start(self, playback_started, paused):
+        await self.set_playback_started(self.room_name, playback_started)
+        await invalidate_room_state(self.room_name)
+        await self.send_to_group({
+            "type": "playback_sync",
+            "frame": encode_frame({
+                "type": "playback_sync",
+                "playback_started": playback_started,
+                "paused": paused
+            })
+        })
+
+    # called by the room scheduler a lead time before the playing song ends:
+    # closes the vote, draws the candidates of the next round and encodes its session_refresh
+    # at most 24 queries: a cold room state cache and a deck reshuffle in the same round
+    @instrument(max_queries=24)
+    async def close_round_task(self):
+        room_state = await get_room_state(self.room_name)
 
         # skips task if host has already disconnected
-        if await self.get_current_party_session(self.room_name):
+        if room_state:
+            # with several worker processes only one of them ends each round
+            round_key = '%s:%s' % (room_state.playback_started, room_state.playing_song.spotify_song_id)
+            if not await room_store.claim_round_end(self.room_name, round_key):
+                return
+            playing_song = room_state.playing_song
             # no additional votes should be added during processing,
-            # voting will be re-allowed on session refresh
-            await self.set_voting_allowed(await self.get_current_party_session(self.room_name), False)
-
-            votable_songs = await self.get_votable_songs(self.room_name)
-            most_voted_song = await self.get_most_voted_song(votable_songs)
-            await self.set_new_playing_song(most_voted_song, playing_song)
-            await self.set_votable_songs()
-
-            # refresh session
-            asyncio.create_task(self.collect_session_data('session_refresh'))
-
+            # voting will be re-allowed when the next round starts
+            await self.set_voting_allowed(self.room_name, False)
+            await invalidate_room_state(self.room_name)
+            # a round that could not be prepared must not leave voting closed for good
+            try:
+                # persist the final vote count of this round
+                await flush_vote_tally(self.room_name)
+
+                # the winner is picked from the vote tally: the flush skips a snapshot that another write-behind pass
+                # is still writing, so the database might not have all votes yet
+                await ensure_vote_tally(self.room_name)
+                seq, votes = await room_store.get_votes(self.room_name)
+                votable_songs = await self.get_votable_songs(self.room_name)
+                most_voted_song = await self.get_most_voted_song(votable_songs, votes)
+                # the winner only starts playing when the playing song ends, it must not be drawn for its own round
+                next_votable_songs = await self.set_votable_songs(exclude=[most_voted_song])
+                await invalidate_room_state(self.room_name)
+
+                timing = song_timings.get(self.room_name) or SongTiming(playing_song.spotify_song_id, 0,
+                                                                         monotonic_time())
+                seq, votes = await room_store.get_votes(self.room_name)
+                playback_started = int((time.time() + max(0, timing.song_end - monotonic_time())) * 1000)
+                frame = encode_frame({
+                    "type": "session_refresh",
+                    "seq": seq,
+                    "playing_song": get_playing_song_dict(most_voted_song),
+                    "votable_songs": get_votable_songs_dict(next_votable_songs, votes),
+                    "playback_started": playback_started
+                })
+                queued = False
+                # a queued song would only play after the song the host skipped to
+                if settings.ROUND_HANDOFF == 'queue' and not timing.skipped:
+                    queued = await self.queue_song(most_voted_song)
+                    if queued:
+                        metrics.track_gap.observe(max(0, monotonic_time() - timing.song_end), handoff='queue')
+                prepared_rounds[self.room_name] = PreparedRound(most_voted_song, playing_song, playback_started, frame,
+                                                                queued)
+                room_scheduler.schedule_at(self.room_name, timing.song_end, self.start_round_task)
+            except Exception:
+                # the round is ended again after a delay, the party would stop without a deadline
+                await room_store.release_round_end(self.room_name, round_key)
+                room_scheduler.schedule_at(self.room_name, monotonic_time() + settings.ROUND_RETRY_DELAY,
+                                           self.close_round_task)
+                await self.set_voting_allowed(self.room_name, True)
+                await invalidate_room_state(self.room_name)
+                raise
+
+    # called by the room scheduler when the playing song ends: starts the prepared round
+    @instrument(max_queries=6)
+    async def start_round_task(self):
+        prepared_round = prepared_rounds.pop(self.room_name, None)
+        if prepared_round is None:
+            return
+        timing = song_timings.get(self.room_name)
+        song_end = timing.song_end if timing is not None else monotonic_time()
+        await self.start_prepared_round(self.room_name, prepared_round.playing_song, prepared_round.previous_song,
+                                        prepared_round.playback_started)
+        await invalidate_room_state(self.room_name)
+        await self.send_to_group({
+            "type": "session_refresh",
+            "frame": prepared_round.frame
+        })
+        metrics.round_transition_duration.observe(monotonic_time() - song_end)
+        song_started = song_end
+        if not prepared_round.queued:
+            # a failing playback request must not end the rounds of the party-session
+            try:
+                await self.start_song(prepared_round.playing_song)
+            except SPOTIFY_ERRORS as error:
+                print('Starting the next song failed: %s' % error)
+            song_started = monotonic_time()
+            metrics.track_gap.observe(song_started - song_end, handoff='start')
+        self.schedule_round(prepared_round.playing_song.spotify_song_id,
+                            prepared_round.playing_song.song_length / 1000, song_started)
+
+    # the party-session of the host is deleted in a constant number of queries, independent of its size
+    @instrument(max_queries=8)
     async def disconnect(self, close_code):
+        metrics.socket_closed(self.room_name)
+        # guests disconnected by the host leave without touching the deleted party-session
+        if self.room_closed:
+            await self.channel_layer.group_discard(
+                self.room_group_name,
+                self.channel_name
+            )
+            print("Disconnected User: " + self.user_id)
         # if host disconnects:
-        # close websocket for all users in session, delete partySession instance cascade
-        if await self.get_current_party_session(self.room_name) and await self.user_is_session_host(self.user,
-                                                                                                    self.room_name):
+        # close websocket for all users in session, delete partySession instance with all its rows
+        elif self.is_host and await get_room_state(self.room_name):
             print('Disconnected Host-User: ' + self.user_id)
             print('All other Users will be disconnected!')
-            current_session = await self.get_current_party_session(self.room_name)
-            await database_sync_to_async(current_session.delete)()
-            await self.channel_layer.group_send(
-                self.room_group_name, {
-                    "type": "force_disconnect"
-                }
-            )
+            await close_room(self.room_name)
+            if not is_room_owner(self.room_name):
+                await forward_to_owner(self.room_name, {"type": "room.close"})
+            await self.delete_party_session(self.room_name)
+            await invalidate_room_state(self.room_name)
+            await room_store.discard_room(self.room_name)
+            await self.send_to_group({
+                "type": "force_disconnect"
+            })
             await self.channel_layer.group_discard(
                 self.room_group_name,
                 self.channel_name
@@ -172,151 +692,173 @@ class SessionConsumer(AsyncWebsocketConsumer):
                 self.room_group_name,
                 self.channel_name
             )
-            if await self.get_current_party_session(self.room_name):
-                # delete user-party_session-relationship
-                await database_sync_to_async(UserJoinedPartySession.objects.filter(
-                    user=self.user, party_session__session_code=self.room_name).delete)()
+            if await get_room_state(self.room_name):
+                # delete user-party_session-relationship, signed guests have none
+                if not self.user.is_guest:
+                    await database_write(UserJoinedPartySession.objects.filter(
+                        user=self.user, party_session__session_code=self.room_name).delete)()
                 # deleting relationship-object might reduce vote-count:
                 # refresh votes
-                asyncio.create_task(self.refresh_votes_task())
+                if is_room_owner(self.room_name):
+                    await room_store.remove_user(self.room_name, self.user.pk)
+                    self.request_votes_refresh()
+                else:
+                    await forward_to_owner(self.room_name, {"type": "room.remove_user", "user": self.user.pk})
             print("Disconnected User: " + self.user_id)
 
+    # broadcasts a message to all members of the party-session
+    async def send_to_group(self, message):
+        start = time.perf_counter()
+        await self.channel_layer.group_send(self.room_group_name, message)
+        metrics.group_send_duration.observe(time.perf_counter() - start, message=message['type'])
+
     # wrapper functions for websocket send
+    # frames are encoded once by the sender and forwarded unchanged
+    @instrument(max_queries=0)
     async def session_init(self, event):
-        await self.send(json.dumps({
-            "type": "websocket.send",
-            "text": event['text']
-        }))
+        await self.send(event['frame'])
 
+    @instrument(max_queries=0)
     async def session_refresh(self, event):
-        await self.send(json.dumps({
-            "type": "websocket.send",
-            "text": event['text']
-        }))
+        await self.send(event['frame'])
 
+    @instrument(max_queries=5)
     async def votes_refresh(self, event):
-        await self.send(json.dumps({
-            "type": "websocket.send",
-            "text": event['text']
-        }))
-
+        if self.protocol_version >= VOTES_DELTA_PROTOCOL:
+            await self.send(event['frame'])
+        else:
+            # clients without delta support receive all votable songs,
+            # the frame is built once per sequence number and shared by all of them
+            seq, frame = votes_refresh_frames.get(self.room_name, (None, None))
+            if seq != event['seq']:
+                room_state = await get_room_state(self.room_name)
+                if not room_state:
+                    return
+                seq, votes = await room_store.get_votes(self.room_name)
+                frame = encode_frame({
+                    "type": "votes_refresh",
+                    "seq": event['seq'],
+                    "votable_songs": get_votable_songs_dict(room_state.votable_songs, votes)
+                })
+                votes_refresh_frames[self.room_name] = (event['seq'], frame)
+            await self.send(frame)
+
+    @instrument(max_queries=0)
+    async def playback_sync(self, event):
+        await self.send(event['frame'])
+
+    @instrument(max_queries=0)
     async def force_disconnect(self, event):
+        self.room_closed = True
         await self.close()
 
     # regular async functions
-    async def set_votable_songs(self):
-        for i in range(4):
-            not_played_songs = await self.get_not_played_songs(self.room_name)
-            random_song = random.choice(not_played_songs)
-            random_song.is_votable = True
-            await database_sync_to_async(random_song.save)()
-
-    async def get_playing_song_dict(self, playing_song):
-        return {
-            "title": playing_song.song_name,
-            "artist": playing_song.song_artist,
-            "length": playing_song.song_length,
-            "song_id": playing_song.spotify_song_id,
-            "cover_link": playing_song.song_cover_link
-        }
-
-    async def get_votable_songs_dict(self, votable_songs):
-        votable_songs_arr = []
-        for song in votable_songs:
-            votable_songs_arr.append(
-                {
-                    "title": song.song_name,
-                    "artist": song.song_artist,
-                    "length": song.song_length,
-                    "votes": song.song_votes,
-                    "song_id": song.spotify_song_id,
-                    "cover_link": song.song_cover_link
-                }
-            )
-        return votable_songs_arr
+    async def set_votable_songs(self, exclude=()):
+        votable_songs = await self.draw_votable_songs(self.room_name, exclude)
+        # start a new round in the vote tally
+        await room_store.reset_tally(self.room_name, [song.spotify_song_id for song in votable_songs])
+        await ensure_vote_tally(self.room_name)
+        return votable_songs
 
     # starts playback for song selected as currently playing
     async def play_song(self):
-        sp = spotipy.Spotify(auth=await self.get_user_token())
+        await self.start_song(await self.get_playing_song(self.room_name))
+
+    async def start_song(self, song):
+        sp = AsyncSpotify(auth=await get_user_token_async(self.user))
         playback_device = await self.get_playback_device()
-        playing_song = await self.get_playing_song(self.room_name)
         # start playback on selected device
-        sp.start_playback(device_id=playback_device.spotify_device_id,
-                          uris=["spotify:track:" + str(playing_song.spotify_song_id)])
+        await sp.start_playback(device_id=playback_device.spotify_device_id if playback_device else None,
+                                uris=["spotify:track:" + str(song.spotify_song_id)])
+
+    # adds the song to the queue of the selected device, spotify plays it without a gap after the current song
+    # returns False if spotify refused or could not be reached, e.g. without an active device,
+    # or the host's token could not be refreshed, the song is started at the end instead
+    async def queue_song(self, song):
+        try:
+            sp = AsyncSpotify(auth=await get_user_token_async(self.user))
+            playback_device = await self.get_playback_device()
+            await sp.add_to_queue("spotify:track:" + str(song.spotify_song_id),
+                                  device_id=playback_device.spotify_device_id if playback_device else None)
+        except SPOTIFY_ERRORS as error:
+            print('Queueing the next song failed: %s' % error)
+            return False
+        return True
+
+    # returns the playback state of the host's account or None if nothing is playing or spotify failed
+    async def get_current_playback(self):
+        try:
+            sp = AsyncSpotify(auth=await get_user_token_async(self.user))
+            return await sp.current_playback()
+        except SPOTIFY_ERRORS as error:
+            print('Polling the playback position failed: %s' % error)
+            return None
 
     # functions for database queries
     # or repeated database access
-    @database_sync_to_async
-    def get_user_join_party_session(self, user, session_code):
-        return UserJoinedPartySession.objects.filter(user=user, party_session__session_code=session_code)[0]
+    @database_write
+    def set_session_initialized(self, session_code):
+        PartySession.objects.filter(session_code=session_code).update(is_initialized=True)
 
-    @database_sync_to_async
-    def get_current_party_session(self, current_session_code):
-        if PartySession.objects.filter(session_code=current_session_code).exists():
-            current_party_session = PartySession.objects.filter(session_code=current_session_code)[0]
-            return current_party_session
-        else:
-            return False
+    @database_write
+    def set_voting_allowed(self, session_code, voting_allowed):
+        PartySession.objects.filter(session_code=session_code).update(voting_allowed=voting_allowed)
 
-    @database_sync_to_async
-    def set_voting_allowed(self, party_session, voting_allowed):
-        party_session.voting_allowed = voting_allowed
-        party_session.save()
+    @database_write
+    def delete_party_session(self, session_code):
+        PartySession.delete_session_rows(session_code)
 
     @database_sync_to_async
     def user_is_session_host(self, user, session_code):
-        return UserJoinedPartySession.objects.filter(user=user, party_session__session_code=session_code)[
-            0].is_session_host
+        return UserJoinedPartySession.objects.filter(user=user, party_session__session_code=session_code,
+                                                     is_session_host=True).exists()
 
     @database_sync_to_async
     def get_playing_song(self, session_code):
-        playing_song = Song.objects.filter(party_session__session_code=session_code, is_playing=True)[0]
+        playing_song = Song.objects.filter(party_session__session_code=session_code, is_playing=True).select_related(
+            'track')[0]
         return playing_song
 
     @database_sync_to_async
     def get_first_song(self, session_code):
-        first_song = Song.objects.filter(party_session__session_code=session_code)[0]
+        first_song = Song.objects.filter(party_session__session_code=session_code).select_related('track')[0]
         return first_song
 
     @database_sync_to_async
     def get_votable_songs(self, session_code):
-        votable_songs = Song.objects.filter(party_session__session_code=session_code, is_votable=True)
+        votable_songs = Song.objects.filter(party_session__session_code=session_code, is_votable=True).select_related(
+            'track')
         # returns queryset as list for use with an asynchronous function
         return list(votable_songs)
 
-    @database_sync_to_async
-    def get_not_played_songs(self, session_code):
-        # if no songs are eligible, all songs are reset to not_played=False
-        if not Song.objects.filter(party_session__session_code=session_code, was_played=False, is_playing=False,
-                                   is_votable=False).exists():
-            all_songs = Song.objects.filter(party_session__session_code=session_code, is_playing=False)
-            for song in all_songs:
-                song.was_played = False
-                song.save()
-
-        not_played_songs = Song.objects.filter(party_session__session_code=session_code, was_played=False,
-                                               is_playing=False, is_votable=False)
-        # returns queryset as list for use with an asynchronous function
-        return list(not_played_songs)
-
-    @database_sync_to_async
-    def set_new_playing_song(self, new_playing_song, prev_playing_song):
-        new_playing_song.is_playing = True
-        prev_playing_song.is_playing = False
-        prev_playing_song.was_played = True
-        new_playing_song.save()
-        prev_playing_song.save()
-
-    @database_sync_to_async
-    def get_most_voted_song(self, votable_songs):
+    @database_write
+    def draw_votable_songs(self, session_code, exclude=()):
+        party_session = PartySession.objects.filter(session_code=session_code)[0]
+        return party_session.draw_votable_songs(VOTABLE_SONGS_PER_ROUND, exclude)
+
+    # switches the playing song and reopens the vote in one transaction
+    @database_write
+    def start_prepared_round(self, session_code, new_playing_song, prev_playing_song, playback_started):
+        with transaction.atomic():
+            Song.objects.filter(pk=prev_playing_song.pk).update(is_playing=False, was_played=True)
+            Song.objects.filter(pk=new_playing_song.pk).update(is_playing=True)
+            PartySession.objects.filter(session_code=session_code).update(playback_started=playback_started,
+                                                                          voting_allowed=True)
+
+    @database_write
+    def set_playback_started(self, session_code, playback_started):
+        PartySession.objects.filter(session_code=session_code).update(playback_started=playback_started)
+
+    @database_write
+    def get_most_voted_song(self, votable_songs, votes):
         # in case of drawn vote_count:
         # set first song as song with most votes
         most_voted_song = votable_songs[0]
         most_votes = 0
         for song in votable_songs:
             # if song has more votes than 0 or other songs set as most_voted_song
-            if song.song_votes > most_votes:
-                most_votes = song.song_votes
+            if votes.get(song.spotify_song_id, 0) > most_votes:
+                most_votes = votes[song.spotify_song_id]
                 most_voted_song = song
             # reset is_votable and vote_count for all songs
             song.is_votable = False
@@ -332,39 +874,15 @@ class SessionConsumer(AsyncWebsocketConsumer):
         user_playlist = UserPlaylist.objects.filter(is_selected=True, user=self.user)[0]
         return user_playlist
 
-    @database_sync_to_async
+    @database_write
     def record_playback_start(self, session_code):
         session = PartySession.objects.filter(session_code=session_code)[0]
-        session.playback_started = int(time.time())
+        session.playback_started = int(time.time() * 1000)
         session.save()
         return session.playback_started
 
     @database_sync_to_async
     def get_playback_device(self):
-        playback_device = PlaybackDevice.objects.filter(user=self.user, is_selected=True)[0]
+        # None if the host has not selected a device, spotify uses the active device of the host's account then
+        playback_device = PlaybackDevice.objects.filter(user=self.user, is_selected=True).first()
         return playback_device
-
-    @database_sync_to_async
-    def get_user_token(self):
-        user_tokens = ApiToken.objects.filter(user=self.user)
-        if user_tokens.exists():
-            user_token = user_tokens[0]
-            access_token = user_token.access_token
-
-            now = int(time.time())
-            is_expired = user_token.expires_at - now < 60
-            # check if token is expired
-            if is_expired:
-                sp_oauth = create_spotify_oauth()
-                # refresh token if expired
-                token_info = sp_oauth.refresh_access_token(user_token.refresh_token)
-                # save new token and delete expired one
-                api_token = ApiToken(access_token=token_info['access_token'], refresh_token=token_info['refresh_token'],
-                                     expires_at=int(token_info['expires_at']), user=self.user)
-                api_token.save()
-                user_token.delete()
-                # return refreshed token
-                user_token = ApiToken.objects.filter(user=self.user)[0]
-                access_token = user_token.access_token
-
-            return access_token
@@ -0,0 +1,65 @@
+import uuid
+from channels.auth import AuthMiddlewareStack
+from channels.middleware import BaseMiddleware
+from django.conf import settings
+from django.core import signing
+
+# signed cookie holding the identifier of a guest
+GUEST_COOKIE = 'spotifyparty_guest'
+GUEST_COOKIE_SALT = 'spotifyparty.guests'
+
+
+# guest without a spotify account, it has no user row and no login session:
+# it is only known by the identifier in its signed cookie and joins party-sessions without database writes
+class GuestUser:
+    is_authenticated = True
+    is_anonymous = False
+    is_guest = True
+
+    def __init__(self, identifier=None):
+        # prefixed, so the identifier never looks like the integer pk of a user account in the vote tally
+        self.identifier = identifier or 'guest-' + uuid.uuid4().hex[:12]
+
+    # the vote tally keys votes by pk
+    @property
+    def pk(self):
+        return self.identifier
+
+    def __str__(self):
+        return self.identifier
+
+
+# returns the guest of a signed cookie, None if there is none or its signature is invalid or expired
+def guest_from_cookies(cookies):
+    value = cookies.get(GUEST_COOKIE)
+    if value is None:
+        return None
+    try:
+        identifier = signing.get_cookie_signer(salt=GUEST_COOKIE + GUEST_COOKIE_SALT).unsign(
+            value, max_age=settings.GUEST_COOKIE_MAX_AGE)
+    except signing.BadSignature:
+        return None
+    return GuestUser(identifier)
+
+
+# signed with the key and salt guest_from_cookies checks, like HttpRequest.get_signed_cookie does
+def set_guest_cookie(response, guest):
+    response.set_signed_cookie(GUEST_COOKIE, guest.identifier, salt=GUEST_COOKIE_SALT,
+                               max_age=settings.GUEST_COOKIE_MAX_AGE, httponly=True, samesite='Lax')
+
+
+# puts the guest of the signed cookie into the scope of websockets without a logged in user
+class GuestMiddleware(BaseMiddleware):
+    async def __call__(self, scope, receive, send):
+        user = scope.get('user')
+        if settings.SIGNED_GUESTS and (user is None or not user.is_authenticated):
+            guest = guest_from_cookies(scope.get('cookies', {}))
+            if guest is not None:
+                scope = dict(scope, user=guest)
+        return await super().__call__(scope, receive, send)
+
+
+# replaces AuthMiddlewareStack: hosts are authenticated by their login session, guests by their signed cookie,
+# a guest without a session cookie costs no session lookup
+def GuestAuthMiddlewareStack(inner):
+    return AuthMiddlewareStack(GuestMiddleware(inner))
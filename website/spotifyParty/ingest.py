@@ -0,0 +1,72 @@
+import random
+import time
+from django.db import transaction
+from .models import Song, Track
+
+# maximum page size of spotify's playlist items endpoint
+PAGE_SIZE = 100
+# rows per INSERT statement
+BATCH_SIZE = 500
+# ids per catalog lookup, stays below sqlite's limit of query variables
+LOOKUP_SIZE = 500
+# only request the fields needed for Song rows
+PLAYLIST_ITEM_FIELDS = 'next,items(track(id,type,name,duration_ms,artists(name),album(images(url))))'
+
+
+# yields all items of a playlist, fetching it page by page
+def iter_playlist_items(sp, playlist_id, page_size=PAGE_SIZE):
+    page = sp.playlist_items(playlist_id, fields=PLAYLIST_ITEM_FIELDS, limit=page_size, offset=0,
+                             additional_types=('track',))
+    while page:
+        yield from page['items']
+        page = sp.next(page) if page['next'] else None
+
+
+# converts playlist items to unsaved Track objects
+# local files, podcast episodes and unavailable tracks are skipped
+def iter_playlist_tracks(items):
+    for item in items:
+        track = item.get('track')
+        if not track or not track.get('id') or track.get('type', 'track') != 'track':
+            continue
+        images = track['album']['images']
+        artists = ', '.join(artist['name'] for artist in track['artists'])
+        yield Track(spotify_song_id=track['id'], song_name=track['name'][:150], song_artist=artists[:100],
+                    song_cover_link=images[0]['url'] if images else '', song_length=int(track['duration_ms']))
+
+
+# returns the ids of all given tracks that are already in the catalog
+def get_known_track_ids(track_ids):
+    known_track_ids = set()
+    for start in range(0, len(track_ids), LOOKUP_SIZE):
+        known_track_ids.update(Track.objects.filter(spotify_song_id__in=track_ids[start:start + LOOKUP_SIZE])
+                               .values_list('spotify_song_id', flat=True))
+    return known_track_ids
+
+
+# saves all tracks of a playlist as songs of a party-session
+# tracks are upserted into the shared catalog, tracks it already knows are not inserted again
+# returns the number of saved songs and the ingest duration in seconds
+def ingest_playlist(sp, playlist_id, party_session, batch_size=BATCH_SIZE):
+    start = time.perf_counter()
+    # pages are normalized while they arrive, the transaction is only opened once all pages are fetched,
+    # so sqlite's write lock is not held during api round trips
+    tracks = {}
+    for track in iter_playlist_tracks(iter_playlist_items(sp, playlist_id)):
+        tracks.setdefault(track.spotify_song_id, track)
+    track_ids = list(tracks)
+    with transaction.atomic():
+        known_track_ids = get_known_track_ids(track_ids)
+        new_tracks = [track for track_id, track in tracks.items() if track_id not in known_track_ids]
+        # ignore_conflicts: a concurrent ingest might have inserted the same tracks in the meantime
+        Track.objects.bulk_create(new_tracks, batch_size=batch_size, ignore_conflicts=True)
+        # the songs are dealt in a shuffled order right away, the deck does not need an initial shuffle
+        deck_positions = list(range(len(track_ids)))
+        random.shuffle(deck_positions)
+        songs = [Song(track_id=track_id, deck_position=deck_position, party_session=party_session)
+                 for track_id, deck_position in zip(track_ids, deck_positions)]
+        Song.objects.bulk_create(songs, batch_size=batch_size)
+    duration = time.perf_counter() - start
+    print('Ingested %d songs (%d new tracks) from playlist %s in %.2fs (%.0f songs/s)'
+          % (len(songs), len(new_tracks), playlist_id, duration, len(songs) / duration if duration else 0))
+    return len(songs), duration
@@ -0,0 +1,180 @@
+import asyncio
+import contextvars
+import functools
+import time
+from channels.db import database_sync_to_async as channels_database_sync_to_async
+from django.conf import settings
+from django.db import connection
+
+
+# raised at test time when a handler runs more queries than its declared budget
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+# queries and durations of one running handler call
+class Measurement:
+    def __init__(self, name, parent):
+        self.name = name
+        self.task = asyncio.current_task()
+        # measurement of the handler awaiting this call, it is charged with the queries of this call as well,
+        # tasks created by a handler inherit its context but are measured on their own
+        self.parent = parent if parent is not None and parent.task is self.task else None
+        self.queries = 0
+        self.db_time = 0
+        self.start = time.perf_counter()
+        self.total_time = 0
+
+    def chain(self):
+        measurement = self
+        while measurement is not None:
+            yield measurement
+            measurement = measurement.parent
+
+    def add_query(self):
+        for measurement in self.chain():
+            measurement.queries += 1
+
+    def add_db_time(self, duration):
+        for measurement in self.chain():
+            measurement.db_time += duration
+
+    def close(self):
+        self.total_time = time.perf_counter() - self.start
+
+    # time the handler spent on the event loop or awaiting anything but the database thread pool
+    @property
+    def loop_time(self):
+        return self.total_time - self.db_time
+
+
+# accumulated measurements of all calls of one handler
+class HandlerStats:
+    def __init__(self, name, max_queries=None):
+        self.name = name
+        self.max_queries = max_queries
+        self.calls = 0
+        self.queries = 0
+        self.most_queries = 0
+        self.db_time = 0
+        self.loop_time = 0
+        self.total_time = 0
+        self.longest_time = 0
+        self.over_budget = 0
+
+    def record(self, measurement):
+        self.calls += 1
+        self.queries += measurement.queries
+        self.most_queries = max(self.most_queries, measurement.queries)
+        self.db_time += measurement.db_time
+        self.loop_time += measurement.loop_time
+        self.total_time += measurement.total_time
+        self.longest_time = max(self.longest_time, measurement.total_time)
+        if self.max_queries is not None and measurement.queries > self.max_queries:
+            self.over_budget += 1
+
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "queries": self.queries,
+            "queries_per_call": self.queries / self.calls if self.calls else 0,
+            "most_queries": self.most_queries,
+            "max_queries": self.max_queries,
+            "over_budget": self.over_budget,
+            "db_time_ms": self.db_time * 1000,
+            "loop_time_ms": self.loop_time * 1000,
+            "total_time_ms": self.total_time * 1000,
+            "longest_time_ms": self.longest_time * 1000
+        }
+
+
+# stats of all instrumented handlers keyed by handler name, e.g. 'SessionConsumer.receive'
+handler_stats = {}
+# measurement of the handler call the current task is running in
+current_measurement = contextvars.ContextVar('current_measurement', default=None)
+
+
+# returns the stats of all handlers as dictionaries
+def get_handler_stats():
+    return {name: stats.as_dict() for name, stats in handler_stats.items()}
+
+
+def reset_handler_stats():
+    for name, stats in list(handler_stats.items()):
+        handler_stats[name] = HandlerStats(name, stats.max_queries)
+
+
+# decorator for consumer entry points and tasks:
+# records queries, database thread pool time, event loop time and end to end duration of every call
+# max_queries declares the query budget of a single call, exceeding it fails the call if QUERY_BUDGETS_ENFORCED is set
+def instrument(max_queries=None):
+    def decorator(handler):
+        name = handler.__qualname__
+        handler_stats[name] = HandlerStats(name, max_queries)
+
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            measurement = Measurement(name, current_measurement.get())
+            token = current_measurement.set(measurement)
+            try:
+                return await handler(*args, **kwargs)
+            finally:
+                current_measurement.reset(token)
+                measurement.close()
+                handler_stats[name].record(measurement)
+                check_query_budget(measurement, max_queries)
+
+        return wrapper
+
+    return decorator
+
+
+def check_query_budget(measurement, max_queries):
+    if max_queries is None or measurement.queries <= max_queries:
+        return
+    message = '%s ran %d queries, its budget is %d' % (measurement.name, measurement.queries, max_queries)
+    if settings.QUERY_BUDGETS_ENFORCED:
+        raise QueryBudgetExceeded(message)
+    print('Query budget exceeded: ' + message)
+
+
+# wraps a synchronous database function, its queries are charged to the handler of the context it runs in
+def count_queries(func):
+    @functools.wraps(func)
+    def run_counted(*args, **kwargs):
+        measurement = current_measurement.get()
+        if measurement is None:
+            return func(*args, **kwargs)
+
+        def count_query(execute, sql, params, many, context):
+            measurement.add_query()
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count_query):
+            return func(*args, **kwargs)
+
+    return run_counted
+
+
+# awaits a database call running on another thread and charges the time waited for it to the running handler
+async def await_database(awaitable):
+    measurement = current_measurement.get()
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        if measurement is not None:
+            measurement.add_db_time(time.perf_counter() - start)
+
+
+# drop-in replacement for channels' database_sync_to_async,
+# charges the queries and the time spent in the database thread pool to the running handler
+def database_sync_to_async(func):
+    # the context of the awaiting task is copied into the database thread
+    run_in_thread = channels_database_sync_to_async(count_queries(func))
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await await_database(run_in_thread(*args, **kwargs))
+
+    return wrapper
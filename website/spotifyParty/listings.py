@@ -0,0 +1,64 @@
+import time
+from django.conf import settings
+
+
+# remembers when a listing of a user was last fetched from spotify
+# paged listings also keep the etag and the filtered rows of every page, keyed by offset
+class ListingCacheEntry:
+    def __init__(self, pages):
+        self.fetched_at = time.monotonic()
+        self.pages = pages
+
+
+# process-local cache for the playlist and device listings shown in the settings view
+class ListingCache:
+    def __init__(self):
+        self.entries = {}
+
+    # returns the ttl in seconds of a listing kind, e.g. 'playlists' -> settings.PLAYLISTS_CACHE_TTL
+    def ttl(self, kind):
+        return getattr(settings, '%s_CACHE_TTL' % kind.upper())
+
+    # True if the listing was fetched within its ttl and does not need to be requested again
+    def is_fresh(self, user_id, kind):
+        entry = self.entries.get((user_id, kind))
+        return entry is not None and time.monotonic() - entry.fetched_at < self.ttl(kind)
+
+    # returns {offset: (etag, rows)} of the last fetch of a paged listing
+    def get_pages(self, user_id, kind):
+        entry = self.entries.get((user_id, kind))
+        return entry.pages if entry is not None else {}
+
+    def mark_fetched(self, user_id, kind, pages=None):
+        self.entries[(user_id, kind)] = ListingCacheEntry(pages or {})
+
+    # forces the next request to fetch the listing again
+    def invalidate(self, user_id, kind):
+        self.entries.pop((user_id, kind), None)
+
+
+listing_cache = ListingCache()
+
+
+# applies a fetched listing to the user's rows: only removed, changed and new entries are written
+# new_rows maps the spotify id to the field values of a row
+def apply_listing(queryset, model, id_field, new_rows, **extra_fields):
+    existing_rows = {getattr(row, id_field): row for row in queryset}
+    removed_ids = [row.pk for spotify_id, row in existing_rows.items() if spotify_id not in new_rows]
+    if removed_ids:
+        queryset.filter(pk__in=removed_ids).delete()
+
+    changed_rows = []
+    created_rows = []
+    for spotify_id, fields in new_rows.items():
+        row = existing_rows.get(spotify_id)
+        if row is None:
+            created_rows.append(model(**{id_field: spotify_id}, **fields, **extra_fields))
+        elif any(getattr(row, name) != value for name, value in fields.items()):
+            for name, value in fields.items():
+                setattr(row, name, value)
+            changed_rows.append(row)
+    if changed_rows:
+        model.objects.bulk_update(changed_rows, sorted({name for fields in new_rows.values() for name in fields}))
+    if created_rows:
+        model.objects.bulk_create(created_rows)
@@ -0,0 +1,22 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from spotifyParty import benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Runs a SpotifyParty benchmark and prints its results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmark', choices=sorted(benchmarks.BENCHMARKS))
+        parser.add_argument('--param', action='append', default=[], metavar='NAME=VALUE',
+                            help='benchmark parameter, e.g. --param room_sizes=10,100,1000')
+
+    def handle(self, *args, **options):
+        params = {}
+        for param in options['param']:
+            if '=' not in param:
+                raise CommandError('Parameters have to be passed as NAME=VALUE')
+            name, value = param.split('=', 1)
+            params[name] = benchmarks.parse_param(value)
+        results = benchmarks.BENCHMARKS[options['benchmark']](**params)
+        self.stdout.write(json.dumps(results, indent=2))
@@ -0,0 +1,206 @@
+import bisect
+import threading
+from .scheduler import room_scheduler
+
+# content type of the prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# all metrics of this process in the order they are rendered
+registry = []
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labelnames, label_values, extra=()):
+    pairs = list(zip(labelnames, label_values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape_label_value(value)) for name, value in pairs)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+# process-local metric with optional labels, values are kept per combination of label values
+# updates only take a lock and a dictionary lookup, so they can stay enabled on the vote path
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def label_values(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, format_labels(self.labelnames, label_values), value)
+                    for label_values, value in sorted(self.values.items())]
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.type)]
+        for name, labels, value in self.samples():
+            lines.append('%s%s %s' % (name, labels, format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        label_values = self.label_values(labels)
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        # computes the value of an unlabeled gauge when it is scraped
+        self.function = function
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.label_values(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        label_values = self.label_values(labels)
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    # values dropping to zero are removed, so labels of closed party-sessions do not pile up
+    def dec(self, amount=1, **labels):
+        label_values = self.label_values(labels)
+        with self.lock:
+            value = self.values.get(label_values, 0) - amount
+            if value > 0:
+                self.values[label_values] = value
+            else:
+                self.values.pop(label_values, None)
+
+    def samples(self):
+        if self.function is not None:
+            return [(self.name, '', self.function())]
+        return super().samples()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    # values are kept as [counts per bucket including the +Inf bucket, sum of all observations]
+    def observe(self, value, **labels):
+        label_values = self.label_values(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for label_values, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for upper_bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    samples.append((self.name + '_bucket',
+                                    format_labels(self.labelnames, label_values,
+                                                  [('le', format_value(float(upper_bound)))]),
+                                    cumulative))
+                labels = format_labels(self.labelnames, label_values)
+                samples.append((self.name + '_sum', labels, total))
+                samples.append((self.name + '_count', labels, cumulative))
+        return samples
+
+
+# returns all metrics in the prometheus text exposition format
+def render_metrics():
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+
+# open websockets per party-session of this process, only their totals are exported:
+# a session code is all it takes to join a party-session, so it must not appear in a label
+room_sockets = {}
+room_sockets_lock = threading.Lock()
+
+
+def socket_opened(session_code):
+    with room_sockets_lock:
+        room_sockets[session_code] = room_sockets.get(session_code, 0) + 1
+
+
+# party-sessions without open websockets are removed, so closed party-sessions do not pile up
+def socket_closed(session_code):
+    with room_sockets_lock:
+        sockets = room_sockets.get(session_code, 0) - 1
+        if sockets > 0:
+            room_sockets[session_code] = sockets
+        else:
+            room_sockets.pop(session_code, None)
+
+
+# scraped from the thread of the metrics view while the event loop opens and closes websockets
+def count_room_sockets(count):
+    with room_sockets_lock:
+        return count(room_sockets)
+
+
+# metrics of the party-sessions handled by this process
+connected_sockets = Gauge('spotifyparty_connected_sockets', 'Open websocket connections.',
+                          function=lambda: count_room_sockets(lambda rooms: sum(rooms.values())))
+active_rooms = Gauge('spotifyparty_active_rooms', 'Party-sessions with at least one open websocket connection.',
+                     function=lambda: count_room_sockets(len))
+received_votes = Counter('spotifyparty_votes_total', 'Votes received, rejected votes name no votable song.',
+                         ['result'])
+vote_broadcast_latency = Histogram('spotifyparty_vote_broadcast_latency_seconds',
+                                   'Time from applying a vote until the votes delta containing it was sent.')
+group_send_duration = Histogram('spotifyparty_group_send_duration_seconds',
+                                'Duration of group_send calls to the members of a party-session.', ['message'])
+round_transition_duration = Histogram('spotifyparty_round_transition_duration_seconds',
+                                      'Time from the end of a song until the next round was sent.')
+playback_drift = Histogram('spotifyparty_playback_drift_seconds',
+                           'Difference between the round deadline and the end of the song reported by spotify, '
+                           'observed on every playback poll.')
+track_gap = Histogram('spotifyparty_track_gap_seconds',
+                      'Time from the end of a song until the next song was started or queued on spotify, '
+                      'zero if it was queued before the end.', ['handoff'])
+room_snapshot_builds = Counter('spotifyparty_room_snapshot_builds_total',
+                               'Snapshots built for late joining and resyncing users, one per room state and '
+                               'vote sequence number requested.')
+spotify_api_latency = Histogram('spotifyparty_spotify_api_request_duration_seconds',
+                                'Duration of spotify web api requests, every retry is a request.', ['method'])
+spotify_api_errors = Counter('spotifyparty_spotify_api_errors_total',
+                             'Failed spotify web api requests by status code, including retried ones.', ['status'])
+token_refreshes = Counter('spotifyparty_token_refreshes_total', 'Access token refreshes by result.', ['result'])
+# round scheduler of this process, see scheduler.py
+scheduler_pending_deadlines = Gauge('spotifyparty_scheduler_pending_deadlines',
+                                    'Room deadlines waiting in the round scheduler.',
+                                    function=lambda: room_scheduler.stats()['pending_deadlines'])
+scheduler_running_callbacks = Gauge('spotifyparty_scheduler_running_callbacks',
+                                    'Deadline callbacks of the round scheduler that have not finished yet.',
+                                    function=lambda: room_scheduler.stats()['running_callbacks'])
+scheduler_heap_size = Gauge('spotifyparty_scheduler_heap_size',
+                            'Entries of the deadline heap, cancelled entries count until they are dropped.',
+                            function=lambda: room_scheduler.stats()['heap_size'])
@@ -0,0 +1,110 @@
+# Generated by Django 3.1.4 on 2026-10-18 07:26
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='User',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_login', models.DateTimeField(blank=True, null=True, verbose_name='last login')),
+                ('password', models.CharField(max_length=128, null=True)),
+                ('identifier', models.CharField(max_length=10, unique=True)),
+                ('is_active', models.BooleanField(default=True)),
+                ('is_admin', models.BooleanField(default=False)),
+                ('is_staff', models.BooleanField(default=False)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='PartySession',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('session_code', models.CharField(max_length=6)),
+                ('is_initialized', models.BooleanField(default=False)),
+                ('voting_allowed', models.BooleanField(default=False)),
+                ('playback_started', models.IntegerField(default=None, null=True)),
+                ('deck_cursor', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Song',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('is_playing', models.BooleanField(default=False)),
+                ('was_played', models.BooleanField(default=False)),
+                ('is_votable', models.BooleanField(default=False)),
+                ('song_votes', models.IntegerField(default=0)),
+                ('deck_position', models.IntegerField(default=None, null=True)),
+                ('party_session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='spotifyParty.partysession')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Track',
+            fields=[
+                ('spotify_song_id', models.CharField(max_length=250, primary_key=True, serialize=False)),
+                ('song_name', models.CharField(max_length=150)),
+                ('song_artist', models.CharField(max_length=100)),
+                ('song_cover_link', models.URLField()),
+                ('song_length', models.IntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserPlaylist',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('spotify_playlist_id', models.CharField(max_length=250)),
+                ('playlist_name', models.CharField(max_length=100)),
+                ('playlist_cover_link', models.URLField()),
+                ('is_selected', models.BooleanField(default=False)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserJoinedPartySession',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('is_session_host', models.BooleanField(default=False)),
+                ('party_session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='spotifyParty.partysession')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+                ('user_vote', models.ForeignKey(default=None, null=True, on_delete=django.db.models.deletion.CASCADE, to='spotifyParty.song')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='song',
+            name='track',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='spotifyParty.track'),
+        ),
+        migrations.CreateModel(
+            name='PlaybackDevice',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('spotify_device_id', models.CharField(max_length=250)),
+                ('device_name', models.CharField(max_length=150)),
+                ('is_selected', models.BooleanField(default=False)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ApiToken',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('access_token', models.CharField(max_length=250)),
+                ('refresh_token', models.CharField(max_length=250)),
+                ('expires_at', models.IntegerField()),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.1.4 on 2026-10-18 07:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotifyParty', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='partysession',
+            name='session_code',
+            field=models.CharField(max_length=6, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='song',
+            index=models.Index(fields=['party_session', 'is_playing'], name='song_session_playing_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='song',
+            index=models.Index(fields=['party_session', 'is_votable'], name='song_session_votable_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='song',
+            index=models.Index(fields=['party_session', 'deck_position'], name='song_session_deck_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='userjoinedpartysession',
+            constraint=models.UniqueConstraint(fields=('user', 'party_session'), name='unique_user_partySession'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.1.4 on 2026-10-18 09:10
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def seconds_to_milliseconds(apps, schema_editor):
+    PartySession = apps.get_model('spotifyParty', 'PartySession')
+    PartySession.objects.filter(playback_started__isnull=False).update(playback_started=F('playback_started') * 1000)
+
+
+def milliseconds_to_seconds(apps, schema_editor):
+    PartySession = apps.get_model('spotifyParty', 'PartySession')
+    PartySession.objects.filter(playback_started__isnull=False).update(playback_started=F('playback_started') / 1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotifyParty', '0002_hot_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='partysession',
+            name='playback_started',
+            field=models.BigIntegerField(default=None, null=True),
+        ),
+        migrations.RunPython(seconds_to_milliseconds, milliseconds_to_seconds),
+    ]
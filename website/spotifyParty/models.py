@@ -1,17 +1,74 @@
-from django.db import models
+from django.db import connection, models, transaction
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager
 from django.conf import settings
 from django.db.models import UniqueConstraint
 from django.db.models.signals import pre_delete
 from django.dispatch import receiver
+import random
 import uuid
 
 
 class PartySession(models.Model):
-    session_code = models.CharField(max_length=6)
+    session_code = models.CharField(max_length=6, unique=True)
     is_initialized = models.BooleanField(default=False)
     voting_allowed = models.BooleanField(default=False)
-    playback_started = models.IntegerField(null=True, default=None)
+    # unix time in milliseconds at which the playing song started
+    playback_started = models.BigIntegerField(null=True, default=None)
+    # next deck position to hand out, songs are drawn in the order of their shuffled deck_position
+    deck_cursor = models.IntegerField(default=0)
+
+    # hands out up to count songs of the shuffled deck as votable songs in O(count),
+    # no song is repeated until the whole deck has been drawn
+    # songs in exclude are never drawn, e.g. the winner of the last round that does not play yet
+    def draw_votable_songs(self, count, exclude=()):
+        drawn_songs = []
+        excluded_pks = [song.pk for song in exclude]
+        reshuffled = False
+        while len(drawn_songs) < count:
+            candidates = list(Song.objects.filter(party_session=self, deck_position__gte=self.deck_cursor,
+                                                  is_playing=False, is_votable=False)
+                              .exclude(pk__in=excluded_pks + [song.pk for song in drawn_songs])
+                              .select_related('track').order_by('deck_position')[:count - len(drawn_songs)])
+            drawn_songs.extend(candidates)
+            if candidates:
+                self.deck_cursor = candidates[-1].deck_position + 1
+            if len(drawn_songs) < count:
+                # deck is exhausted: reshuffle it once, stop if the playlist has too few songs
+                if reshuffled:
+                    break
+                self.shuffle_deck()
+                reshuffled = True
+        self.save(update_fields=['deck_cursor'])
+        Song.objects.filter(pk__in=[song.pk for song in drawn_songs]).update(is_votable=True)
+        for song in drawn_songs:
+            song.is_votable = True
+        return drawn_songs
+
+    # assigns a new random deck position to every song of the session and resets was_played in bulk
+    def shuffle_deck(self):
+        songs = list(Song.objects.filter(party_session=self).only('pk'))
+        positions = list(range(len(songs)))
+        random.shuffle(positions)
+        for song, position in zip(songs, positions):
+            song.deck_position = position
+            song.was_played = False
+        Song.objects.bulk_update(songs, ['deck_position', 'was_played'], batch_size=500)
+        self.deck_cursor = 0
+
+    # deletes a party-session with its memberships and songs in three statements,
+    # a cascading delete would load every row and run the pre_delete signal of every membership,
+    # taking back votes of songs that are deleted anyway
+    # the statements bypass the ORM, so they handle the cascades by hand: memberships reference songs and the
+    # party-session and are deleted first, then the songs, then the party-session
+    @classmethod
+    def delete_session_rows(cls, session_code):
+        quote_name = connection.ops.quote_name
+        session_ids = 'SELECT id FROM %s WHERE session_code = %%s' % quote_name(cls._meta.db_table)
+        with transaction.atomic(), connection.cursor() as cursor:
+            for model in (UserJoinedPartySession, Song):
+                cursor.execute('DELETE FROM %s WHERE party_session_id IN (%s)'
+                               % (quote_name(model._meta.db_table), session_ids), [session_code])
+            cursor.execute('DELETE FROM %s WHERE session_code = %%s' % quote_name(cls._meta.db_table), [session_code])
 
 
 class UserPlaylist(models.Model):
@@ -22,18 +79,56 @@ class UserPlaylist(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
 
 
-class Song(models.Model):
-    spotify_song_id = models.CharField(max_length=250)
+# track metadata shared by all party-sessions, keyed by spotify id
+class Track(models.Model):
+    spotify_song_id = models.CharField(max_length=250, primary_key=True)
     song_name = models.CharField(max_length=150)
     song_artist = models.CharField(max_length=100)
     song_cover_link = models.URLField()
     song_length = models.IntegerField()
+
+
+# per-session queue entry of a track, only holds the session's flags and vote count
+class Song(models.Model):
+    track = models.ForeignKey(Track, on_delete=models.CASCADE)
     is_playing = models.BooleanField(default=False)
     was_played = models.BooleanField(default=False)
     is_votable = models.BooleanField(default=False)
     song_votes = models.IntegerField(default=0)
+    # position in the session's shuffled deck, None until the deck is shuffled
+    deck_position = models.IntegerField(null=True, default=None)
     party_session = models.ForeignKey(PartySession, on_delete=models.CASCADE)
 
+    class Meta:
+        indexes = [
+            # playing song and votable songs of a session
+            models.Index(fields=['party_session', 'is_playing'], name='song_session_playing_idx'),
+            models.Index(fields=['party_session', 'is_votable'], name='song_session_votable_idx'),
+            # next songs of the shuffled deck
+            models.Index(fields=['party_session', 'deck_position'], name='song_session_deck_idx'),
+        ]
+
+    # track metadata is read from the catalog, use select_related('track') when reading several songs
+    @property
+    def spotify_song_id(self):
+        return self.track_id
+
+    @property
+    def song_name(self):
+        return self.track.song_name
+
+    @property
+    def song_artist(self):
+        return self.track.song_artist
+
+    @property
+    def song_cover_link(self):
+        return self.track.song_cover_link
+
+    @property
+    def song_length(self):
+        return self.track.song_length
+
 
 class PlaybackDevice(models.Model):
     spotify_device_id = models.CharField(max_length=250)
@@ -54,38 +149,18 @@ class UserJoinedPartySession(models.Model):
     party_session = models.ForeignKey(PartySession, on_delete=models.CASCADE)
     user_vote = models.ForeignKey(Song, on_delete=models.CASCADE, null=True, default=None)
     is_session_host = models.BooleanField(default=False)
-    UniqueConstraint(fields=['user', 'party_session'], name='unique_user_partySession')
-
-    def change_vote(self, spotify_song_id):
-        song = Song.objects.filter(spotify_song_id=spotify_song_id, party_session=self.party_session, is_votable=True)
-        if song.exists():
-            voted_song = song[0]
-            # remove one vote from old song if exists
-            if self.user_vote is not None:
-                old_song = self.user_vote
-                old_song.song_votes = old_song.song_votes - 1
-                old_song.save()
-            # add one vote to new song and save as voted song if exists
-            if not self.user_vote == voted_song:
-                voted_song.song_votes = voted_song.song_votes + 1
-                voted_song.save()
-                self.user_vote = voted_song
-                self.save()
-            # remove user vote if already voted-for song has been clicked again
-            else:
-                self.user_vote = None
-                self.save()
-            return True
-        return False
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=['user', 'party_session'], name='unique_user_partySession')
+        ]
 
 
 @receiver(pre_delete, sender=UserJoinedPartySession)
 def remove_vote_on_user_leave_party_session(instance, **kwargs):
-    if instance.user_vote:
-        song = Song.objects.filter(spotify_song_id=instance.user_vote.spotify_song_id,
-                                   party_session=instance.party_session)[0]
-        song.song_votes = song.song_votes - 1
-        song.save()
+    # the voted song belongs to the party-session of the membership, its vote count is decremented in place
+    if instance.user_vote_id is not None:
+        Song.objects.filter(pk=instance.user_vote_id).update(song_votes=models.F('song_votes') - 1)
 
 
 class UserManager(BaseUserManager):
@@ -120,6 +195,9 @@ class User(AbstractBaseUser):
 
     objects = UserManager()
 
+    # guests identified by a signed cookie are GuestUsers, see guests.py
+    is_guest = False
+
     def __str__(self):
         return self.identifier
 
@@ -0,0 +1,103 @@
+import asyncio
+from .instrumentation import database_sync_to_async
+from .models import PartySession, Song, Track
+from .room_store import room_store
+
+
+# snapshot of a party-session's state as needed by the consumers, cached in the room store
+class RoomState:
+    def __init__(self, party_session, playing_song, votable_songs):
+        self.session_id = party_session.pk
+        self.is_initialized = party_session.is_initialized
+        self.voting_allowed = party_session.voting_allowed
+        self.playback_started = party_session.playback_started
+        self.playing_song = playing_song
+        self.votable_songs = votable_songs
+
+    # a shared room store keeps room states as json, explicit fields instead of pickled model instances
+    def as_dict(self):
+        return {
+            "session_id": self.session_id,
+            "is_initialized": self.is_initialized,
+            "voting_allowed": self.voting_allowed,
+            "playback_started": self.playback_started,
+            "playing_song": song_as_dict(self.playing_song) if self.playing_song is not None else None,
+            "votable_songs": [song_as_dict(song) for song in self.votable_songs]
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        party_session = PartySession(pk=data['session_id'], is_initialized=data['is_initialized'],
+                                     voting_allowed=data['voting_allowed'], playback_started=data['playback_started'])
+        playing_song = song_from_dict(data['playing_song']) if data['playing_song'] is not None else None
+        return cls(party_session, playing_song, [song_from_dict(song) for song in data['votable_songs']])
+
+
+# fields of the songs in a room state, the consumers read their track metadata as well
+SONG_FIELDS = ('id', 'track_id', 'is_playing', 'was_played', 'is_votable', 'song_votes', 'deck_position',
+               'party_session_id')
+TRACK_FIELDS = ('spotify_song_id', 'song_name', 'song_artist', 'song_cover_link', 'song_length')
+
+
+def song_as_dict(song):
+    data = {field: getattr(song, field) for field in SONG_FIELDS}
+    data['track'] = {field: getattr(song.track, field) for field in TRACK_FIELDS}
+    return data
+
+
+# the song is not read from the database, it only carries the fields of the room state
+def song_from_dict(data):
+    fields = dict(data)
+    track = Track(**fields.pop('track'))
+    song = Song(**fields)
+    song.track = track
+    return song
+
+
+# running loads of room states as (version, task), keyed by session code
+room_state_loads = {}
+
+
+# returns the cached state of a party-session, loads it from the database on a cache miss
+# returns None if the party-session does not exist
+# concurrent cache misses of the same version share one load, e.g. when hundreds of guests join at once
+async def get_room_state(session_code):
+    room_state = await room_store.get_room_state(session_code)
+    if room_state is None:
+        # loads started before an invalidation are not cached
+        version = await room_store.get_room_state_version(session_code)
+        load_version, load = room_state_loads.get(session_code, (None, None))
+        if load is None or load_version != version:
+            load = asyncio.ensure_future(load_and_cache_room_state(session_code, version))
+            room_state_loads[session_code] = (version, load)
+        room_state = await asyncio.shield(load)
+    return room_state
+
+
+async def load_and_cache_room_state(session_code, version):
+    try:
+        room_state = await load_room_state(session_code)
+        if room_state is not None:
+            await room_store.set_room_state(session_code, room_state, version)
+        return room_state
+    finally:
+        if room_state_loads.get(session_code, (None, None))[0] == version:
+            del room_state_loads[session_code]
+
+
+# has to be called whenever is_initialized, voting_allowed, playback_started,
+# the playing song or the votable songs of a party-session change or the session is deleted
+# with a shared room store the room state is invalidated for all worker processes
+async def invalidate_room_state(session_code):
+    await room_store.invalidate_room_state(session_code)
+
+
+@database_sync_to_async
+def load_room_state(session_code):
+    party_session = PartySession.objects.filter(session_code=session_code).first()
+    if party_session is None:
+        return None
+    songs = Song.objects.filter(party_session=party_session).select_related('track')
+    playing_song = songs.filter(is_playing=True).first()
+    votable_songs = list(songs.filter(is_votable=True))
+    return RoomState(party_session, playing_song, votable_songs)
@@ -0,0 +1,385 @@
+import asyncio
+import hashlib
+import json
+from django.conf import settings
+from .tally import VoteTally
+
+# seconds after which the redis keys of an abandoned party-session expire, refreshed on every round
+ROOM_KEY_TTL = 24 * 60 * 60
+
+
+# state of all party-sessions shared by the consumers:
+# vote tallies, the cached room states and the claims on ending a round
+# MemoryRoomStore keeps it in this process, RedisRoomStore shares it between all worker processes
+# all methods are coroutines, so both stores can be used interchangeably
+class MemoryRoomStore:
+    def __init__(self):
+        self.tallies = {}
+        self.room_states = {}
+        # incremented on every invalidation of a room state, prevents loads started before an invalidation
+        # from being cached, keyed by session code and kept after a party-session is discarded
+        self.room_state_versions = {}
+        self.round_ends = set()
+
+    # vote tallies
+    async def has_tally(self, session_code):
+        return session_code in self.tallies
+
+    # creates the tally of a party-session from the votes stored in the database, unless it already exists
+    async def init_tally(self, session_code, song_ids, user_votes):
+        if session_code not in self.tallies:
+            tally = VoteTally(song_ids, user_votes)
+            tally.dirty = False
+            self.tallies[session_code] = tally
+
+    async def reset_tally(self, session_code, song_ids):
+        tally = self.tallies.get(session_code)
+        if tally is None:
+            tally = self.tallies[session_code] = VoteTally()
+        tally.reset(song_ids)
+
+    async def vote(self, session_code, user_id, song_id):
+        tally = self.tallies.get(session_code)
+        return tally is not None and tally.vote(user_id, song_id)
+
+    async def remove_user(self, session_code, user_id):
+        tally = self.tallies.get(session_code)
+        return tally is not None and tally.remove_user(user_id)
+
+    # returns (seq, {song_id: votes}) of all songs changed since the last delta or None
+    async def pop_delta(self, session_code):
+        tally = self.tallies.get(session_code)
+        return tally.pop_delta() if tally is not None else None
+
+    # returns (seq, {song_id: votes}) of all votable songs
+    async def get_votes(self, session_code):
+        tally = self.tallies.get(session_code)
+        if tally is None:
+            return 0, {}
+        return tally.seq, dict(tally.votes)
+
+    # returns (votes, user_votes) and clears the dirty flag if votes changed since the last snapshot, otherwise None
+    async def take_snapshot(self, session_code):
+        tally = self.tallies.get(session_code)
+        if tally is None or not tally.dirty:
+            return None
+        return tally.snapshot()
+
+    async def discard_tally(self, session_code):
+        self.tallies.pop(session_code, None)
+
+    # room states
+    async def get_room_state(self, session_code):
+        return self.room_states.get(session_code)
+
+    async def get_room_state_version(self, session_code):
+        return self.room_state_versions.get(session_code, 0)
+
+    # caches a room state loaded from the database unless it was invalidated since version was read
+    async def set_room_state(self, session_code, room_state, version):
+        if self.room_state_versions.get(session_code, 0) == version:
+            self.room_states[session_code] = room_state
+
+    async def invalidate_room_state(self, session_code):
+        self.room_states.pop(session_code, None)
+        self.room_state_versions[session_code] = self.room_state_versions.get(session_code, 0) + 1
+
+    # rounds
+    # returns True for exactly one caller per round, the one that ends the round
+    async def claim_round_end(self, session_code, round_key):
+        if (session_code, round_key) in self.round_ends:
+            return False
+        self.round_ends.add((session_code, round_key))
+        return True
+
+    # lets a round whose end failed be claimed again
+    async def release_round_end(self, session_code, round_key):
+        self.round_ends.discard((session_code, round_key))
+
+    # removes everything stored for a closed party-session,
+    # the version of its room state is kept, so loads still running can not cache it again
+    async def discard_room(self, session_code):
+        self.tallies.pop(session_code, None)
+        self.room_states.pop(session_code, None)
+        self.round_ends = {(code, round_key) for code, round_key in self.round_ends if code != session_code}
+
+
+# lua script that is sent by its sha1 and only loaded into redis once
+class Script:
+    def __init__(self, source):
+        self.source = source
+        self.sha = hashlib.sha1(source.encode()).hexdigest()
+
+    async def __call__(self, redis, keys, args):
+        import aioredis
+        try:
+            return await redis.evalsha(self.sha, keys=keys, args=args)
+        except aioredis.ReplyError as error:
+            if not str(error).startswith('NOSCRIPT'):
+                raise
+            return await redis.eval(self.source, keys=keys, args=args)
+
+
+# KEYS: votes, user_votes, changed, tally
+# ARGV: ttl, number of songs, song ids..., user id and song id of every stored vote...
+INIT_TALLY = Script("""
+if redis.call('EXISTS', KEYS[4]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[4], 'seq', 0, 'dirty', 0)
+local song_count = tonumber(ARGV[2])
+for i = 3, song_count + 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], 0)
+end
+for i = song_count + 3, #ARGV, 2 do
+    if redis.call('HEXISTS', KEYS[1], ARGV[i + 1]) == 1 then
+        redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 1])
+        redis.call('HINCRBY', KEYS[1], ARGV[i + 1], 1)
+    end
+end
+for i = 1, 4 do
+    redis.call('EXPIRE', KEYS[i], ARGV[1])
+end
+return 1
+""")
+
+# KEYS: votes, user_votes, changed, tally
+# ARGV: ttl, song ids...
+RESET_TALLY = Script("""
+redis.call('DEL', KEYS[1], KEYS[2], KEYS[3])
+for i = 2, #ARGV do
+    redis.call('HSET', KEYS[1], ARGV[i], 0)
+end
+redis.call('HSETNX', KEYS[4], 'seq', 0)
+redis.call('HSET', KEYS[4], 'dirty', 1)
+for i = 1, 4 do
+    redis.call('EXPIRE', KEYS[i], ARGV[1])
+end
+return 1
+""")
+
+# same semantics as VoteTally.vote
+# user_votes and changed are deleted by every reset and pop of a delta, the vote creating them again sets their ttl
+# KEYS: votes, user_votes, changed, tally
+# ARGV: user id, song id, ttl
+VOTE = Script("""
+if redis.call('HEXISTS', KEYS[1], ARGV[2]) == 0 then
+    return 0
+end
+local old_song_id = redis.call('HGET', KEYS[2], ARGV[1])
+if old_song_id then
+    redis.call('HINCRBY', KEYS[1], old_song_id, -1)
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    redis.call('SADD', KEYS[3], old_song_id)
+end
+if old_song_id ~= ARGV[2] then
+    redis.call('HINCRBY', KEYS[1], ARGV[2], 1)
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+    redis.call('EXPIRE', KEYS[2], ARGV[3])
+end
+redis.call('SADD', KEYS[3], ARGV[2])
+redis.call('EXPIRE', KEYS[3], ARGV[3])
+redis.call('HSET', KEYS[4], 'dirty', 1)
+return 1
+""")
+
+# KEYS: votes, user_votes, changed, tally
+# ARGV: user id, ttl
+REMOVE_USER = Script("""
+local old_song_id = redis.call('HGET', KEYS[2], ARGV[1])
+if not old_song_id then
+    return 0
+end
+redis.call('HINCRBY', KEYS[1], old_song_id, -1)
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('SADD', KEYS[3], old_song_id)
+redis.call('EXPIRE', KEYS[3], ARGV[2])
+redis.call('HSET', KEYS[4], 'dirty', 1)
+return 1
+""")
+
+# returns {seq, song id, votes, song id, votes, ...} or nil if nothing changed
+# KEYS: votes, changed, tally
+POP_DELTA = Script("""
+local changed = redis.call('SMEMBERS', KEYS[2])
+if #changed == 0 then
+    return false
+end
+local seq = redis.call('HINCRBY', KEYS[3], 'seq', 1)
+redis.call('DEL', KEYS[2])
+local delta = {seq}
+for i, song_id in ipairs(changed) do
+    delta[#delta + 1] = song_id
+    delta[#delta + 1] = redis.call('HGET', KEYS[1], song_id)
+end
+return delta
+""")
+
+# returns {seq, {song id, votes, ...}}
+# KEYS: votes, tally
+GET_VOTES = Script("""
+return {redis.call('HGET', KEYS[2], 'seq') or 0, redis.call('HGETALL', KEYS[1])}
+""")
+
+# returns {{song id, votes, ...}, {user id, song id, ...}} and clears the dirty flag or nil if nothing changed
+# KEYS: votes, user_votes, tally
+TAKE_SNAPSHOT = Script("""
+if redis.call('HGET', KEYS[3], 'dirty') ~= '1' then
+    return false
+end
+redis.call('HSET', KEYS[3], 'dirty', 0)
+return {redis.call('HGETALL', KEYS[1]), redis.call('HGETALL', KEYS[2])}
+""")
+
+# KEYS: state, version
+# ARGV: room state as json, version read before loading it, ttl
+SET_ROOM_STATE = Script("""
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[2] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[3])
+return 1
+""")
+
+# KEYS: state, version
+# ARGV: ttl
+INVALIDATE_ROOM_STATE = Script("""
+redis.call('DEL', KEYS[1])
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+return 1
+""")
+
+
+def pairs_to_dict(flat, convert_key=str):
+    return {convert_key(flat[i]): flat[i + 1] for i in range(0, len(flat), 2)}
+
+
+# votes are keyed by the integer pk of user accounts or by the identifier of signed guests
+def user_id_from_key(user_id):
+    user_id = user_id.decode()
+    return int(user_id) if user_id.isdigit() else user_id
+
+
+# party-session state in redis, shared by all worker processes:
+# every change is a single lua script, so concurrent votes and round changes from different processes stay consistent
+# the keys of a party-session share the hash tag {session_code} and therefore a cluster slot
+class RedisRoomStore:
+    def __init__(self, url):
+        self.url = url
+        self.redis = None
+        self.loop = None
+        self.connect_lock = None
+
+    # connection pools can not be shared between event loops, a new loop gets a new pool (e.g. in tests)
+    async def connection(self):
+        loop = asyncio.get_event_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.redis = None
+            self.connect_lock = asyncio.Lock()
+        async with self.connect_lock:
+            if self.redis is None:
+                import aioredis
+                self.redis = await aioredis.create_redis_pool(self.url)
+        return self.redis
+
+    def key(self, session_code, name):
+        return 'spotifyparty:room:{%s}:%s' % (session_code, name)
+
+    def tally_keys(self, session_code):
+        return [self.key(session_code, name) for name in ('votes', 'user_votes', 'changed', 'tally')]
+
+    # vote tallies, user ids are stored as strings and converted back to ints
+    async def has_tally(self, session_code):
+        redis = await self.connection()
+        return bool(await redis.exists(self.key(session_code, 'tally')))
+
+    async def init_tally(self, session_code, song_ids, user_votes):
+        args = [ROOM_KEY_TTL, len(song_ids)] + list(song_ids)
+        for user_id, song_id in user_votes.items():
+            args += [user_id, song_id]
+        await INIT_TALLY(await self.connection(), self.tally_keys(session_code), args)
+
+    async def reset_tally(self, session_code, song_ids):
+        await RESET_TALLY(await self.connection(), self.tally_keys(session_code), [ROOM_KEY_TTL] + list(song_ids))
+
+    async def vote(self, session_code, user_id, song_id):
+        return bool(await VOTE(await self.connection(), self.tally_keys(session_code),
+                               [user_id, song_id, ROOM_KEY_TTL]))
+
+    async def remove_user(self, session_code, user_id):
+        return bool(await REMOVE_USER(await self.connection(), self.tally_keys(session_code),
+                                      [user_id, ROOM_KEY_TTL]))
+
+    async def pop_delta(self, session_code):
+        votes_key, user_votes_key, changed_key, tally_key = self.tally_keys(session_code)
+        delta = await POP_DELTA(await self.connection(), [votes_key, changed_key, tally_key], [])
+        if delta is None:
+            return None
+        votes = pairs_to_dict(delta[1:], lambda song_id: song_id.decode())
+        return int(delta[0]), {song_id: int(count) for song_id, count in votes.items()}
+
+    async def get_votes(self, session_code):
+        votes_key, user_votes_key, changed_key, tally_key = self.tally_keys(session_code)
+        seq, votes = await GET_VOTES(await self.connection(), [votes_key, tally_key], [])
+        votes = pairs_to_dict(votes, lambda song_id: song_id.decode())
+        return int(seq), {song_id: int(count) for song_id, count in votes.items()}
+
+    async def take_snapshot(self, session_code):
+        votes_key, user_votes_key, changed_key, tally_key = self.tally_keys(session_code)
+        snapshot = await TAKE_SNAPSHOT(await self.connection(), [votes_key, user_votes_key, tally_key], [])
+        if snapshot is None:
+            return None
+        votes = pairs_to_dict(snapshot[0], lambda song_id: song_id.decode())
+        user_votes = pairs_to_dict(snapshot[1], user_id_from_key)
+        return ({song_id: int(count) for song_id, count in votes.items()},
+                {user_id: song_id.decode() for user_id, song_id in user_votes.items()})
+
+    async def discard_tally(self, session_code):
+        redis = await self.connection()
+        await redis.delete(*self.tally_keys(session_code))
+
+    # room states are stored as json, see RoomState.as_dict
+    async def get_room_state(self, session_code):
+        from .room_state import RoomState
+        redis = await self.connection()
+        stored = await redis.get(self.key(session_code, 'state'))
+        return RoomState.from_dict(json.loads(stored)) if stored is not None else None
+
+    async def get_room_state_version(self, session_code):
+        redis = await self.connection()
+        return int(await redis.get(self.key(session_code, 'version')) or 0)
+
+    async def set_room_state(self, session_code, room_state, version):
+        await SET_ROOM_STATE(await self.connection(),
+                             [self.key(session_code, 'state'), self.key(session_code, 'version')],
+                             [json.dumps(room_state.as_dict()), version, ROOM_KEY_TTL])
+
+    async def invalidate_room_state(self, session_code):
+        await INVALIDATE_ROOM_STATE(await self.connection(),
+                                    [self.key(session_code, 'state'), self.key(session_code, 'version')],
+                                    [ROOM_KEY_TTL])
+
+    # rounds
+    async def claim_round_end(self, session_code, round_key):
+        redis = await self.connection()
+        return bool(await redis.set(self.key(session_code, 'round_end:%s' % round_key), 1,
+                                    expire=ROOM_KEY_TTL, exist=redis.SET_IF_NOT_EXIST))
+
+    async def release_round_end(self, session_code, round_key):
+        redis = await self.connection()
+        await redis.delete(self.key(session_code, 'round_end:%s' % round_key))
+
+    async def discard_room(self, session_code):
+        redis = await self.connection()
+        await redis.delete(*self.tally_keys(session_code), self.key(session_code, 'state'))
+
+
+def create_room_store(url):
+    if url:
+        return RedisRoomStore(url)
+    return MemoryRoomStore()
+
+
+room_store = create_room_store(settings.ROOM_STORE_URL)
@@ -0,0 +1,115 @@
+import asyncio
+import heapq
+import itertools
+
+
+# current time of the event loop's monotonic clock, the clock of all room deadlines
+def monotonic_time():
+    return asyncio.get_event_loop().time()
+
+
+# owns exactly one round deadline per party-session, independent of single consumer instances
+# all deadlines are kept in one heap that is served by a single timer on the event loop,
+# so thousands of rooms cost one TimerHandle instead of one sleeping task per round and connection
+class RoomScheduler:
+    # heap entry layout: [deadline, sequence number, session code, callback]
+    DEADLINE, SEQUENCE, SESSION_CODE, CALLBACK = range(4)
+
+    def __init__(self):
+        self.loop = None
+        self._reset()
+
+    # forgets all deadlines and running callbacks, the timer has to be cancelled before
+    def _reset(self):
+        self.heap = []
+        self.deadlines = {}
+        self.running = {}
+        self.counter = itertools.count()
+        self.timer = None
+        self.timer_deadline = None
+
+    # (re)schedules the deadline of a party-session, an existing deadline of the same session is replaced
+    # the deadline is a time of the event loop's monotonic clock, see monotonic_time, deadlines in the past are due
+    # immediately
+    def schedule_at(self, session_code, deadline, callback):
+        self.bind_loop(asyncio.get_event_loop())
+        self.cancel(session_code)
+        entry = [deadline, next(self.counter), session_code, callback]
+        self.deadlines[session_code] = entry
+        heapq.heappush(self.heap, entry)
+        self.arm_timer()
+
+    # removes the pending deadline of a party-session, cancelled entries are dropped from the heap lazily
+    def cancel(self, session_code):
+        entry = self.deadlines.pop(session_code, None)
+        if entry is not None:
+            entry[self.CALLBACK] = None
+            # rebuild the heap if it mostly consists of cancelled entries
+            if len(self.heap) > 2 * len(self.deadlines) + 64:
+                self.heap = [entry for entry in self.heap if entry[self.CALLBACK] is not None]
+                heapq.heapify(self.heap)
+
+    # cancels the deadline and a running deadline callback of a closed party-session
+    def close_room(self, session_code):
+        self.cancel(session_code)
+        task = self.running.pop(session_code, None)
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+        self.arm_timer()
+
+    # exported by the metrics, read from the thread of the metrics view
+    def stats(self):
+        return {
+            "pending_deadlines": len(self.deadlines),
+            "running_callbacks": len(self.running),
+            "heap_size": len(self.heap)
+        }
+
+    # the scheduler is bound to the event loop of the first schedule call (a new loop resets it, e.g. in tests)
+    def bind_loop(self, loop):
+        if self.loop is not loop:
+            if self.timer is not None:
+                self.timer.cancel()
+            self._reset()
+            self.loop = loop
+
+    # points the single timer at the earliest live deadline
+    def arm_timer(self):
+        while self.heap and self.heap[0][self.CALLBACK] is None:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            return
+        deadline = self.heap[0][self.DEADLINE]
+        if self.timer is not None:
+            if self.timer_deadline <= deadline:
+                return
+            self.timer.cancel()
+        self.timer = self.loop.call_at(deadline, self.run_due)
+        self.timer_deadline = deadline
+
+    # starts the callbacks of all deadlines that are due
+    def run_due(self):
+        self.timer = None
+        now = self.loop.time()
+        while self.heap and self.heap[0][self.DEADLINE] <= now:
+            entry = heapq.heappop(self.heap)
+            callback = entry[self.CALLBACK]
+            if callback is None:
+                continue
+            session_code = entry[self.SESSION_CODE]
+            del self.deadlines[session_code]
+            task = self.loop.create_task(callback())
+            self.running[session_code] = task
+            task.add_done_callback(lambda done_task, code=session_code: self.callback_done(code, done_task))
+        self.arm_timer()
+
+    def callback_done(self, session_code, task):
+        if self.running.get(session_code) is task:
+            del self.running[session_code]
+
+
+# scheduler shared by all consumers of this process
+room_scheduler = RoomScheduler()
@@ -0,0 +1,90 @@
+import asyncio
+import bisect
+import hashlib
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+# points of every worker on the hash ring, more points spread the rooms more evenly
+RING_REPLICAS = 100
+# seconds the inbox waits before it reads again after the channel layer failed
+INBOX_RETRY_DELAY = 1
+
+
+def ring_position(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+# consistent hashing of session codes onto worker ids:
+# adding or removing a worker only moves the rooms between its points and their predecessors,
+# about 1/N of all rooms, every other room keeps its owner
+class HashRing:
+    def __init__(self, workers, replicas=RING_REPLICAS):
+        self.workers = list(workers)
+        points = sorted((ring_position('%s#%d' % (worker, replica)), worker)
+                        for worker in self.workers for replica in range(replicas))
+        self.positions = [position for position, worker in points]
+        self.owners = [worker for position, worker in points]
+
+    def owner(self, session_code):
+        index = bisect.bisect(self.positions, ring_position(session_code)) % len(self.positions)
+        return self.owners[index]
+
+
+ring = HashRing(settings.ROOM_AFFINITY_WORKERS) if settings.ROOM_AFFINITY_WORKERS else None
+
+
+# returns True if this worker runs the scheduler and the tally of a party-session,
+# every worker owns every room while room affinity is disabled
+def is_room_owner(session_code):
+    return ring is None or ring.owner(session_code) == settings.ROOM_AFFINITY_WORKER_ID
+
+
+# channel layer channel on which a worker receives the messages forwarded to the rooms it owns
+def worker_inbox(worker_id):
+    return 'spotifyparty.worker.%s' % worker_id
+
+
+async def forward_to_owner(session_code, message):
+    await get_channel_layer().send(worker_inbox(ring.owner(session_code)), dict(message, room=session_code))
+
+
+# task reading this worker's inbox, started with the process, see start_inbox_at_startup
+inbox_task = None
+
+
+# message types are dispatched like in consumers: 'room.vote' is handled by handlers['room_vote']
+def start_inbox(handlers):
+    global inbox_task
+    if ring is None or (inbox_task is not None and not inbox_task.done()):
+        return
+    inbox_task = asyncio.create_task(read_inbox(handlers, settings.ROOM_AFFINITY_WORKER_ID))
+
+
+# called while the ASGI server loads the application, before its event loop accepts connections:
+# the owner of a party-session has to handle the messages forwarded to it even if none of the room's websockets
+# are connected to it, so the inbox cannot wait for a consumer of this worker
+def start_inbox_at_startup(handlers):
+    if ring is not None:
+        asyncio.get_event_loop().call_soon(start_inbox, handlers)
+
+
+async def read_inbox(handlers, worker_id):
+    channel_layer = get_channel_layer()
+    inbox = worker_inbox(worker_id)
+    while True:
+        # nothing restarts the inbox, it keeps reading while the channel layer is unreachable
+        try:
+            message = await channel_layer.receive(inbox)
+        except Exception as error:
+            print('Reading the worker inbox failed: %r' % error)
+            await asyncio.sleep(INBOX_RETRY_DELAY)
+            continue
+        handler = handlers.get(message['type'].replace('.', '_'))
+        if handler is None:
+            print('Unknown message in worker inbox: ' + message['type'])
+            continue
+        # one message must not stop the inbox of the whole worker
+        try:
+            await handler(message)
+        except Exception as error:
+            print('Handling %s for room %s failed: %r' % (message['type'], message.get('room'), error))
@@ -0,0 +1,144 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from spotipy import SpotifyException
+from . import metrics
+
+API_URL = 'https://api.spotify.com/v1/'
+# requests that can be sent again after a server error without applying them twice,
+# a POST like adding a song to the queue might have been applied before the error
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'))
+
+# keep-alive connections to the web api are pooled and reused by all requests of this process
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=32))
+
+# blocking http calls of AsyncSpotify run on these threads, never on the event loop
+api_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='spotify-api')
+
+
+# minimal spotify web api client using the pooled http session
+# method names and return values follow spotipy.Spotify, errors are raised as spotipy.SpotifyException
+class Spotify:
+    def __init__(self, auth, base_url=API_URL):
+        self.auth = auth
+        self.base_url = base_url
+
+    def request(self, method, endpoint, params=None, payload=None):
+        response = self.send(method, endpoint, params=params, payload=payload)
+        if not response.content:
+            return None
+        return response.json()
+
+    # conditional GET: returns (None, etag) if the resource still matches the given etag, otherwise (result, etag)
+    def get_if_modified(self, endpoint, params=None, etag=None):
+        headers = {'If-None-Match': etag} if etag else None
+        response = self.send('GET', endpoint, params=params, headers=headers)
+        if response.status_code == 304:
+            return None, etag
+        return response.json(), response.headers.get('ETag')
+
+    def send(self, method, endpoint, params=None, payload=None, headers=None):
+        url = endpoint if endpoint.startswith('http') else self.base_url + endpoint
+        headers = dict(headers or {}, Authorization='Bearer ' + str(self.auth))
+        max_retries = settings.SPOTIFY_API_MAX_RETRIES
+        for attempt in range(max_retries + 1):
+            start = time.perf_counter()
+            try:
+                response = http_session.request(method, url, headers=headers, params=params, json=payload,
+                                                timeout=settings.SPOTIFY_API_TIMEOUT)
+            except requests.RequestException:
+                metrics.spotify_api_errors.inc(status='connection')
+                raise
+            finally:
+                metrics.spotify_api_latency.observe(time.perf_counter() - start, method=method)
+            if response.status_code >= 400:
+                metrics.spotify_api_errors.inc(status=response.status_code)
+            if attempt == max_retries:
+                break
+            # rate limited: the request was not applied, wait as long as spotify asks for
+            if response.status_code == 429:
+                retry_after = float(response.headers.get('Retry-After', 1))
+                # a long wait would block an api thread and the round transition awaiting it, the caller falls back
+                if retry_after > settings.SPOTIFY_API_MAX_RETRY_AFTER:
+                    break
+                time.sleep(retry_after)
+            # temporary server error: exponential backoff
+            elif response.status_code >= 500 and method in IDEMPOTENT_METHODS:
+                time.sleep(settings.SPOTIFY_API_BACKOFF * 2 ** attempt)
+            else:
+                break
+        if response.status_code >= 400:
+            try:
+                message = response.json()['error']['message']
+            except (ValueError, KeyError, TypeError):
+                message = response.text
+            raise SpotifyException(response.status_code, -1, '%s:\n %s' % (response.url, message),
+                                   headers=response.headers)
+        return response
+
+    def current_user_playlists(self, limit=50, offset=0):
+        return self.request('GET', 'me/playlists', params={'limit': limit, 'offset': offset})
+
+    def playlist_items(self, playlist_id, fields=None, limit=100, offset=0, additional_types=('track', 'episode')):
+        return self.request('GET', 'playlists/%s/tracks' % playlist_id,
+                            params={'fields': fields, 'limit': limit, 'offset': offset,
+                                    'additional_types': ','.join(additional_types)})
+
+    # returns the next page of a paged result or None
+    def next(self, result):
+        if result.get('next'):
+            return self.request('GET', result['next'])
+        return None
+
+    def devices(self):
+        return self.request('GET', 'me/player/devices')
+
+    def start_playback(self, device_id=None, uris=None):
+        params = {'device_id': device_id} if device_id else None
+        payload = {'uris': uris} if uris else None
+        return self.request('PUT', 'me/player/play', params=params, payload=payload)
+
+    # returns None if nothing is playing
+    def current_playback(self):
+        return self.request('GET', 'me/player')
+
+    def add_to_queue(self, uri, device_id=None):
+        params = {'uri': uri, 'device_id': device_id} if device_id else {'uri': uri}
+        return self.request('POST', 'me/player/queue', params=params)
+
+
+# asyncio interface for the consumers: every call runs on the api thread pool,
+# so a slow or rate limited request never stalls the event loop and the other rooms on it
+class AsyncSpotify:
+    def __init__(self, auth, base_url=API_URL):
+        self.client = Spotify(auth, base_url)
+
+    async def call(self, method, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(api_executor, lambda: method(*args, **kwargs))
+
+    async def current_user_playlists(self, limit=50, offset=0):
+        return await self.call(self.client.current_user_playlists, limit=limit, offset=offset)
+
+    async def playlist_items(self, playlist_id, fields=None, limit=100, offset=0, additional_types=('track', 'episode')):
+        return await self.call(self.client.playlist_items, playlist_id, fields=fields, limit=limit, offset=offset,
+                               additional_types=additional_types)
+
+    async def next(self, result):
+        return await self.call(self.client.next, result)
+
+    async def devices(self):
+        return await self.call(self.client.devices)
+
+    async def start_playback(self, device_id=None, uris=None):
+        return await self.call(self.client.start_playback, device_id=device_id, uris=uris)
+
+    async def current_playback(self):
+        return await self.call(self.client.current_playback)
+
+    async def add_to_queue(self, uri, device_id=None):
+        return await self.call(self.client.add_to_queue, uri, device_id=device_id)
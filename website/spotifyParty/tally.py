@@ -0,0 +1,67 @@
+# authoritative vote count for the votable songs of one party-session round, kept by MemoryRoomStore
+# votes are applied in O(1), the database is only written by periodic snapshots (write-behind)
+class VoteTally:
+    def __init__(self, song_ids=(), user_votes=None):
+        self.votes = {}
+        self.user_votes = {}
+        self.dirty = False
+        # room sequence number of the last broadcast vote delta
+        self.seq = 0
+        # songs whose vote count changed since the last delta
+        self.changed = set()
+        self.reset(song_ids)
+        # restore votes already stored in the database
+        if user_votes:
+            for user_id, song_id in user_votes.items():
+                if song_id in self.votes:
+                    self.user_votes[user_id] = song_id
+                    self.votes[song_id] += 1
+
+    # starts a new round with a new set of votable songs
+    def reset(self, song_ids):
+        self.votes = dict.fromkeys(song_ids, 0)
+        self.user_votes = {}
+        self.dirty = True
+        # a new round is announced with a full snapshot, pending deltas are obsolete
+        self.changed = set()
+
+    # same semantics as the old UserJoinedPartySession.change_vote:
+    # voting for a new song moves the user's vote, voting for the same song again removes it
+    def vote(self, user_id, song_id):
+        if song_id not in self.votes:
+            return False
+        old_song_id = self.user_votes.pop(user_id, None)
+        if old_song_id is not None:
+            self.votes[old_song_id] -= 1
+            self.changed.add(old_song_id)
+        if old_song_id != song_id:
+            self.votes[song_id] += 1
+            self.user_votes[user_id] = song_id
+        self.changed.add(song_id)
+        self.dirty = True
+        return True
+
+    # removes the vote of a user leaving the party-session
+    def remove_user(self, user_id):
+        old_song_id = self.user_votes.pop(user_id, None)
+        if old_song_id is None:
+            return False
+        self.votes[old_song_id] -= 1
+        self.changed.add(old_song_id)
+        self.dirty = True
+        return True
+
+    # returns the next sequence number and the vote counts of all songs changed since the last delta
+    # or None if nothing changed
+    def pop_delta(self):
+        if not self.changed:
+            return None
+        self.seq += 1
+        delta = {song_id: self.votes[song_id] for song_id in self.changed}
+        self.changed = set()
+        return self.seq, delta
+
+    # returns copies of the current state for writing to the database and clears the dirty flag
+    def snapshot(self):
+        self.dirty = False
+        return dict(self.votes), dict(self.user_votes)
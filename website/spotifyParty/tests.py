@@ -1,3 +1,1506 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+import unittest
+import uuid
+import requests
+from concurrent.futures import Future
+from unittest import mock
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.models import Session
+from django.db import DatabaseError, IntegrityError, connection
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from spotipy import SpotifyException
+from spotipy.oauth2 import SpotifyOauthError
+from . import consumers, metrics, routing, sharding, spotify_client, tokens, views
+from .instrumentation import QueryBudgetExceeded, database_sync_to_async, handler_stats, instrument, \
+    reset_handler_stats
+from .write_queue import WriteQueue
+from .broadcast import VotesRefreshCoalescer
+from .ingest import ingest_playlist
+from .listings import ListingCache
+from .guests import GUEST_COOKIE, GuestMiddleware, GuestUser, guest_from_cookies, set_guest_cookie
+from .room_state import RoomState, load_room_state
+from .room_store import MemoryRoomStore, RedisRoomStore
+from .scheduler import RoomScheduler, monotonic_time, room_scheduler
+from .sharding import HashRing
+from .models import PartySession, Song, Track, User, UserJoinedPartySession, ApiToken, UserPlaylist, PlaybackDevice
 
-# Create your tests here.
+try:
+    import fakeredis
+    import fakeredis.aioredis
+except ImportError:
+    fakeredis = None
+
+
+# the in-memory test database is shared by the connections of all threads and cannot use WAL:
+# a read of a table written by an open transaction of another connection, e.g. of the writer of the write queue,
+# fails with 'database table is locked', the readers of the test database read past open transactions instead
+# connections are opened before a test enables the write queue, so this does not depend on the setting
+@receiver(connection_created)
+def read_uncommitted_test_database(sender, connection, **kwargs):
+    if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+        connection.connection.execute('PRAGMA read_uncommitted=1')
+
+
+# seeds many party-sessions and checks that every hot query is answered through an index
+class QueryPlanTests(TestCase):
+    SESSIONS = 200
+    SONGS_PER_SESSION = 30
+    USERS_PER_SESSION = 5
+
+    @classmethod
+    def setUpTestData(cls):
+        tracks = [Track(spotify_song_id='track%d' % index, song_name='Song %d' % index, song_artist='Artist',
+                        song_cover_link='https://i.scdn.co/image/%d' % index, song_length=215000)
+                  for index in range(cls.SONGS_PER_SESSION * 4)]
+        Track.objects.bulk_create(tracks)
+        # bulk_create does not set primary keys on sqlite, the rows are read back in creation order
+        User.objects.bulk_create([User(identifier='user%d' % index)
+                                  for index in range(cls.SESSIONS * cls.USERS_PER_SESSION)])
+        users = list(User.objects.order_by('pk'))
+        PartySession.objects.bulk_create([PartySession(session_code='s%05d' % index)
+                                          for index in range(cls.SESSIONS)])
+        sessions = list(PartySession.objects.order_by('pk'))
+        songs = []
+        joined_users = []
+        for session_index, party_session in enumerate(sessions):
+            for song_index in range(cls.SONGS_PER_SESSION):
+                songs.append(Song(track=tracks[(session_index + song_index) % len(tracks)], party_session=party_session,
+                                  is_playing=song_index == 0, is_votable=0 < song_index < 5,
+                                  deck_position=song_index))
+            session_users = users[session_index * cls.USERS_PER_SESSION:(session_index + 1) * cls.USERS_PER_SESSION]
+            for user_index, user in enumerate(session_users):
+                joined_users.append(UserJoinedPartySession(user=user, party_session=party_session,
+                                                           is_session_host=user_index == 0))
+        Song.objects.bulk_create(songs)
+        UserJoinedPartySession.objects.bulk_create(joined_users)
+        ApiToken.objects.bulk_create([ApiToken(access_token='a', refresh_token='r', expires_at=0, user=user)
+                                      for user in users])
+        UserPlaylist.objects.bulk_create([UserPlaylist(spotify_playlist_id='p', playlist_name='p',
+                                                       playlist_cover_link='https://i.scdn.co/image/p', user=user)
+                                          for user in users])
+        PlaybackDevice.objects.bulk_create([PlaybackDevice(spotify_device_id='d', device_name='d', user=user)
+                                            for user in users])
+        # collect table statistics like a long running database would have them
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def setUp(self):
+        self.party_session = PartySession.objects.get(session_code='s00100')
+        self.user = User.objects.get(identifier='user500')
+
+    def get_query_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    # full table scans show up as 'SCAN <table>' in sqlite's query plans, index lookups as 'SEARCH'
+    def assertNoFullScan(self, queryset):
+        plan = self.get_query_plan(queryset)
+        scans = [step for step in plan if re.match(r'SCAN (?!CONSTANT ROW)', step)]
+        self.assertEqual(scans, [], 'full scan in query plan: %s' % plan)
+
+    def test_party_session_by_session_code(self):
+        self.assertNoFullScan(PartySession.objects.filter(session_code='s00100'))
+
+    def test_playing_song_by_session_code(self):
+        self.assertNoFullScan(Song.objects.filter(party_session__session_code='s00100', is_playing=True)
+                              .select_related('track'))
+
+    def test_votable_songs_by_session_code(self):
+        self.assertNoFullScan(Song.objects.filter(party_session__session_code='s00100', is_votable=True)
+                              .select_related('track'))
+
+    def test_room_state_songs(self):
+        songs = Song.objects.filter(party_session=self.party_session).select_related('track')
+        self.assertNoFullScan(songs.filter(is_playing=True))
+        self.assertNoFullScan(songs.filter(is_votable=True))
+
+    def test_shuffled_deck_candidates(self):
+        self.assertNoFullScan(Song.objects.filter(party_session=self.party_session, deck_position__gte=10,
+                                                  is_playing=False, is_votable=False)
+                              .select_related('track').order_by('deck_position')[:4])
+
+    def test_user_joined_party_session_by_user_and_session_code(self):
+        self.assertNoFullScan(UserJoinedPartySession.objects.filter(user=self.user,
+                                                                    party_session__session_code='s00100'))
+
+    def test_user_votes_of_session(self):
+        self.assertNoFullScan(UserJoinedPartySession.objects.filter(party_session__session_code='s00100',
+                                                                    user_vote__isnull=False)
+                              .values_list('user_id', 'user_vote__track_id'))
+
+    def test_session_host(self):
+        self.assertNoFullScan(UserJoinedPartySession.objects.filter(party_session=self.party_session,
+                                                                    is_session_host=True))
+
+    def test_known_tracks(self):
+        self.assertNoFullScan(Track.objects.filter(spotify_song_id__in=['track1', 'track2'])
+                              .values_list('spotify_song_id', flat=True))
+
+    def test_user_token_playlist_and_device(self):
+        self.assertNoFullScan(ApiToken.objects.filter(user=self.user))
+        self.assertNoFullScan(UserPlaylist.objects.filter(user=self.user, is_selected=True))
+        self.assertNoFullScan(PlaybackDevice.objects.filter(user=self.user, is_selected=True))
+
+    def test_session_code_is_unique(self):
+        self.assertTrue(PartySession._meta.get_field('session_code').unique)
+
+
+class DeckTests(TestCase):
+    SONGS = 6
+
+    def setUp(self):
+        self.party_session = PartySession.objects.create(session_code='deck')
+        for index in range(self.SONGS):
+            track = Track.objects.create(spotify_song_id='deck%d' % index, song_name='Song %d' % index,
+                                         song_artist='Artist', song_cover_link='https://i.scdn.co/image/%d' % index,
+                                         song_length=60000)
+            Song.objects.create(track=track, party_session=self.party_session, is_playing=index == 0)
+        self.party_session.shuffle_deck()
+        self.party_session.save()
+
+    # ends a round like the consumers do: the candidates are no longer votable, the winner does not play yet
+    def end_round(self, votable_songs):
+        Song.objects.filter(pk__in=[song.pk for song in votable_songs]).update(is_votable=False)
+        return votable_songs[0]
+
+    def test_winner_is_not_drawn_for_its_own_round(self):
+        winner = self.end_round(self.party_session.draw_votable_songs(4))
+        # the deck is exhausted, the next draw reshuffles it
+        next_songs = self.party_session.draw_votable_songs(4, exclude=[winner])
+        self.assertNotIn(winner.pk, [song.pk for song in next_songs])
+        self.assertEqual(len(next_songs), self.SONGS - 2)
+
+    # every song but the playing one is drawn once before the deck is reshuffled
+    def test_songs_are_not_repeated_within_a_deck(self):
+        drawn_pks = []
+        for _ in range(self.SONGS - 1):
+            songs = self.party_session.draw_votable_songs(1)
+            self.end_round(songs)
+            drawn_pks.extend(song.pk for song in songs)
+        self.assertEqual(sorted(drawn_pks), list(Song.objects.filter(is_playing=False).order_by('pk')
+                                                 .values_list('pk', flat=True)))
+
+    # a draw that exhausts the deck continues in the reshuffled deck without repeating the songs it already drew
+    def test_draw_across_a_reshuffle_has_no_repeats(self):
+        first_songs = self.party_session.draw_votable_songs(3)
+        self.end_round(first_songs)
+        first_pks = {song.pk for song in first_songs}
+        left_pks = set(Song.objects.filter(is_playing=False).exclude(pk__in=first_pks).values_list('pk', flat=True))
+        with mock.patch.object(PartySession, 'shuffle_deck', autospec=True,
+                               side_effect=PartySession.shuffle_deck) as shuffle_deck:
+            songs = self.party_session.draw_votable_songs(3)
+        self.assertEqual(shuffle_deck.call_count, 1)
+        pks = [song.pk for song in songs]
+        # the last two songs of the first deck come first, the third one is drawn from the reshuffled deck
+        self.assertEqual(set(pks[:2]), left_pks)
+        self.assertEqual(len(set(pks)), 3)
+        self.assertNotIn(Song.objects.get(is_playing=True).pk, pks)
+
+
+# serves a playlist in pages like spotify's playlist items endpoint and counts the requests
+class FakePlaylistClient:
+    def __init__(self, items):
+        self.items = items
+        self.requests = 0
+
+    def page(self, offset, limit):
+        self.requests += 1
+        next_offset = offset + limit if offset + limit < len(self.items) else None
+        return {'items': self.items[offset:offset + limit], 'offset': offset, 'limit': limit, 'next': next_offset}
+
+    def playlist_items(self, playlist_id, fields=None, limit=100, offset=0, additional_types=('track',)):
+        return self.page(offset, limit)
+
+    def next(self, page):
+        return self.page(page['next'], page['limit'])
+
+
+def playlist_item(track_id, name=None):
+    return {'track': {'id': track_id, 'type': 'track', 'name': name or 'Song ' + track_id, 'duration_ms': 215000,
+                      'artists': [{'name': 'Artist'}, {'name': 'Band'}],
+                      'album': {'images': [{'url': 'https://i.scdn.co/image/' + track_id}]}}}
+
+
+class IngestTests(TestCase):
+    def setUp(self):
+        self.party_session = PartySession.objects.create(session_code='ingest')
+        # tracks another party-session already put into the catalog
+        Track.objects.bulk_create([Track(spotify_song_id='known%d' % index, song_name='Known %d' % index,
+                                         song_artist='Artist', song_cover_link='https://i.scdn.co/image/k',
+                                         song_length=215000) for index in range(50)])
+
+    # 250 new tracks, the 50 known ones, a track that is listed twice, a local file and a podcast episode
+    def playlist(self):
+        items = [playlist_item('new%d' % index) for index in range(250)]
+        items += [playlist_item('known%d' % index, name='Renamed') for index in range(50)]
+        items += [playlist_item('new0'), {'track': {'id': None, 'type': 'track'}},
+                  {'track': {'id': 'episode', 'type': 'episode'}}, {'track': None}]
+        return items
+
+    def test_all_pages_are_fetched(self):
+        client = FakePlaylistClient(self.playlist())
+        song_count, duration = ingest_playlist(client, 'p', self.party_session)
+        self.assertEqual(client.requests, 4)
+        self.assertEqual(song_count, 300)
+        self.assertEqual(Song.objects.filter(party_session=self.party_session).count(), 300)
+
+    def test_known_and_repeated_tracks_are_not_inserted_again(self):
+        ingest_playlist(FakePlaylistClient(self.playlist()), 'p', self.party_session)
+        self.assertEqual(Track.objects.count(), 300)
+        # the catalog keeps its rows
+        self.assertFalse(Track.objects.filter(song_name='Renamed').exists())
+        self.assertEqual(Song.objects.filter(track_id='new0').count(), 1)
+        track = Track.objects.get(pk='new7')
+        self.assertEqual((track.song_name, track.song_artist, track.song_cover_link, track.song_length),
+                         ('Song new7', 'Artist, Band', 'https://i.scdn.co/image/new7', 215000))
+        # songs are dealt in a shuffled deck
+        self.assertEqual(sorted(Song.objects.values_list('deck_position', flat=True)), list(range(300)))
+
+    # one catalog lookup and one INSERT per batch, independent of the number of api pages
+    def test_queries_do_not_grow_with_the_pages(self):
+        with CaptureQueriesContext(connection) as queries:
+            ingest_playlist(FakePlaylistClient(self.playlist()), 'p', self.party_session, batch_size=100)
+        statements = [query['sql'].split()[0] for query in queries.captured_queries]
+        self.assertEqual(statements.count('SELECT'), 1)
+        # 250 tracks and 300 songs
+        self.assertEqual(statements.count('INSERT'), 3 + 3)
+        self.assertEqual(len(statements), 1 + 6 + 2)
+
+
+# drives SessionConsumer through websocket communicators and checks the queries of its handlers
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+                   QUERY_BUDGETS_ENFORCED=True, VOTES_REFRESH_WINDOW=0.01, ROUND_LEAD_TIME=0.05)
+class HandlerQueryBudgetTests(TransactionTestCase):
+    SESSION_CODE = 'budget'
+    GUESTS = 3
+
+    def setUp(self):
+        self.host = User.objects.create_user()
+        party_session = PartySession.objects.create(session_code=self.SESSION_CODE)
+        UserJoinedPartySession.objects.create(user=self.host, party_session=party_session, is_session_host=True)
+        UserPlaylist.objects.create(spotify_playlist_id='p', playlist_name='p', is_selected=True, user=self.host,
+                                    playlist_cover_link='https://i.scdn.co/image/p')
+        PlaybackDevice.objects.create(spotify_device_id='d', device_name='d', is_selected=True, user=self.host)
+        ApiToken.objects.create(access_token='a', refresh_token='r', expires_at=2 ** 31 - 1, user=self.host)
+        for index in range(10):
+            track = Track.objects.create(spotify_song_id='track%d' % index, song_name='Song %d' % index,
+                                         song_artist='Artist', song_cover_link='https://i.scdn.co/image/%d' % index,
+                                         song_length=60000)
+            Song.objects.create(track=track, party_session=party_session)
+        self.guests = [User.objects.create_user() for _ in range(self.GUESTS)]
+        for guest in self.guests:
+            UserJoinedPartySession.objects.create(user=guest, party_session=party_session)
+        # users are read back to have their identifiers as saved
+        self.host = User.objects.get(pk=self.host.pk)
+        self.guests = [User.objects.get(pk=guest.pk) for guest in self.guests]
+        # spotify answers every playback request with 204 no content
+        patcher = mock.patch.object(spotify_client.http_session, 'request',
+                                    return_value=mock.Mock(status_code=204, content=b''))
+        self.spotify_request = patcher.start()
+        self.addCleanup(patcher.stop)
+        reset_handler_stats()
+
+    async def connect(self, user, protocol=2):
+        communicator = WebsocketCommunicator(URLRouter(routing.websocket_urlpatterns),
+                                             '/%s/?protocol=%d' % (self.SESSION_CODE, protocol))
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive(self, communicator, message_type, timeout=2):
+        while True:
+            message = json.loads(await communicator.receive_from(timeout=timeout))['text']
+            if message['type'] == message_type:
+                return message
+
+    # connects host and guests and starts the party-session
+    async def start_party_session(self):
+        host = await self.connect(self.host)
+        guests = [await self.connect(guest) for guest in self.guests]
+        await host.send_to(text_data='start_party_session')
+        for communicator in [host] + guests:
+            init_data = await self.receive(communicator, 'session_init')
+        return host, guests, init_data
+
+    # guests leave once the host's disconnect closed their websockets
+    async def close_party_session(self, host, guests):
+        await host.disconnect()
+        for communicator in guests:
+            while (await communicator.receive_output(timeout=2))['type'] != 'websocket.close':
+                pass
+            await communicator.disconnect()
+
+    def queries_of(self, *handler_names):
+        return {name: handler_stats['SessionConsumer.' + name].queries for name in handler_names}
+
+    async def test_votes_run_no_queries(self):
+        host, guests, init_data = await self.start_party_session()
+        song_ids = [song['song_id'] for song in init_data['votable_songs']]
+        # the first votes warm up the vote tally
+        for communicator in guests:
+            await communicator.send_to(text_data=song_ids[0])
+        await self.receive(host, 'votes_delta')
+        await asyncio.sleep(0.05)
+        reset_handler_stats()
+
+        for song_id in song_ids:
+            for communicator in guests:
+                await communicator.send_to(text_data=song_id)
+            await self.receive(host, 'votes_delta')
+        self.assertEqual(handler_stats['SessionConsumer.new_vote_task'].calls, len(song_ids) * self.GUESTS)
+        self.assertEqual(self.queries_of('receive', 'new_vote_task', 'refresh_votes_task', 'votes_refresh'),
+                         {'receive': 0, 'new_vote_task': 0, 'refresh_votes_task': 0, 'votes_refresh': 0})
+        await self.close_party_session(host, guests)
+
+    async def test_round_stays_within_query_budgets(self):
+        await database_sync_to_async(Track.objects.update)(song_length=300)
+        accepted_votes = metrics.received_votes.values.get(('accepted',), 0)
+        round_transitions = sum(metrics.round_transition_duration.values.get((), [[], 0])[0])
+        host, guests, init_data = await self.start_party_session()
+        self.assertEqual(metrics.room_sockets[self.SESSION_CODE], self.GUESTS + 1)
+        # only totals are exported, a session code is enough to join the party-session
+        self.assertIn('spotifyparty_connected_sockets %d' % (self.GUESTS + 1), metrics.render_metrics())
+        self.assertNotIn(self.SESSION_CODE, metrics.render_metrics())
+        await guests[0].send_to(text_data=init_data['votable_songs'][2]['song_id'])
+        refresh_data = await self.receive(host, 'session_refresh')
+        self.assertEqual(refresh_data['playing_song']['song_id'], init_data['votable_songs'][2]['song_id'])
+        await self.close_party_session(host, guests)
+
+        self.assertEqual(handler_stats['SessionConsumer.close_round_task'].calls, 1)
+        self.assertEqual(handler_stats['SessionConsumer.start_round_task'].calls, 1)
+        over_budget = {name: stats.as_dict() for name, stats in handler_stats.items() if stats.over_budget}
+        self.assertEqual(over_budget, {})
+        self.assertEqual(metrics.received_votes.values[('accepted',)], accepted_votes + 1)
+        self.assertEqual(sum(metrics.round_transition_duration.values[()][0]), round_transitions + 1)
+        self.assertNotIn(self.SESSION_CODE, metrics.room_sockets)
+        # the winner was queued on spotify before the playing song ended
+        self.assertIn(mock.call('POST', 'https://api.spotify.com/v1/me/player/queue', headers=mock.ANY,
+                                params={'uri': 'spotify:track:' + refresh_data['playing_song']['song_id'],
+                                        'device_id': 'd'}, json=None, timeout=mock.ANY),
+                      self.spotify_request.call_args_list)
+
+    async def test_resyncing_users_share_one_snapshot(self):
+        host, guests, init_data = await self.start_party_session()
+        builds = metrics.room_snapshot_builds.values.get((), 0)
+        reset_handler_stats()
+        await asyncio.gather(*[communicator.send_to(text_data='resync') for communicator in guests])
+        snapshots = [await communicator.receive_from(timeout=2) for communicator in guests]
+        self.assertEqual(len(set(snapshots)), 1)
+        self.assertEqual(json.loads(snapshots[0])['text']['playing_song'], init_data['playing_song'])
+        self.assertEqual(metrics.room_snapshot_builds.values[()], builds + 1)
+
+        # a vote changes the snapshot
+        song_id = init_data['votable_songs'][0]['song_id']
+        await guests[0].send_to(text_data=song_id)
+        await self.receive(host, 'votes_delta')
+        await guests[1].send_to(text_data='resync')
+        snapshot = await self.receive(guests[1], 'user_session_init')
+        self.assertEqual(snapshot['votable_songs'][0]['votes'], 1)
+        self.assertEqual(metrics.room_snapshot_builds.values[()], builds + 2)
+        self.assertFalse(handler_stats['SessionConsumer.send_to_single_user_task'].over_budget)
+        await self.close_party_session(host, guests)
+
+    # a client that missed a votes delta sees the gap in the sequence numbers and requests a snapshot,
+    # which contains the missed votes and continues the sequence
+    async def test_sequence_gap_is_repaired_by_a_resync(self):
+        host, guests, init_data = await self.start_party_session()
+        song_ids = [song['song_id'] for song in init_data['votable_songs']]
+        for communicator, song_id in zip(guests, song_ids):
+            await communicator.send_to(text_data=song_id)
+            await self.receive(host, 'votes_delta')
+        deltas = [await self.receive(guests[0], 'votes_delta') for _ in guests]
+        self.assertEqual([delta['seq'] for delta in deltas], [init_data['seq'] + 1, init_data['seq'] + 2,
+                                                              init_data['seq'] + 3])
+
+        # the second delta is lost, the third one does not follow the first one
+        last_seq = deltas[0]['seq']
+        self.assertNotEqual(deltas[2]['seq'], last_seq + 1)
+        self.assertNotIn(song_ids[1], deltas[2]['votes'])
+        await guests[0].send_to(text_data='resync')
+        snapshot = await self.receive(guests[0], 'user_session_init')
+        self.assertEqual(snapshot['seq'], deltas[2]['seq'])
+        votes = {song['song_id']: song['votes'] for song in snapshot['votable_songs']}
+        self.assertEqual([votes[song_id] for song_id in song_ids[:3]], [1, 1, 1])
+
+        # the next delta follows the snapshot
+        await guests[1].send_to(text_data=song_ids[0])
+        delta = await self.receive(guests[0], 'votes_delta')
+        self.assertEqual(delta['seq'], snapshot['seq'] + 1)
+        self.assertEqual(delta['votes'], {song_ids[0]: 2, song_ids[1]: 0})
+        await self.close_party_session(host, guests)
+
+    # clients without delta support receive every votable song with its votes, in one frame shared by all of them
+    async def test_protocol_1_clients_receive_full_votes_refresh(self):
+        host, guests, init_data = await self.start_party_session()
+        legacy_clients = [await self.connect(GuestUser(), protocol=1) for _ in range(2)]
+        for communicator in legacy_clients:
+            await self.receive(communicator, 'user_session_init')
+        song_id = init_data['votable_songs'][0]['song_id']
+        await guests[0].send_to(text_data=song_id)
+
+        self.assertEqual((await self.receive(host, 'votes_delta'))['votes'], {song_id: 1})
+        frames = [await communicator.receive_from(timeout=2) for communicator in legacy_clients]
+        self.assertEqual(frames[0], frames[1])
+        refresh_data = json.loads(frames[0])['text']
+        self.assertEqual(refresh_data['type'], 'votes_refresh')
+        self.assertEqual([song['song_id'] for song in refresh_data['votable_songs']],
+                         [song['song_id'] for song in init_data['votable_songs']])
+        self.assertEqual([song['votes'] for song in refresh_data['votable_songs']],
+                         [1] + [0] * (len(init_data['votable_songs']) - 1))
+        for communicator in legacy_clients:
+            await communicator.disconnect()
+        await self.close_party_session(host, guests)
+
+    async def test_closing_a_room_deletes_its_rows_in_constant_queries(self):
+        host, guests, init_data = await self.start_party_session()
+        song_id = init_data['votable_songs'][0]['song_id']
+        song = await database_sync_to_async(Song.objects.get)(party_session__session_code=self.SESSION_CODE,
+                                                              track_id=song_id)
+        # every guest has a vote stored, as after a flush of the vote tally
+        await database_sync_to_async(Song.objects.filter(pk=song.pk).update)(song_votes=self.GUESTS)
+        await database_sync_to_async(UserJoinedPartySession.objects.filter(is_session_host=False).update)(
+            user_vote=song)
+
+        # a leaving guest takes back its vote
+        await guests[0].disconnect()
+        song = await database_sync_to_async(Song.objects.get)(pk=song.pk)
+        self.assertEqual(song.song_votes, self.GUESTS - 1)
+
+        reset_handler_stats()
+        await self.close_party_session(host, guests[1:])
+        self.assertEqual(handler_stats['SessionConsumer.disconnect'].calls, self.GUESTS)
+        self.assertLessEqual(handler_stats['SessionConsumer.disconnect'].queries, 8)
+        for model in (PartySession, Song, UserJoinedPartySession):
+            self.assertFalse(await database_sync_to_async(model.objects.exists)())
+        self.assertEqual(await database_sync_to_async(Track.objects.count)(), 10)
+
+    async def test_signed_guests_vote_without_rows(self):
+        host, guests, init_data = await self.start_party_session()
+        guest = await self.connect(GuestUser())
+        song_id = init_data['votable_songs'][1]['song_id']
+        await guest.send_to(text_data=song_id)
+        self.assertEqual((await self.receive(host, 'votes_delta'))['votes'], {song_id: 1})
+        # the vote of a leaving guest is removed from the tally
+        await guest.disconnect()
+        self.assertEqual((await self.receive(host, 'votes_delta'))['votes'], {song_id: 0})
+        self.assertEqual(await database_sync_to_async(UserJoinedPartySession.objects.count)(), self.GUESTS + 1)
+        await self.close_party_session(host, guests)
+
+    # without a queue, the winner is started on spotify when the playing song ends
+    async def test_refused_queue_starts_song_at_the_end(self):
+        await database_sync_to_async(Track.objects.update)(song_length=300)
+        no_content = mock.Mock(status_code=204, content=b'')
+        no_active_device = mock.Mock(status_code=404, content=b'{}', text='no active device')
+        self.spotify_request.side_effect = lambda method, url, **kwargs: \
+            no_active_device if url.endswith('queue') else no_content
+        started_songs = sum(metrics.track_gap.values.get(('start',), [[], 0])[0])
+        host, guests, init_data = await self.start_party_session()
+        refresh_data = await self.receive(host, 'session_refresh')
+        await self.close_party_session(host, guests)
+        playback_requests = [call for call in self.spotify_request.call_args_list if call[0][0] == 'PUT']
+        self.assertEqual(len(playback_requests), 2)
+        self.assertEqual(playback_requests[1][1]['json'],
+                         {'uris': ['spotify:track:' + refresh_data['playing_song']['song_id']]})
+        self.assertEqual(sum(metrics.track_gap.values[('start',)][0]), started_songs + 1)
+
+    # spotify becoming unreachable after the first song started must not end the rounds
+    async def test_rounds_continue_while_spotify_is_unreachable(self):
+        await database_sync_to_async(Track.objects.update)(song_length=300)
+        no_content = mock.Mock(status_code=204, content=b'')
+        started = []
+
+        def answer(method, url, **kwargs):
+            if url.endswith('play') and not started:
+                started.append(url)
+                return no_content
+            raise requests.ConnectionError('unreachable')
+
+        self.spotify_request.side_effect = answer
+        host, guests, init_data = await self.start_party_session()
+        first_round = await self.receive(host, 'session_refresh')
+        second_round = await self.receive(host, 'session_refresh')
+        self.assertNotEqual(first_round['playback_started'], second_round['playback_started'])
+        room_state = await consumers.get_room_state(self.SESSION_CODE)
+        self.assertTrue(room_state.voting_allowed)
+        await self.close_party_session(host, guests)
+        # failures of scheduled tasks are not raised in the test, a round over its budget only shows in the stats
+        self.assertEqual(handler_stats['SessionConsumer.close_round_task'].over_budget, 0)
+
+    # votes are written to the database behind the tally, a failed flush does not stop later ones
+    async def test_vote_tally_is_written_behind(self):
+        write_vote_tally = consumers.write_vote_tally
+        failed_writes = []
+
+        async def write_once_failing(*args):
+            if not failed_writes:
+                # the write-behind loop of the party-session
+                failed_writes.append(asyncio.current_task())
+                raise DatabaseError('disk I/O error')
+            await write_vote_tally(*args)
+
+        with self.settings(VOTE_FLUSH_INTERVAL=0.01), \
+                mock.patch.object(consumers, 'write_vote_tally', write_once_failing):
+            host, guests, init_data = await self.start_party_session()
+            song_id = init_data['votable_songs'][0]['song_id']
+            await guests[0].send_to(text_data=song_id)
+            await self.receive(host, 'votes_delta')
+            # the failed flush ends the write-behind loop of the party-session
+            await asyncio.sleep(0.05)
+            self.assertEqual(len(failed_writes), 1)
+            self.assertTrue(failed_writes[0].done())
+            # the next vote runs a new loop, which writes all votes of the tally
+            await guests[1].send_to(text_data=song_id)
+            await self.receive(host, 'votes_delta')
+            self.assertFalse(consumers.vote_flush_tasks[self.SESSION_CODE].done())
+            await asyncio.sleep(0.05)
+            song = await database_sync_to_async(Song.objects.get)(party_session__session_code=self.SESSION_CODE,
+                                                                  track_id=song_id)
+            self.assertEqual(song.song_votes, 2)
+            voters = await database_sync_to_async(lambda: set(
+                UserJoinedPartySession.objects.filter(user_vote=song).values_list('user_id', flat=True)))()
+            self.assertEqual(voters, {self.guests[0].pk, self.guests[1].pk})
+            await self.close_party_session(host, guests)
+
+    async def test_clients_read_the_server_clock(self):
+        host = await self.connect(self.host)
+        before = int(time.time() * 1000)
+        await host.send_to(text_data='time_sync:1608000000000')
+        answer = await self.receive(host, 'time_sync')
+        self.assertEqual(answer['client_time'], '1608000000000')
+        self.assertGreaterEqual(answer['server_time'], before)
+        self.assertLessEqual(answer['server_time'], int(time.time() * 1000))
+        await self.close_party_session(host, [])
+
+    def answer_playback(self, song_id, progress_ms):
+        playback = {'is_playing': True, 'progress_ms': progress_ms, 'item': {'id': song_id, 'duration_ms': 60000}}
+        no_content = mock.Mock(status_code=204, content=b'')
+        playing = mock.Mock(status_code=200, content=json.dumps(playback).encode(), json=lambda: playback)
+        self.spotify_request.side_effect = lambda method, url, **kwargs: \
+            playing if url.endswith('me/player') else no_content
+
+    async def test_playback_poll_corrects_round_deadline(self):
+        host, guests, init_data = await self.start_party_session()
+        song_id = init_data['playing_song']['song_id']
+        await asyncio.sleep(0.05)
+        timing = consumers.song_timings[self.SESSION_CODE]
+        self.assertEqual(room_scheduler.deadlines[self.SESSION_CODE][room_scheduler.CALLBACK].__name__,
+                         'sync_playback_task')
+        consumer = consumers.SessionConsumer.for_room(self.SESSION_CODE, self.host)
+
+        # the host's device is 30 seconds ahead: deadline and progress bars are moved
+        self.answer_playback(song_id, 30000)
+        await consumer.sync_playback_task()
+        self.assertAlmostEqual(timing.song_end - monotonic_time(), 30, delta=1)
+        playback_sync = await self.receive(host, 'playback_sync')
+        self.assertAlmostEqual(playback_sync['playback_started'], time.time() * 1000 - 30000, delta=1000)
+        self.assertEqual(await database_sync_to_async(PartySession.objects.values_list('playback_started',
+                                                                                       flat=True).get)(),
+                         playback_sync['playback_started'])
+        # a matching position halves the poll frequency
+        poll_interval = timing.poll_interval
+        await consumer.sync_playback_task()
+        self.assertEqual(timing.poll_interval, 2 * poll_interval)
+
+        # the host skipped the song: the round ends now and the winner is started instead of queued
+        self.answer_playback('skipped', 1000)
+        await consumer.sync_playback_task()
+        refresh_data = await self.receive(host, 'session_refresh')
+        # the winner is started on spotify after the session_refresh was sent
+        for _ in range(100):
+            if handler_stats['SessionConsumer.start_round_task'].calls:
+                break
+            await asyncio.sleep(0.01)
+        await self.close_party_session(host, guests)
+        requests = [(call[0][0], call[0][1].rsplit('/', 1)[1]) for call in self.spotify_request.call_args_list]
+        self.assertNotIn(('POST', 'queue'), requests)
+        self.assertEqual(requests.count(('PUT', 'play')), 2)
+        self.assertEqual(self.spotify_request.call_args_list[-1][1]['json'],
+                         {'uris': ['spotify:track:' + refresh_data['playing_song']['song_id']]})
+
+    # a failing poll still schedules the next deadline of the round, otherwise the rounds would stop for good
+    async def test_failing_playback_poll_keeps_the_round_deadline(self):
+        host, guests, init_data = await self.start_party_session()
+        await asyncio.sleep(0.05)
+        consumer = consumers.SessionConsumer.for_room(self.SESSION_CODE, self.host)
+
+        # the host's token cannot be refreshed
+        room_scheduler.cancel(self.SESSION_CODE)
+        with mock.patch.object(consumers, 'get_user_token_async', side_effect=requests.ConnectionError('unreachable')):
+            await consumer.sync_playback_task()
+        self.assertIn(self.SESSION_CODE, room_scheduler.deadlines)
+
+        # the corrected playback start cannot be saved
+        room_scheduler.cancel(self.SESSION_CODE)
+        self.answer_playback(init_data['playing_song']['song_id'], 30000)
+        with mock.patch.object(consumer, 'set_playback_started', side_effect=DatabaseError('disk I/O error')), \
+                self.assertRaises(DatabaseError):
+            await consumer.sync_playback_task()
+        self.assertIn(self.SESSION_CODE, room_scheduler.deadlines)
+        await self.close_party_session(host, guests)
+
+    # a round that could not be ended reopens the vote and is ended again after a delay
+    async def test_failed_round_end_is_retried(self):
+        host, guests, init_data = await self.start_party_session()
+        consumer = consumers.SessionConsumer.for_room(self.SESSION_CODE, self.host)
+        with self.settings(ROUND_RETRY_DELAY=30), \
+                mock.patch.object(consumers, 'flush_vote_tally', side_effect=DatabaseError('database is locked')), \
+                self.assertRaises(DatabaseError):
+            await consumer.close_round_task()
+        deadline = room_scheduler.deadlines[self.SESSION_CODE]
+        self.assertEqual(deadline[room_scheduler.CALLBACK].__name__, 'close_round_task')
+        self.assertAlmostEqual(deadline[room_scheduler.DEADLINE] - monotonic_time(), 30, delta=1)
+        self.assertTrue((await consumers.get_room_state(self.SESSION_CODE)).voting_allowed)
+
+        # the retry claims the round end again
+        await consumer.close_round_task()
+        self.assertIn(self.SESSION_CODE, consumers.prepared_rounds)
+        self.assertEqual(room_scheduler.deadlines[self.SESSION_CODE][room_scheduler.CALLBACK].__name__,
+                         'start_round_task')
+        await self.close_party_session(host, guests)
+
+    # the database misses the votes of a snapshot that another write-behind pass is still writing
+    async def test_winner_is_picked_from_the_vote_tally(self):
+        host, guests, init_data = await self.start_party_session()
+        song_id = init_data['votable_songs'][2]['song_id']
+        for communicator in guests[:2]:
+            await communicator.send_to(text_data=song_id)
+        while (await self.receive(host, 'votes_delta'))['votes'] != {song_id: 2}:
+            pass
+        consumer = consumers.SessionConsumer.for_room(self.SESSION_CODE, self.host)
+        with mock.patch.object(consumers, 'flush_vote_tally'):
+            await consumer.close_round_task()
+        self.assertEqual(consumers.prepared_rounds[self.SESSION_CODE].playing_song.spotify_song_id, song_id)
+        await self.close_party_session(host, guests)
+
+    # without a token or a selected device the winner is started when the playing song ends
+    async def test_queue_song_reports_token_and_device_failures(self):
+        song = await database_sync_to_async(Song.objects.select_related('track').first)()
+        consumer = consumers.SessionConsumer.for_room(self.SESSION_CODE, self.host)
+        with mock.patch.object(consumers, 'get_user_token_async', side_effect=SpotifyOauthError('invalid_grant')):
+            self.assertFalse(await consumer.queue_song(song))
+        # spotify queues the song on the active device of the host's account
+        await database_sync_to_async(PlaybackDevice.objects.update)(is_selected=False)
+        self.assertTrue(await consumer.queue_song(song))
+        self.assertEqual(self.spotify_request.call_args[1]['params'], {'uri': 'spotify:track:' + song.track_id})
+
+    # the cached room state must match the database after every handler that changes the party-session
+    async def assert_room_state_is_fresh(self):
+        room_state = await consumers.get_room_state(self.SESSION_CODE)
+        self.assertEqual(room_state.as_dict(), (await load_room_state(self.SESSION_CODE)).as_dict())
+        return room_state
+
+    async def test_handlers_invalidate_the_room_state(self):
+        self.assertFalse((await self.assert_room_state_is_fresh()).is_initialized)
+        host, guests, init_data = await self.start_party_session()
+        room_state = await self.assert_room_state_is_fresh()
+        self.assertTrue(room_state.is_initialized)
+        self.assertTrue(room_state.voting_allowed)
+        self.assertEqual(room_state.playing_song.spotify_song_id, init_data['playing_song']['song_id'])
+        self.assertEqual(room_state.playback_started, init_data['playback_started'])
+
+        consumer = consumers.SessionConsumer.for_room(self.SESSION_CODE, self.host)
+        await consumer.close_round_task()
+        room_state = await self.assert_room_state_is_fresh()
+        self.assertFalse(room_state.voting_allowed)
+        winner = consumers.prepared_rounds[self.SESSION_CODE].playing_song
+        self.assertNotIn(winner.pk, [song.pk for song in room_state.votable_songs])
+
+        await consumer.start_round_task()
+        room_state = await self.assert_room_state_is_fresh()
+        self.assertTrue(room_state.voting_allowed)
+        self.assertEqual(room_state.playing_song.pk, winner.pk)
+
+        await consumer.sync_playback_start(1608000000000, False)
+        self.assertEqual((await self.assert_room_state_is_fresh()).playback_started, 1608000000000)
+
+        await self.close_party_session(host, guests)
+        self.assertIsNone(await consumers.get_room_state(self.SESSION_CODE))
+
+    async def test_exceeding_query_budget_fails(self):
+        @instrument(max_queries=1)
+        async def handler():
+            await database_sync_to_async(PartySession.objects.count)()
+            await database_sync_to_async(Song.objects.count)()
+
+        with self.assertRaises(QueryBudgetExceeded):
+            await handler()
+        stats = handler_stats[handler.__qualname__]
+        self.assertEqual((stats.calls, stats.queries, stats.over_budget), (1, 2, 1))
+
+
+# the same party-session with all consumer writes going through the single writer
+@override_settings(DATABASE_WRITE_QUEUE=True)
+class WriteQueueHandlerQueryBudgetTests(HandlerQueryBudgetTests):
+    pass
+
+
+# the same party-session with room affinity, this worker does not own the party-session:
+# votes, guest removals and round ends are forwarded to the owning worker, whose inbox is read in the same process
+# none of the room's websockets connect to the owning worker, its inbox runs since its process started
+class RoomAffinityHandlerQueryBudgetTests(HandlerQueryBudgetTests):
+    def setUp(self):
+        super().setUp()
+        ring = HashRing(['worker-1', 'worker-2'])
+        self.owner = ring.owner(self.SESSION_CODE)
+        for patcher in (mock.patch.object(sharding, 'ring', ring), mock.patch.object(sharding, 'inbox_task', None)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        worker_id = override_settings(ROOM_AFFINITY_WORKER_ID=({'worker-1', 'worker-2'} - {self.owner}).pop())
+        worker_id.enable()
+        self.addCleanup(worker_id.disable)
+
+    async def start_party_session(self):
+        with override_settings(ROOM_AFFINITY_WORKER_ID=self.owner):
+            sharding.start_inbox_at_startup(consumers.room_owner_handlers)
+            # the inbox starts once the event loop runs
+            await asyncio.sleep(0)
+        self.assertIsNotNone(sharding.inbox_task)
+        return await super().start_party_session()
+
+    async def close_party_session(self, host, guests):
+        await super().close_party_session(host, guests)
+        # the owner has left the party-session before its inbox is stopped
+        await asyncio.sleep(0.05)
+        self.assertNotIn(self.SESSION_CODE, consumers.room_owner_consumers)
+        if sharding.inbox_task is not None:
+            sharding.inbox_task.cancel()
+        # the in-memory channel layer outlives the event loop of this test
+        await get_channel_layer().flush()
+
+    async def test_owner_applies_forwarded_votes(self):
+        host, guests, init_data = await self.start_party_session()
+        song_id = init_data['votable_songs'][1]['song_id']
+        await guests[0].send_to(text_data=song_id)
+        self.assertEqual((await self.receive(host, 'votes_delta'))['votes'], {song_id: 1})
+        # the vote of a leaving guest is removed by the owner
+        await guests[0].disconnect()
+        self.assertEqual((await self.receive(host, 'votes_delta'))['votes'], {song_id: 0})
+        await self.close_party_session(host, guests[1:])
+        self.assertEqual(handler_stats['room_vote'].calls, 1)
+        self.assertEqual(handler_stats['room_remove_user'].calls, 1)
+        self.assertEqual(handler_stats['room_schedule_round'].calls, 1)
+
+    # both workers share the worker id of this process, the owner's write-behind loop is never started here
+    @unittest.skip('the write-behind loop runs on the owning worker')
+    async def test_vote_tally_is_written_behind(self):
+        pass
+
+    async def test_inbox_outlives_channel_layer_failures(self):
+        handled = asyncio.Event()
+        channel_layer = get_channel_layer()
+        receive = channel_layer.receive
+        failures = [ConnectionError('unreachable')]
+
+        async def failing_receive(channel):
+            if failures:
+                raise failures.pop()
+            return await receive(channel)
+
+        async def room_vote(message):
+            handled.set()
+
+        with mock.patch.object(sharding, 'INBOX_RETRY_DELAY', 0), \
+                mock.patch.object(channel_layer, 'receive', failing_receive):
+            inbox_task = asyncio.create_task(sharding.read_inbox({'room_vote': room_vote}, self.owner))
+            await channel_layer.send(sharding.worker_inbox(self.owner), {'type': 'room.vote'})
+            await asyncio.wait_for(handled.wait(), 1)
+            inbox_task.cancel()
+        self.assertEqual(failures, [])
+        await channel_layer.flush()
+
+
+# event loop whose clock only moves when the test advances it
+class FakeClockEventLoop(asyncio.SelectorEventLoop):
+    def __init__(self):
+        super().__init__()
+        self.now = 0
+
+    def time(self):
+        return self.now
+
+    # moves the clock and runs everything that became due
+    def advance(self, seconds):
+        self.now += seconds
+        for _ in range(3):
+            self.run_until_complete(asyncio.sleep(0))
+
+
+class VotesRefreshCoalescerTests(SimpleTestCase):
+    WINDOW = 0.05
+
+    def setUp(self):
+        self.loop = FakeClockEventLoop()
+        self.addCleanup(self.loop.close)
+        self.votes = 0
+        # (time, votes) of every broadcast
+        self.broadcasts = []
+        self.coalescer = VotesRefreshCoalescer(self.WINDOW, self.send)
+
+    async def send(self):
+        self.broadcasts.append((self.loop.time(), self.votes))
+
+    async def vote(self):
+        self.votes += 1
+        self.coalescer.request()
+
+    def test_burst_is_broadcast_once_per_window(self):
+        # 1000 votes within one second
+        for _ in range(1000):
+            self.loop.run_until_complete(self.vote())
+            self.loop.advance(0.001)
+        self.loop.advance(self.WINDOW)
+        times = [broadcast_time for broadcast_time, votes in self.broadcasts]
+        self.assertLessEqual(len(self.broadcasts), 1 / self.WINDOW + 1)
+        for earlier, later in zip(times, times[1:]):
+            self.assertGreaterEqual(later - earlier, self.WINDOW - 1e-9)
+        # the last broadcast contains the last vote, nothing is left pending
+        self.assertEqual(self.broadcasts[-1][1], 1000)
+        self.assertIsNone(self.coalescer.pending)
+
+    def test_lone_vote_is_broadcast_after_one_window(self):
+        self.loop.run_until_complete(self.vote())
+        self.loop.advance(self.WINDOW / 2)
+        self.assertEqual(self.broadcasts, [])
+        self.loop.advance(self.WINDOW / 2)
+        self.assertEqual(self.broadcasts, [(self.WINDOW, 1)])
+
+    def test_cancelled_broadcast_is_not_sent(self):
+        self.loop.run_until_complete(self.vote())
+        self.coalescer.cancel()
+        self.loop.advance(self.WINDOW)
+        self.assertEqual(self.broadcasts, [])
+
+
+def api_response(status_code, headers=None):
+    return mock.Mock(status_code=status_code, headers=headers or {}, content=b'{}', json=lambda: {}, text='',
+                     url='https://api.spotify.com/v1/')
+
+
+@override_settings(SPOTIFY_API_MAX_RETRIES=3, SPOTIFY_API_BACKOFF=0.5, SPOTIFY_API_MAX_RETRY_AFTER=5)
+class SpotifyClientTests(SimpleTestCase):
+    def setUp(self):
+        self.client = spotify_client.Spotify('a')
+        patcher = mock.patch.object(spotify_client.http_session, 'request')
+        self.request = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(spotify_client.time, 'sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def sleeps(self):
+        return [call[0][0] for call in self.sleep.call_args_list]
+
+    def test_server_errors_are_retried_with_exponential_backoff(self):
+        self.request.side_effect = [api_response(503), api_response(502), api_response(200)]
+        self.assertEqual(self.client.current_playback(), {})
+        self.assertEqual(self.request.call_count, 3)
+        self.assertEqual(self.sleeps(), [0.5, 1.0])
+
+    def test_retries_end_after_the_last_attempt(self):
+        self.request.return_value = api_response(500)
+        with self.assertRaises(SpotifyException) as raised:
+            self.client.devices()
+        self.assertEqual(raised.exception.http_status, 500)
+        self.assertEqual(self.request.call_count, 4)
+        self.assertEqual(self.sleeps(), [0.5, 1.0, 2.0])
+
+    # a queued song would be queued twice if spotify added it before failing
+    def test_server_errors_of_queue_requests_are_not_retried(self):
+        self.request.return_value = api_response(502)
+        with self.assertRaises(SpotifyException):
+            self.client.add_to_queue('spotify:track:t', device_id='d')
+        self.assertEqual(self.request.call_count, 1)
+        self.assertEqual(self.sleeps(), [])
+
+    def test_rate_limited_queue_requests_wait_and_are_retried(self):
+        self.request.side_effect = [api_response(429, {'Retry-After': '2'}), api_response(204)]
+        self.client.add_to_queue('spotify:track:t', device_id='d')
+        self.assertEqual(self.request.call_count, 2)
+        self.assertEqual(self.sleeps(), [2.0])
+
+    # a long rate limit is raised right away instead of blocking an api thread
+    def test_long_rate_limits_are_not_waited_for(self):
+        self.request.return_value = api_response(429, {'Retry-After': '120'})
+        with self.assertRaises(SpotifyException) as raised:
+            self.client.add_to_queue('spotify:track:t', device_id='d')
+        self.assertEqual(raised.exception.http_status, 429)
+        self.assertEqual(self.request.call_count, 1)
+        self.assertEqual(self.sleeps(), [])
+
+
+class RoomSchedulerTests(SimpleTestCase):
+    def setUp(self):
+        self.scheduler = RoomScheduler()
+        self.calls = []
+
+    def callback(self, name):
+        async def callback():
+            self.calls.append(name)
+        return callback
+
+    async def test_deadlines_run_in_order(self):
+        now = monotonic_time()
+        for session_code, delay in (('a', 0.03), ('b', 0.01), ('c', 0.02), ('d', -1)):
+            self.scheduler.schedule_at(session_code, now + delay, self.callback(session_code))
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.calls, ['d', 'b', 'c', 'a'])
+        self.assertEqual(self.scheduler.stats(), {"pending_deadlines": 0, "running_callbacks": 0, "heap_size": 0})
+        self.assertIsNone(self.scheduler.timer)
+
+    async def test_rescheduling_replaces_the_deadline(self):
+        now = monotonic_time()
+        self.scheduler.schedule_at('a', now + 0.01, self.callback('first'))
+        self.scheduler.schedule_at('a', now + 0.02, self.callback('second'))
+        self.scheduler.schedule_at('b', now + 0.01, self.callback('cancelled'))
+        self.scheduler.cancel('b')
+        self.assertEqual(self.scheduler.stats()['pending_deadlines'], 1)
+        await asyncio.sleep(0.04)
+        self.assertEqual(self.calls, ['second'])
+
+    async def test_timer_follows_the_earliest_deadline(self):
+        now = monotonic_time()
+        self.scheduler.schedule_at('late', now + 10, self.callback('late'))
+        self.assertEqual(self.scheduler.timer_deadline, now + 10)
+        self.scheduler.schedule_at('early', now + 0.01, self.callback('early'))
+        self.assertEqual(self.scheduler.timer_deadline, now + 0.01)
+        await asyncio.sleep(0.03)
+        self.assertEqual(self.calls, ['early'])
+        # after the early deadline the timer is armed for the late one again
+        self.assertEqual(self.scheduler.timer_deadline, now + 10)
+        self.scheduler.close_room('late')
+        self.assertIsNone(self.scheduler.timer)
+
+    async def test_closing_a_room_cancels_its_running_callback(self):
+        started = asyncio.Event()
+
+        async def callback():
+            started.set()
+            await asyncio.sleep(10)
+
+        self.scheduler.schedule_at('a', monotonic_time(), callback)
+        await asyncio.wait_for(started.wait(), 1)
+        task = self.scheduler.running['a']
+        self.scheduler.close_room('a')
+        await asyncio.sleep(0)
+        self.assertTrue(task.cancelled())
+        self.assertEqual(self.scheduler.stats()['running_callbacks'], 0)
+
+    def test_new_event_loop_resets_the_scheduler(self):
+        async def schedule():
+            self.scheduler.schedule_at('a', monotonic_time() + 10, self.callback('a'))
+
+        asyncio.run(schedule())
+        self.assertEqual(self.scheduler.stats()['pending_deadlines'], 1)
+        asyncio.run(schedule())
+        self.assertEqual(self.scheduler.stats(), {"pending_deadlines": 1, "running_callbacks": 0, "heap_size": 1})
+
+    def test_scheduler_stats_are_exported(self):
+        self.assertIn('spotifyparty_scheduler_pending_deadlines %d' % room_scheduler.stats()['pending_deadlines'],
+                      metrics.render_metrics())
+
+
+class HashRingTests(SimpleTestCase):
+    SESSION_CODES = ['room%d' % index for index in range(10000)]
+
+    def test_rooms_are_spread_evenly(self):
+        ring = HashRing(['worker-%d' % index for index in range(4)])
+        rooms_per_worker = {}
+        for session_code in self.SESSION_CODES:
+            owner = ring.owner(session_code)
+            rooms_per_worker[owner] = rooms_per_worker.get(owner, 0) + 1
+        self.assertEqual(len(rooms_per_worker), 4)
+        for rooms in rooms_per_worker.values():
+            self.assertLess(abs(rooms - len(self.SESSION_CODES) / 4), len(self.SESSION_CODES) / 4 * 0.25)
+
+    def test_adding_a_worker_only_moves_rooms_to_it(self):
+        ring = HashRing(['worker-%d' % index for index in range(4)])
+        grown_ring = HashRing(['worker-%d' % index for index in range(5)])
+        moved = [session_code for session_code in self.SESSION_CODES
+                 if ring.owner(session_code) != grown_ring.owner(session_code)]
+        self.assertEqual({grown_ring.owner(session_code) for session_code in moved}, {'worker-4'})
+        self.assertLess(len(moved), len(self.SESSION_CODES) / 5 * 1.25)
+
+    def test_removing_a_worker_only_moves_its_rooms(self):
+        ring = HashRing(['worker-%d' % index for index in range(4)])
+        shrunk_ring = HashRing(['worker-0', 'worker-1', 'worker-3'])
+        for session_code in self.SESSION_CODES:
+            if ring.owner(session_code) != 'worker-2':
+                self.assertEqual(shrunk_ring.owner(session_code), ring.owner(session_code))
+
+
+class WriteQueueTests(TransactionTestCase):
+    def test_failing_job_does_not_roll_back_its_batch(self):
+        writer = WriteQueue()
+        batch = [(Future(), lambda: PartySession.objects.create(session_code='first').session_code),
+                 (Future(), lambda: PartySession.objects.create(session_code='first').session_code),
+                 (Future(), lambda: PartySession.objects.create(session_code='second').session_code)]
+        writer.write_batch(batch)
+        self.assertEqual(batch[0][0].result(), 'first')
+        self.assertIsInstance(batch[1][0].exception(), IntegrityError)
+        self.assertEqual(batch[2][0].result(), 'second')
+        self.assertEqual(sorted(PartySession.objects.values_list('session_code', flat=True)), ['first', 'second'])
+
+    def test_batches_keep_the_connection_until_it_is_unusable(self):
+        writer = WriteQueue()
+        with mock.patch.object(connection, 'close') as close:
+            for _ in range(2):
+                writer.write_batch([(Future(), PartySession.objects.count)])
+            close.assert_not_called()
+            connection.errors_occurred = True
+            with mock.patch.object(connection, 'is_usable', return_value=False):
+                writer.write_batch([(Future(), PartySession.objects.count)])
+            close.assert_called_once_with()
+
+    def test_enqueued_jobs_are_committed_by_the_writer(self):
+        writer = WriteQueue(batch_size=10)
+        futures = [writer.enqueue(PartySession.objects.create, session_code='s%d' % index) for index in range(50)]
+        self.assertEqual([future.result(timeout=5).session_code for future in futures],
+                         ['s%d' % index for index in range(50)])
+        self.assertEqual(PartySession.objects.count(), 50)
+        self.assertEqual(writer.jobs_written, 50)
+        self.assertLessEqual(writer.batches, 50)
+
+
+class TokenServiceTests(TransactionTestCase):
+    CALLERS = 8
+
+    def setUp(self):
+        self.user = User.objects.create_user()
+        ApiToken.objects.create(access_token='expired', refresh_token='r', expires_at=int(time.time()) - 10,
+                                user=self.user)
+        self.service = tokens.TokenService()
+
+    # all callers wait for the refresh of the first one instead of refreshing the token themselves
+    def test_concurrent_callers_share_one_refresh(self):
+        def refresh_access_token(refresh_token):
+            # the other callers arrive while the refresh is in flight
+            time.sleep(0.05)
+            return {'access_token': 'fresh', 'refresh_token': 'r2', 'expires_at': time.time() + 3600}
+
+        oauth = mock.Mock()
+        oauth.refresh_access_token.side_effect = refresh_access_token
+        callers_ready = threading.Barrier(self.CALLERS)
+        access_tokens = []
+
+        def get_token():
+            callers_ready.wait()
+            try:
+                access_tokens.append(self.service.get_token(self.user.pk))
+            finally:
+                connection.close()
+
+        with mock.patch.object(tokens, 'create_spotify_oauth', return_value=oauth):
+            callers = [threading.Thread(target=get_token) for _ in range(self.CALLERS)]
+            for caller in callers:
+                caller.start()
+            for caller in callers:
+                caller.join(timeout=5)
+        self.assertEqual(access_tokens, ['fresh'] * self.CALLERS)
+        oauth.refresh_access_token.assert_called_once_with('r')
+        user_token = ApiToken.objects.get(user=self.user)
+        self.assertEqual((user_token.access_token, user_token.refresh_token), ('fresh', 'r2'))
+
+
+# serves the playlists and devices of a user like spotify's web api, answers matching etags with 304
+class FakeListingsApi:
+    def __init__(self, playlists, devices):
+        self.playlists = playlists
+        self.devices = devices
+        # (endpoint, offset, status) of every request
+        self.requests = []
+        # seconds every request takes, the most requests that were in flight at the same time
+        self.delay = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def response(self, status_code, body=None, etag=None):
+        return mock.Mock(status_code=status_code, headers={'ETag': etag} if etag else {},
+                         content=json.dumps(body).encode() if body is not None else b'', json=lambda: body)
+
+    def request(self, method, url, headers=None, params=None, **kwargs):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.delay)
+            return self.answer(url, headers, params)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def answer(self, url, headers, params):
+        if url.endswith('me/player/devices'):
+            self.requests.append(('devices', None, 200))
+            return self.response(200, {'devices': self.devices})
+        offset, limit = params['offset'], params['limit']
+        body = {'items': self.playlists[offset:offset + limit], 'total': len(self.playlists)}
+        etag = '"%x"' % (hash(json.dumps(body, sort_keys=True)) & 0xffffffff)
+        status_code = 304 if headers.get('If-None-Match') == etag else 200
+        self.requests.append(('playlists', offset, status_code))
+        return self.response(status_code, body if status_code == 200 else None, etag)
+
+
+def listed_playlist(index, name=None, songs=10):
+    return {'id': 'playlist%d' % index, 'name': name or 'Playlist %d' % index, 'tracks': {'total': songs},
+            'images': [{'url': 'https://i.scdn.co/image/p%d' % index}]}
+
+
+# listings are always stale, every fetch requests them again
+@override_settings(PLAYLISTS_CACHE_TTL=0, DEVICES_CACHE_TTL=0)
+class ListingTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user()
+        ApiToken.objects.create(access_token='a', refresh_token='r', expires_at=2 ** 31 - 1, user=self.user)
+        # 120 playlists in three pages, playlists with less than 5 songs are not listed
+        playlists = [listed_playlist(index, songs=3 if index % 10 == 9 else 10) for index in range(120)]
+        self.api = FakeListingsApi(playlists, [{'id': 'd', 'name': 'Speaker', 'is_restricted': False},
+                                               {'id': 'r', 'name': 'Restricted', 'is_restricted': True}])
+        for patcher in (mock.patch.object(views, 'listing_cache', ListingCache()),
+                        mock.patch.object(spotify_client.http_session, 'request', side_effect=self.api.request)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def playlist_rows(self):
+        return dict(UserPlaylist.objects.filter(user=self.user).values_list('spotify_playlist_id', 'playlist_name'))
+
+    def test_listings_are_saved(self):
+        views.fetch_listings_from_spotify(self.user)
+        self.assertCountEqual(self.api.requests, [('devices', None, 200), ('playlists', 0, 200),
+                                                  ('playlists', 50, 200), ('playlists', 100, 200)])
+        self.assertEqual(self.playlist_rows(), {'playlist%d' % index: 'Playlist %d' % index
+                                                for index in range(120) if index % 10 != 9})
+        self.assertEqual(list(PlaybackDevice.objects.filter(user=self.user).values_list('spotify_device_id',
+                                                                                        flat=True)), ['d'])
+
+    # spotify answers every page with 304, nothing is written
+    def test_unchanged_listings_are_not_written(self):
+        views.fetch_listings_from_spotify(self.user)
+        self.api.requests = []
+        with CaptureQueriesContext(connection) as queries:
+            views.fetch_listings_from_spotify(self.user)
+        self.assertEqual([status for kind, offset, status in self.api.requests if kind == 'playlists'],
+                         [304, 304, 304])
+        writes = [query['sql'] for query in queries.captured_queries
+                  if query['sql'].split()[0] in ('INSERT', 'UPDATE', 'DELETE')]
+        self.assertEqual(writes, [])
+
+    # only the changed page is sent again, only the changed, added and removed rows are written
+    def test_changed_page_writes_only_its_changes(self):
+        views.fetch_listings_from_spotify(self.user)
+        row_pks = dict(UserPlaylist.objects.filter(user=self.user).values_list('spotify_playlist_id', 'pk'))
+        self.api.playlists[60] = listed_playlist(60, name='Renamed')
+        # a playlist of the page is replaced by a new one, the total of the listing stays the same
+        self.api.playlists[61] = listed_playlist(200)
+        self.api.requests = []
+        with CaptureQueriesContext(connection) as queries:
+            views.fetch_listings_from_spotify(self.user)
+        self.assertCountEqual([(offset, status) for kind, offset, status in self.api.requests if kind == 'playlists'],
+                              [(0, 304), (50, 200), (100, 304)])
+        statements = [query['sql'].split()[0] for query in queries.captured_queries]
+        self.assertEqual((statements.count('INSERT'), statements.count('UPDATE'), statements.count('DELETE')),
+                         (1, 1, 1))
+        rows = self.playlist_rows()
+        self.assertEqual(rows['playlist60'], 'Renamed')
+        self.assertNotIn('playlist61', rows)
+        self.assertEqual(rows['playlist200'], 'Playlist 200')
+        self.assertEqual(UserPlaylist.objects.get(spotify_playlist_id='playlist0').pk, row_pks['playlist0'])
+
+    # devices and the first page are requested together, the other pages as soon as the first one reports the total,
+    # a refetch requests all pages known from the last fetch at once
+    def test_pages_are_requested_concurrently(self):
+        self.api.delay = 0.05
+        views.fetch_listings_from_spotify(self.user)
+        self.assertGreaterEqual(self.api.max_in_flight, 2)
+        self.api.max_in_flight = 0
+        views.fetch_listings_from_spotify(self.user)
+        self.assertEqual(self.api.max_in_flight, 4)
+
+    # pages behind the end of a listing that got shorter are dropped with their rows
+    def test_shorter_listing_drops_its_last_pages(self):
+        views.fetch_listings_from_spotify(self.user)
+        del self.api.playlists[60:]
+        views.fetch_listings_from_spotify(self.user)
+        self.assertEqual(sorted(views.listing_cache.get_pages(self.user.pk, 'playlists')), [0, 50])
+        self.assertEqual(self.playlist_rows(), {'playlist%d' % index: 'Playlist %d' % index
+                                                for index in range(60) if index % 10 != 9})
+
+    @override_settings(PLAYLISTS_CACHE_TTL=300, DEVICES_CACHE_TTL=15)
+    def test_listings_are_not_requested_within_their_ttl(self):
+        views.fetch_listings_from_spotify(self.user)
+        self.api.requests = []
+        self.assertEqual(views.fetch_listings_from_spotify(self.user), {})
+        self.assertEqual(self.api.requests, [])
+
+
+class SignedGuestTests(TestCase):
+    def setUp(self):
+        host = User.objects.create_user()
+        party_session = PartySession.objects.create(session_code='guests')
+        UserJoinedPartySession.objects.create(user=host, party_session=party_session, is_session_host=True)
+        UserPlaylist.objects.create(spotify_playlist_id='p', playlist_name='p', is_selected=True, user=host,
+                                    playlist_cover_link='https://i.scdn.co/image/p')
+
+    def guest_of(self, response):
+        return guest_from_cookies({GUEST_COOKIE: response.cookies[GUEST_COOKIE].value})
+
+    def test_guests_join_without_database_writes(self):
+        users = User.objects.count()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/guests/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([query['sql'] for query in queries.captured_queries
+                          if not query['sql'].startswith('SELECT')], [])
+        self.assertEqual(User.objects.count(), users)
+        self.assertFalse(Session.objects.exists())
+        # the guest keeps its identity on the next visit
+        guest = self.guest_of(response)
+        self.assertEqual(self.guest_of(self.client.get('/guests/')).identifier, guest.identifier)
+
+    def test_forged_cookie_gets_a_new_identity(self):
+        self.client.cookies[GUEST_COOKIE] = 'guest-forged:signature'
+        guest = self.guest_of(self.client.get('/guests/'))
+        self.assertNotEqual(guest.identifier, 'guest-forged')
+
+    @override_settings(SIGNED_GUESTS=False)
+    def test_accounts_without_signed_guests(self):
+        users = User.objects.count()
+        response = self.client.get('/guests/')
+        self.assertNotIn(GUEST_COOKIE, response.cookies)
+        self.assertEqual(User.objects.count(), users + 1)
+        self.assertEqual(UserJoinedPartySession.objects.count(), 2)
+
+    async def run_guest_middleware(self, user, cookies):
+        scopes = []
+
+        async def inner(scope, receive, send):
+            scopes.append(scope)
+
+        await GuestMiddleware(inner)({'type': 'websocket', 'user': user, 'cookies': cookies}, None, None)
+        return scopes[0]['user']
+
+    async def test_websocket_scope_gets_the_guest_of_the_cookie(self):
+        response = HttpResponse()
+        set_guest_cookie(response, GuestUser('guest-abc'))
+        cookies = {GUEST_COOKIE: response.cookies[GUEST_COOKIE].value}
+        self.assertEqual((await self.run_guest_middleware(AnonymousUser(), cookies)).identifier, 'guest-abc')
+        self.assertIsInstance(await self.run_guest_middleware(AnonymousUser(), {}), AnonymousUser)
+        # logged in hosts keep their account
+        host = User(identifier='host')
+        self.assertIs(await self.run_guest_middleware(host, cookies), host)
+
+
+class MetricsTests(SimpleTestCase):
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram('test_duration_seconds', 'Test durations.', ['kind'], buckets=(0.01, 0.1))
+        self.addCleanup(metrics.registry.remove, histogram)
+        for value in (0.005, 0.05, 0.5):
+            histogram.observe(value, kind='a"b')
+        self.assertEqual(histogram.render().split('\n'), [
+            '# HELP test_duration_seconds Test durations.',
+            '# TYPE test_duration_seconds histogram',
+            'test_duration_seconds_bucket{kind="a\\"b",le="0.01"} 1',
+            'test_duration_seconds_bucket{kind="a\\"b",le="0.1"} 2',
+            'test_duration_seconds_bucket{kind="a\\"b",le="+Inf"} 3',
+            'test_duration_seconds_sum{kind="a\\"b"} 0.555',
+            'test_duration_seconds_count{kind="a\\"b"} 3',
+        ])
+
+    def test_metrics_endpoint(self):
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], metrics.CONTENT_TYPE)
+        self.assertIn('# TYPE spotifyparty_votes_total counter', response.content.decode())
+        self.assertIn('spotifyparty_active_rooms 0', response.content.decode())
+
+    @override_settings(METRICS_ALLOWED_IPS=[], METRICS_TOKEN='scraper')
+    def test_metrics_endpoint_refuses_unknown_clients(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer other').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scraper').status_code, 200)
+        with self.settings(METRICS_TOKEN=None):
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer None').status_code, 403)
+
+
+# contract of the room stores, run against the in-memory store and, if available, against a local redis
+class RoomStoreTests:
+    def create_store(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.store = self.create_store()
+        self.session_code = uuid.uuid4().hex[:12]
+
+    # runs the test's coroutine and removes the party-session from the store afterwards
+    async def run_with_store(self, test):
+        try:
+            await test()
+        finally:
+            await self.store.discard_room(self.session_code)
+
+    async def test_votes_move_and_toggle(self):
+        async def test():
+            await self.store.init_tally(self.session_code, ['a', 'b', 'c'], {})
+            self.assertTrue(await self.store.vote(self.session_code, 1, 'a'))
+            self.assertTrue(await self.store.vote(self.session_code, 2, 'a'))
+            self.assertTrue(await self.store.vote(self.session_code, 1, 'b'))
+            self.assertTrue(await self.store.vote(self.session_code, 2, 'a'))
+            self.assertFalse(await self.store.vote(self.session_code, 3, 'unknown'))
+            self.assertEqual(await self.store.get_votes(self.session_code), (0, {'a': 0, 'b': 1, 'c': 0}))
+            self.assertTrue(await self.store.remove_user(self.session_code, 1))
+            self.assertFalse(await self.store.remove_user(self.session_code, 1))
+            self.assertEqual((await self.store.get_votes(self.session_code))[1], {'a': 0, 'b': 0, 'c': 0})
+
+        await self.run_with_store(test)
+
+    async def test_deltas_contain_changed_songs_once(self):
+        async def test():
+            await self.store.init_tally(self.session_code, ['a', 'b', 'c'], {})
+            self.assertIsNone(await self.store.pop_delta(self.session_code))
+            await self.store.vote(self.session_code, 1, 'a')
+            await self.store.vote(self.session_code, 1, 'b')
+            self.assertEqual(await self.store.pop_delta(self.session_code), (1, {'a': 0, 'b': 1}))
+            self.assertIsNone(await self.store.pop_delta(self.session_code))
+            await self.store.vote(self.session_code, 2, 'c')
+            self.assertEqual(await self.store.pop_delta(self.session_code), (2, {'c': 1}))
+
+        await self.run_with_store(test)
+
+    async def test_init_restores_stored_votes_and_keeps_existing_tally(self):
+        async def test():
+            await self.store.init_tally(self.session_code, ['a', 'b'], {1: 'a', 2: 'a', 3: 'gone'})
+            self.assertIsNone(await self.store.take_snapshot(self.session_code))
+            await self.store.init_tally(self.session_code, ['c'], {})
+            self.assertEqual(await self.store.get_votes(self.session_code), (0, {'a': 2, 'b': 0}))
+            await self.store.vote(self.session_code, 3, 'b')
+            self.assertEqual(await self.store.take_snapshot(self.session_code),
+                             ({'a': 2, 'b': 1}, {1: 'a', 2: 'a', 3: 'b'}))
+            self.assertIsNone(await self.store.take_snapshot(self.session_code))
+
+        await self.run_with_store(test)
+
+    async def test_reset_starts_new_round(self):
+        async def test():
+            await self.store.init_tally(self.session_code, ['a', 'b'], {1: 'a'})
+            await self.store.vote(self.session_code, 2, 'b')
+            await self.store.pop_delta(self.session_code)
+            await self.store.vote(self.session_code, 3, 'b')
+            await self.store.reset_tally(self.session_code, ['c', 'd'])
+            self.assertEqual(await self.store.get_votes(self.session_code), (1, {'c': 0, 'd': 0}))
+            self.assertIsNone(await self.store.pop_delta(self.session_code))
+            self.assertEqual(await self.store.take_snapshot(self.session_code), ({'c': 0, 'd': 0}, {}))
+            await self.store.discard_tally(self.session_code)
+            self.assertFalse(await self.store.has_tally(self.session_code))
+
+        await self.run_with_store(test)
+
+    async def test_invalidated_room_state_is_not_cached(self):
+        async def test():
+            room_state = RoomState(PartySession(pk=1, session_code=self.session_code), None, [])
+            version = await self.store.get_room_state_version(self.session_code)
+            await self.store.invalidate_room_state(self.session_code)
+            await self.store.set_room_state(self.session_code, room_state, version)
+            self.assertIsNone(await self.store.get_room_state(self.session_code))
+            version = await self.store.get_room_state_version(self.session_code)
+            await self.store.set_room_state(self.session_code, room_state, version)
+            self.assertEqual((await self.store.get_room_state(self.session_code)).session_id, 1)
+
+        await self.run_with_store(test)
+
+    async def test_room_state_versions_are_kept_per_room(self):
+        async def test():
+            room_state = RoomState(PartySession(pk=1, session_code=self.session_code), None, [])
+            version = await self.store.get_room_state_version(self.session_code)
+            await self.store.invalidate_room_state(self.session_code + 'other')
+            await self.store.set_room_state(self.session_code, room_state, version)
+            self.assertEqual((await self.store.get_room_state(self.session_code)).session_id, 1)
+
+        await self.run_with_store(test)
+
+    async def test_room_state_keeps_the_songs(self):
+        async def test():
+            tracks = [Track(spotify_song_id='track%d' % index, song_name='Song %d' % index, song_artist='Artist',
+                            song_cover_link='https://i.scdn.co/image/%d' % index, song_length=215000)
+                      for index in range(1, 4)]
+            songs = [Song(pk=index, track=track, is_playing=index == 1, is_votable=index > 1, song_votes=index,
+                          party_session_id=1)
+                     for index, track in enumerate(tracks, 1)]
+            room_state = RoomState(PartySession(pk=1, session_code=self.session_code, is_initialized=True,
+                                                voting_allowed=True, playback_started=1608000000000),
+                                   songs[0], songs[1:])
+            await self.store.set_room_state(self.session_code, room_state,
+                                            await self.store.get_room_state_version(self.session_code))
+            cached = await self.store.get_room_state(self.session_code)
+            self.assertEqual((cached.session_id, cached.is_initialized, cached.voting_allowed, cached.playback_started),
+                             (1, True, True, 1608000000000))
+            self.assertEqual(cached.playing_song.pk, 1)
+            self.assertEqual(consumers.get_playing_song_dict(cached.playing_song),
+                             consumers.get_playing_song_dict(songs[0]))
+            self.assertEqual([song.pk for song in cached.votable_songs], [2, 3])
+            self.assertEqual(consumers.get_votable_songs_dict(cached.votable_songs, {}),
+                             consumers.get_votable_songs_dict(songs[1:], {}))
+
+        await self.run_with_store(test)
+
+    async def test_round_end_is_claimed_once(self):
+        async def test():
+            self.assertTrue(await self.store.claim_round_end(self.session_code, 'round1'))
+            self.assertFalse(await self.store.claim_round_end(self.session_code, 'round1'))
+            self.assertTrue(await self.store.claim_round_end(self.session_code, 'round2'))
+            # a failed round end is released and claimed again by the retry
+            await self.store.release_round_end(self.session_code, 'round1')
+            self.assertTrue(await self.store.claim_round_end(self.session_code, 'round1'))
+
+        await self.run_with_store(test)
+
+
+class MemoryRoomStoreTests(RoomStoreTests, SimpleTestCase):
+    def create_store(self):
+        return MemoryRoomStore()
+
+
+# the contract and the keys of the redis store
+class RedisRoomStoreTests(RoomStoreTests):
+    async def test_keys_created_by_votes_expire(self):
+        async def test():
+            await self.store.init_tally(self.session_code, ['a', 'b'], {})
+            await self.store.reset_tally(self.session_code, ['a', 'b'])
+            await self.store.vote(self.session_code, 1, 'a')
+            redis = await self.store.connection()
+            for key in self.store.tally_keys(self.session_code):
+                self.assertGreater(await redis.ttl(key), 0, key)
+
+        await self.run_with_store(test)
+
+
+# runs against the redis given by REDIS_TEST_URL, e.g. REDIS_TEST_URL=redis://127.0.0.1:6379/15
+@unittest.skipUnless(os.environ.get('REDIS_TEST_URL'), 'REDIS_TEST_URL is not set')
+class ServerRedisRoomStoreTests(RedisRoomStoreTests, SimpleTestCase):
+    def create_store(self):
+        return RedisRoomStore(os.environ['REDIS_TEST_URL'])
+
+
+# runs the lua scripts in fakeredis, which executes them with lupa (fakeredis[lua] in requirements.txt)
+@unittest.skipUnless(fakeredis is not None, 'fakeredis is not installed')
+class FakeRedisRoomStoreTests(RedisRoomStoreTests, SimpleTestCase):
+    def create_store(self):
+        server = fakeredis.FakeServer()
+        patcher = mock.patch('aioredis.create_redis_pool', lambda url: fakeredis.aioredis.create_redis_pool(server))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return RedisRoomStore('redis://fakeredis')
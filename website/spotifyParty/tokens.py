@@ -0,0 +1,164 @@
+import threading
+import time
+from .instrumentation import database_sync_to_async
+from django.db import connection
+from spotipy import SpotifyOAuth
+from .models import ApiToken
+from . import metrics
+
+# tokens expiring within this many seconds are refreshed before they are handed out
+EXPIRY_MARGIN = 60
+# tokens expiring within this many seconds are refreshed in the background while still being handed out
+REFRESH_AHEAD = 300
+
+
+# authorizes application
+def create_spotify_oauth():
+    return SpotifyOAuth(
+        client_id='bad705349c69482491eb6fc424167330',
+        client_secret='c75baaacada64c7f92a6f06e45b72c29',
+        redirect_uri='http://127.0.0.1:8000/redirect/',
+        scope='user-library-read, user-modify-playback-state, user-read-playback-state'
+    )
+
+
+class CachedToken:
+    def __init__(self, access_token, refresh_token, expires_at):
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.expires_at = expires_at
+
+    def expires_in(self):
+        return self.expires_at - time.time()
+
+
+# single source of access tokens for views and consumers
+# tokens are cached per user, only one refresh per user runs at a time (single-flight)
+class TokenService:
+    def __init__(self):
+        self.tokens = {}
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+        self.refreshing_ahead = set()
+
+    def lock_for(self, user_id):
+        with self.locks_lock:
+            return self.locks.setdefault(user_id, threading.Lock())
+
+    # returns a valid access token of a user or False if the user has no token, may query the database
+    def get_token(self, user_id):
+        token = self.tokens.get(user_id)
+        if token is None or token.expires_in() < EXPIRY_MARGIN:
+            token = self.load_or_refresh(user_id)
+            if token is None:
+                return False
+        elif token.expires_in() < REFRESH_AHEAD:
+            self.refresh_in_background(user_id)
+        return token.access_token
+
+    # returns a cached access token that is still valid without touching the database or None
+    def get_cached_token(self, user_id):
+        token = self.tokens.get(user_id)
+        if token is None or token.expires_in() < EXPIRY_MARGIN:
+            return None
+        if token.expires_in() < REFRESH_AHEAD:
+            self.refresh_in_background(user_id)
+        return token.access_token
+
+    def load_or_refresh(self, user_id):
+        with self.lock_for(user_id):
+            # another caller might have loaded or refreshed the token while this one was waiting
+            token = self.tokens.get(user_id)
+            if token is None:
+                token = self.load(user_id)
+                if token is None:
+                    return None
+            if token.expires_in() < EXPIRY_MARGIN:
+                token = self.refresh(user_id, token)
+            return token
+
+    def load(self, user_id):
+        user_tokens = list(ApiToken.objects.filter(user_id=user_id).order_by('-pk'))
+        if not user_tokens:
+            return None
+        # remove duplicate rows left over from earlier save-then-delete refreshes
+        if len(user_tokens) > 1:
+            ApiToken.objects.filter(pk__in=[user_token.pk for user_token in user_tokens[1:]]).delete()
+        user_token = user_tokens[0]
+        token = CachedToken(user_token.access_token, user_token.refresh_token, user_token.expires_at)
+        self.tokens[user_id] = token
+        return token
+
+    # has to be called while holding the user's lock
+    def refresh(self, user_id, token):
+        try:
+            token_info = create_spotify_oauth().refresh_access_token(token.refresh_token)
+        except Exception:
+            metrics.token_refreshes.inc(result='failure')
+            raise
+        metrics.token_refreshes.inc(result='success')
+        return self.save(user_id, token_info)
+
+    # stores a token received from spotify in the database and the cache, the user's token row is updated in place
+    def save(self, user_id, token_info):
+        token = CachedToken(token_info['access_token'], token_info['refresh_token'], int(token_info['expires_at']))
+        updated = ApiToken.objects.filter(user_id=user_id).update(access_token=token.access_token,
+                                                                  refresh_token=token.refresh_token,
+                                                                  expires_at=token.expires_at)
+        if not updated:
+            ApiToken.objects.create(access_token=token.access_token, refresh_token=token.refresh_token,
+                                    expires_at=token.expires_at, user_id=user_id)
+        self.tokens[user_id] = token
+        return token
+
+    # removes the tokens of a user, e.g. after spotify rejected the refresh token
+    def discard(self, user_id):
+        with self.lock_for(user_id):
+            self.tokens.pop(user_id, None)
+            ApiToken.objects.filter(user_id=user_id).delete()
+
+    # refreshes a token that expires soon without making the caller wait for it
+    def refresh_in_background(self, user_id):
+        with self.locks_lock:
+            if user_id in self.refreshing_ahead:
+                return
+            self.refreshing_ahead.add(user_id)
+        threading.Thread(target=self.refresh_ahead, args=(user_id,), daemon=True).start()
+
+    def refresh_ahead(self, user_id):
+        try:
+            with self.lock_for(user_id):
+                token = self.tokens.get(user_id)
+                if token is not None and token.expires_in() < REFRESH_AHEAD:
+                    self.refresh(user_id, token)
+        except Exception as error:
+            # the next caller refreshes the token in the foreground once it is about to expire
+            print('Background token refresh failed for user %s: %r' % (user_id, error))
+        finally:
+            with self.locks_lock:
+                self.refreshing_ahead.discard(user_id)
+            connection.close()
+
+
+token_service = TokenService()
+
+
+# get user token from cache, database or spotify api, returns False if the user has no token
+def get_user_token(user):
+    return token_service.get_token(user.pk)
+
+
+# hot path for consumers: cached tokens are returned without leaving the event loop
+async def get_user_token_async(user):
+    access_token = token_service.get_cached_token(user.pk)
+    if access_token is None:
+        access_token = await database_sync_to_async(token_service.get_token)(user.pk)
+    return access_token
+
+
+def save_user_token(user, token_info):
+    token_service.save(user.pk, token_info)
+
+
+def discard_user_token(user):
+    token_service.discard(user.pk)
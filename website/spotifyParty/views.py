@@ -1,15 +1,22 @@
 import string
 import random
-from django.http import HttpResponseRedirect
+from django.conf import settings as site_settings
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseRedirect
 from django.contrib.auth import login
 from django.urls import reverse
-from .models import PartySession, UserPlaylist, Song, UserJoinedPartySession, User, ApiToken, PlaybackDevice
+from django.utils.crypto import constant_time_compare
+from .models import PartySession, UserPlaylist, UserJoinedPartySession, User, PlaybackDevice
+from .guests import GuestUser, guest_from_cookies, set_guest_cookie
+from .ingest import ingest_playlist
 
-import json
 import time
+from concurrent.futures import wait, FIRST_COMPLETED
 from django.shortcuts import render, redirect
-import spotipy
-from spotipy import SpotifyOAuth, SpotifyException
+from spotipy import SpotifyException
+from .spotify_client import Spotify, api_executor
+from .tokens import create_spotify_oauth, get_user_token, save_user_token, discard_user_token
+from .listings import listing_cache, apply_listing
+from .metrics import CONTENT_TYPE, render_metrics
 
 
 def index(request):
@@ -36,7 +43,10 @@ def settings(request):
         if active_playlists.exists() and active_devices.exists():
             active_playlist = active_playlists[0]
             active_device = active_devices[0]
-            # set selected playlist and device as is_selected in db
+            # set selected playlist and device as is_selected in db,
+            # listings are kept between page loads, so earlier selections have to be cleared
+            UserPlaylist.objects.filter(user=request.user, is_selected=True).update(is_selected=False)
+            PlaybackDevice.objects.filter(user=request.user, is_selected=True).update(is_selected=False)
             active_playlist.is_selected = True
             active_playlist.save()
             active_device.is_selected = True
@@ -59,8 +69,7 @@ def settings(request):
             return HttpResponseRedirect(reverse('party_session', kwargs={'room_name': random_session_code}))
 
     # fetch user devices and playlist from spotify api
-    fetch_playlists_from_spotify(request.user)
-    fetch_devices_from_spotify(request.user)
+    upstream_timings = fetch_listings_from_spotify(request.user)
     user_playlists = UserPlaylist.objects.filter(user=request.user)
     user_devices = PlaybackDevice.objects.filter(user=request.user)
 
@@ -85,10 +94,15 @@ def settings(request):
         error_msg1 = 'Please make sure your playlist is set to public and contains at least 5 songs!'
     if not user_devices.exists():
         error_msg2 = 'Please make sure your playback device is active and accessible!'
-    return render(request, 'settings.html', {'error_msg1': error_msg1,
-                                             'error_msg2': error_msg2,
-                                             'playlists': playlists,
-                                             'devices': devices})
+    response = render(request, 'settings.html', {'error_msg1': error_msg1,
+                                                 'error_msg2': error_msg2,
+                                                 'playlists': playlists,
+                                                 'devices': devices})
+    # timing breakdown of the upstream calls, shown in the browser's developer tools
+    if upstream_timings:
+        response['Server-Timing'] = ', '.join('spotify-%s;dur=%.1f' % (name, duration)
+                                              for name, duration in upstream_timings.items())
+    return response
 
 
 # delivers connection to websocket
@@ -98,36 +112,67 @@ def party_session(request, room_name):
     # check if session for entered code exists
     if valid_session.exists():
         valid_session = valid_session[0]
+        guest = None
         if not request.user.is_authenticated:
-            new_user = User.objects.create_user()
-            new_user.save()
-            login(request, new_user)
-
-        # create relationship object for non-host users
-        user_joined_session = UserJoinedPartySession.objects.filter(user=request.user, party_session=valid_session)
-        if not user_joined_session.exists():
-            new_user_joined_party_session = UserJoinedPartySession(user=request.user, party_session=valid_session)
-            new_user_joined_party_session.save()
-            user_is_host = new_user_joined_party_session.is_session_host
+            if site_settings.SIGNED_GUESTS:
+                # guests keep the identity of their signed cookie, joining does not write to the database
+                guest = guest_from_cookies(request.COOKIES) or GuestUser()
+            else:
+                new_user = User.objects.create_user()
+                new_user.save()
+                login(request, new_user)
+
+        if guest is not None:
+            user_is_host = False
         else:
-            user_joined_session = user_joined_session[0]
-            user_is_host = user_joined_session.is_session_host
+            # create relationship object for non-host users
+            user_joined_session = UserJoinedPartySession.objects.filter(user=request.user,
+                                                                        party_session=valid_session)
+            if not user_joined_session.exists():
+                new_user_joined_party_session = UserJoinedPartySession(user=request.user,
+                                                                       party_session=valid_session)
+                new_user_joined_party_session.save()
+                user_is_host = new_user_joined_party_session.is_session_host
+            else:
+                user_joined_session = user_joined_session[0]
+                user_is_host = user_joined_session.is_session_host
 
         # connects to websocket if matching session exists
         # delivers different html based on user-role
         host_joined_session = UserJoinedPartySession.objects.filter(party_session=valid_session, is_session_host=True)[
             0]
         active_playlist = UserPlaylist.objects.filter(is_selected=True, user=host_joined_session.user)[0]
-        return render(request, 'room.html', {
+        response = render(request, 'room.html', {
             'room_name': room_name,
             'user_is_host': user_is_host,
             'active_playlist': active_playlist
         })
+        # every visit renews the guest cookie
+        if guest is not None:
+            set_guest_cookie(response, guest)
+        return response
     else:
         # redirects back to index if no matching session exists
         return HttpResponseRedirect(reverse('index'))
 
 
+# metrics of this process in the prometheus text format, every server process has to be scraped on its own
+def metrics(request):
+    if not metrics_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(render_metrics(), content_type=CONTENT_TYPE)
+
+
+# the scraper is allowed by its address or its token, staff users by their login
+def metrics_allowed(request):
+    if request.META.get('REMOTE_ADDR') in site_settings.METRICS_ALLOWED_IPS:
+        return True
+    token = site_settings.METRICS_TOKEN
+    if token and constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), 'Bearer ' + token):
+        return True
+    return request.user.is_authenticated and request.user.is_staff
+
+
 # creates random 6 digit string
 def create_session_code():
     characters = string.ascii_lowercase
@@ -135,7 +180,7 @@ def create_session_code():
     # checks if string is already in use
     if PartySession.objects.filter(session_code=random_session_code).exists():
         # create new string
-        create_session_code()
+        return create_session_code()
     else:
         return random_session_code
 
@@ -149,93 +194,121 @@ def login_spotify(template):
     return redirect(auth_url)
 
 
-# gets user playlists from api and save them to database
-def fetch_playlists_from_spotify(user):
-    sp = spotipy.Spotify(auth=get_user_token(user))
-    # receiving playlists
-    raw_playlists = sp.current_user_playlists(limit=10, offset=0)
-    # converting playlists to json
-    playlist_json = json.loads(json.dumps(raw_playlists))
-    # delete old playlists from database
-    previous_playlists = UserPlaylist.objects.filter(user=user)
-    if previous_playlists.exists():
-        previous_playlists.delete()
-    # save new playlists to database
-    for playlist in playlist_json['items']:
+# gets all user playlist-tracks from api and saves them to db
+def fetch_playlist_tracks_from_spotify(user, playlist_id, current_session):
+    sp = Spotify(auth=get_user_token(user))
+    ingest_playlist(sp, playlist_id, current_session)
+
+
+# page size of spotify's playlists endpoint
+PLAYLISTS_PAGE_SIZE = 50
+
+
+# calls function and records its duration in milliseconds under name
+def timed_call(timings, name, function, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        timings[name] = (time.perf_counter() - start) * 1000
+
+
+# requests one page of the user's playlists, conditional on the etag of the last request for this page
+# returns (rows, etag, total), rows are None if the page did not change
+def request_playlists_page(sp, offset, etag):
+    raw_playlists, etag = sp.get_if_modified('me/playlists', params={'limit': PLAYLISTS_PAGE_SIZE, 'offset': offset},
+                                             etag=etag)
+    if raw_playlists is None:
+        return None, etag, None
+    playlists = {}
+    for playlist in raw_playlists['items']:
         # only save playlists with at least 5 songs (1 playback + 4 votable)
         if int(playlist['tracks']['total']) > 4:
-            new_playlist = UserPlaylist(spotify_playlist_id=playlist['id'], playlist_name=playlist['name'],
-                                        playlist_cover_link=playlist['images'][0]['url'], user=user)
-            new_playlist.save()
+            playlists[playlist['id']] = {
+                'playlist_name': playlist['name'][:100],
+                'playlist_cover_link': playlist['images'][0]['url'] if playlist['images'] else ''
+            }
+    return playlists, etag, raw_playlists['total']
 
 
-# gets user playlist-tracks from api and saves them to db
-def fetch_playlist_tracks_from_spotify(user, playlist_id, current_session):
-    sp = spotipy.Spotify(auth=get_user_token(user))
-    # receiving tracks from selected playlist
-    raw_tracks = sp.playlist_items(playlist_id, limit=30, offset=0)
-    # converting tracks to json
-    tracks_json = json.loads(json.dumps(raw_tracks))
-    # save tracks to database
-    for track in tracks_json['items']:
-        song_id = track['track']['id']
-        name = track['track']['name']
-        length = int(track['track']['duration_ms'])
-        image_link = track['track']['album']['images'][0]['url']
-        artists = ''
-        for artist in track['track']['artists']:
-            artists = artists + artist['name'] + ', '
-        artists = artists[0:-2]
-        new_song = Song(spotify_song_id=song_id, song_name=name, song_artist=artists, song_cover_link=image_link,
-                        song_length=length, party_session=current_session)
-        new_song.save()
-
-
-# gets user devices from api and save them to db
-def fetch_devices_from_spotify(user):
-    sp = spotipy.Spotify(auth=get_user_token(user))
-    # receiving user devices
+def request_devices(sp):
     raw_devices = sp.devices()
-    # converting devices to json
-    json_devices = json.loads(json.dumps(raw_devices))
-    # delete old devices from db:
-    previous_devices = PlaybackDevice.objects.filter(user=user)
-    if previous_devices.exists():
-        previous_devices.delete()
-    # save new devices to db:
-    for device in json_devices['devices']:
+    devices = {}
+    for device in raw_devices['devices']:
         # only save unrestricted devices
         if not device['is_restricted']:
-            new_device = PlaybackDevice(spotify_device_id=device['id'],
-                                        device_name=device['name'], user=user)
-            new_device.save()
-
-
-# get user token either from database or spotify api
-def get_user_token(user):
-    user_tokens = ApiToken.objects.filter(user=user)
-    if user_tokens.exists():
-        user_token = user_tokens[0]
-        access_token = user_token.access_token
-
-        now = int(time.time())
-        is_expired = user_token.expires_at - now < 60
-        # check if token is expired
-        if is_expired:
-            sp_oauth = create_spotify_oauth()
-            # refresh token if expired
-            token_info = sp_oauth.refresh_access_token(user_token.refresh_token)
-            # save new token and delete expired one
-            api_token = ApiToken(access_token=token_info['access_token'], refresh_token=token_info['refresh_token'],
-                                 expires_at=int(token_info['expires_at']), user=user)
-            api_token.save()
-            user_token.delete()
-            # return refreshed token
-            user_token = ApiToken.objects.filter(user=user)[0]
-            access_token = user_token.access_token
-        return access_token
-    else:
-        return False
+            devices[device['id']] = {'device_name': device['name'][:150]}
+    return devices
+
+
+# gets user playlists and devices from api and saves changes to the database
+# all upstream requests run concurrently: devices and all playlists pages known from the last fetch start together,
+# further playlists pages start as soon as the first page reports the total,
+# pages are filtered as they arrive
+# listings are skipped within their cache ttl, unchanged playlists pages are answered with 304 by spotify
+# returns the duration of every upstream call in milliseconds
+def fetch_listings_from_spotify(user):
+    timings = {}
+    fetch_playlists = not listing_cache.is_fresh(user.pk, 'playlists')
+    fetch_devices = not listing_cache.is_fresh(user.pk, 'devices')
+    if not fetch_playlists and not fetch_devices:
+        return timings
+    sp = Spotify(auth=get_user_token(user))
+    cached_pages = listing_cache.get_pages(user.pk, 'playlists')
+    pages = {}
+    # maps every submitted future to the playlists offset it requests or to 'devices'
+    submitted = {}
+
+    def request_page(offset):
+        etag = cached_pages[offset][0] if offset in cached_pages else None
+        future = api_executor.submit(timed_call, timings, 'playlists-%d' % offset, request_playlists_page, sp,
+                                     offset, etag)
+        submitted[future] = offset
+        return future
+
+    if fetch_devices:
+        submitted[api_executor.submit(timed_call, timings, 'devices', request_devices, sp)] = 'devices'
+    if fetch_playlists:
+        for offset in sorted(set(cached_pages) | {0}):
+            request_page(offset)
+    devices = None
+    total = None
+    pending = set(submitted)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if submitted[future] == 'devices':
+                devices = future.result()
+                continue
+            offset = submitted[future]
+            rows, etag, page_total = future.result()
+            # unchanged pages reuse the rows of the last fetch
+            pages[offset] = (etag, rows if rows is not None else cached_pages.get(offset, (None, {}))[1])
+            if offset == 0:
+                # an unchanged first page has the same total as the last fetch
+                total = page_total if page_total is not None else PLAYLISTS_PAGE_SIZE * len(cached_pages)
+                for next_offset in range(PLAYLISTS_PAGE_SIZE, total, PLAYLISTS_PAGE_SIZE):
+                    if next_offset not in submitted.values():
+                        pending.add(request_page(next_offset))
+
+    # drop pages behind the end of a playlists listing that got shorter
+    if total is not None:
+        pages = {offset: page for offset, page in pages.items() if offset == 0 or offset < total}
+
+    if fetch_devices:
+        listing_cache.mark_fetched(user.pk, 'devices')
+        apply_listing(PlaybackDevice.objects.filter(user=user), PlaybackDevice, 'spotify_device_id', devices,
+                      user=user)
+    if fetch_playlists:
+        listing_cache.mark_fetched(user.pk, 'playlists', pages)
+        # only write if a page changed or pages were added or removed
+        if pages.keys() != cached_pages.keys() or any(pages[offset] != cached_pages[offset] for offset in pages):
+            playlists = {}
+            for offset in sorted(pages):
+                playlists.update(pages[offset][1])
+            apply_listing(UserPlaylist.objects.filter(user=user), UserPlaylist, 'spotify_playlist_id', playlists,
+                          user=user)
+    return timings
 
 
 # called after spotify login
@@ -253,28 +326,13 @@ def redirect_page(request):
             no_token_saved = True
     # catch invalid refresh token exception and delete old tokens
     except SpotifyException:
-        user_tokens = ApiToken.objects.filter(user=request.user)
-        if user_tokens.exists():
-            user_token = user_tokens[0]
-            user_token.delete()
-            no_token_saved = True
+        discard_user_token(request.user)
+        no_token_saved = True
     # get new token from spotify-api
     if no_token_saved:
         sp_oauth = create_spotify_oauth()
         code = request.GET.get('code')
         token_info = sp_oauth.get_access_token(code=code, check_cache=False)
-        # save new token to database
-        api_token = ApiToken(access_token=token_info['access_token'], refresh_token=token_info['refresh_token'],
-                             expires_at=int(token_info['expires_at']), user=request.user)
-        api_token.save()
+        # save new token to database and token cache
+        save_user_token(request.user, token_info)
     return redirect(settings)
-
-
-# authorizes application
-def create_spotify_oauth():
-    return SpotifyOAuth(
-        client_id='bad705349c69482491eb6fc424167330',
-        client_secret='c75baaacada64c7f92a6f06e45b72c29',
-        redirect_uri='http://127.0.0.1:8000/redirect/',
-        scope='user-library-read, user-modify-playback-state, user-read-playback-state'
-    )
@@ -0,0 +1,123 @@
+import asyncio
+import contextvars
+import functools
+import queue
+import threading
+from concurrent.futures import Future
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from .instrumentation import await_database, count_queries, database_sync_to_async
+
+# pragmas of every sqlite connection while the write queue is enabled:
+# readers keep reading while the writer commits (WAL), commits do not wait for fsync of the database file (NORMAL)
+# and a connection waits for the write lock instead of failing with 'database is locked'
+SQLITE_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA temp_store=MEMORY',
+)
+
+
+# the pragmas are run on the raw connection: setting up a connection is not charged to the handler that opened it
+@receiver(connection_created)
+def set_sqlite_pragmas(sender, connection, **kwargs):
+    if connection.vendor == 'sqlite' and settings.DATABASE_WRITE_QUEUE:
+        for pragma in SQLITE_PRAGMAS:
+            connection.connection.execute(pragma)
+
+
+# single writer for all database mutations of this process:
+# jobs submitted by the consumers are executed by one dedicated thread,
+# all jobs waiting when the writer becomes free are committed together in one transaction (group commit)
+class WriteQueue:
+    def __init__(self, batch_size=100):
+        self.batch_size = batch_size
+        self.jobs = queue.Queue()
+        self.thread = None
+        self.thread_lock = threading.Lock()
+        self.batches = 0
+        self.jobs_written = 0
+
+    # queues func to be run by the writer, returns a concurrent.futures.Future that is resolved after the commit
+    # the job runs in the caller's context, so its queries are charged to the calling handler
+    def enqueue(self, func, *args, **kwargs):
+        self.start()
+        future = Future()
+        context = contextvars.copy_context()
+        self.jobs.put((future, functools.partial(context.run, func, *args, **kwargs)))
+        return future
+
+    # queues func and waits until it is committed, returns its result or raises its exception
+    async def submit(self, func, *args, **kwargs):
+        return await asyncio.wrap_future(self.enqueue(func, *args, **kwargs))
+
+    def start(self):
+        if self.thread is None:
+            with self.thread_lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, name='database-writer', daemon=True)
+                    self.thread.start()
+
+    def run(self):
+        while True:
+            batch = [self.jobs.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+            self.write_batch(batch)
+
+    # the writer keeps its connection and pragmas across batches, regardless of CONN_MAX_AGE,
+    # it is only replaced once a failed query left it unusable
+    def close_unusable_connection(self):
+        if connection.connection is None or not connection.errors_occurred:
+            return
+        if connection.is_usable():
+            connection.errors_occurred = False
+        else:
+            connection.close()
+
+    def write_batch(self, batch):
+        self.close_unusable_connection()
+        results = []
+        try:
+            with transaction.atomic():
+                for future, job in batch:
+                    # every job runs in its own savepoint, a failing job does not roll back the others
+                    try:
+                        with transaction.atomic():
+                            results.append((future, job(), None))
+                    except Exception as error:
+                        results.append((future, None, error))
+        except Exception as error:
+            # the commit failed, none of the jobs was written
+            results = [(future, None, error) for future, job in batch]
+        self.batches += 1
+        self.jobs_written += len(batch)
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+write_queue = WriteQueue(settings.DATABASE_WRITE_BATCH_SIZE)
+
+
+# decorator for database functions that write:
+# with DATABASE_WRITE_QUEUE enabled they run on the single writer, otherwise like database_sync_to_async
+def database_write(func):
+    run_in_thread = database_sync_to_async(func)
+    run_counted = count_queries(func)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if not settings.DATABASE_WRITE_QUEUE:
+            return await run_in_thread(*args, **kwargs)
+        return await await_database(write_queue.submit(run_counted, *args, **kwargs))
+
+    return wrapper
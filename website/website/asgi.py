@@ -10,8 +10,10 @@ https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
 import os
 
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
 from django.core.asgi import get_asgi_application
+from spotifyParty.consumers import room_owner_handlers
+from spotifyParty.guests import GuestAuthMiddlewareStack
+from spotifyParty.sharding import start_inbox_at_startup
 import spotifyParty.routing
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'website.settings')
@@ -20,10 +22,13 @@ application = get_asgi_application()
 
 application = ProtocolTypeRouter({
     "http": get_asgi_application(),
-    "websocket": AuthMiddlewareStack(
+    "websocket": GuestAuthMiddlewareStack(
         URLRouter(
             # sub routing into spotifyParty.routing
             spotifyParty.routing.websocket_urlpatterns
         )
     ),
 })
+
+# with room affinity this worker reads the messages forwarded to the party-sessions it owns from the start
+start_inbox_at_startup(room_owner_handlers)
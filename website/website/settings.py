@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -83,6 +84,60 @@ CHANNEL_LAYERS = {
     },
 }
 
+# SpotifyParty
+# seconds between write-behind flushes of the in-memory vote tallies to the database
+VOTE_FLUSH_INTERVAL = 5
+# seconds in which vote changes are collected into a single votes_refresh broadcast
+VOTES_REFRESH_WINDOW = 0.075
+# seconds before the end of a song at which the vote closes and the next round is prepared, at most half of the song
+ROUND_LEAD_TIME = 3
+# seconds after which a round that could not be ended, e.g. while the database was unavailable, is ended again
+ROUND_RETRY_DELAY = 5
+# how the winner is handed to spotify: 'queue' adds it to the host's queue when the vote closes,
+# 'start' starts its playback when the playing song ends
+ROUND_HANDOFF = 'queue'
+# round deadlines follow the playback position of the host's device, it is polled every PLAYBACK_POLL_MIN_INTERVAL
+# seconds after a correction and pauses, the interval doubles up to PLAYBACK_POLL_MAX_INTERVAL while it matches,
+# deadlines are corrected if they are more than PLAYBACK_DRIFT_TOLERANCE seconds off
+PLAYBACK_SYNC = True
+PLAYBACK_POLL_MIN_INTERVAL = 5
+PLAYBACK_POLL_MAX_INTERVAL = 60
+PLAYBACK_DRIFT_TOLERANCE = 0.5
+# spotify web api: request timeout and retries in seconds, 429 responses are retried after their Retry-After
+# unless it is longer than SPOTIFY_API_MAX_RETRY_AFTER seconds
+SPOTIFY_API_TIMEOUT = 5
+SPOTIFY_API_MAX_RETRIES = 3
+SPOTIFY_API_BACKOFF = 0.5
+SPOTIFY_API_MAX_RETRY_AFTER = 5
+# seconds for which the playlist and device listings of the settings view are not requested again
+PLAYLISTS_CACHE_TTL = 300
+DEVICES_CACHE_TTL = 15
+# the metrics endpoint answers requests from METRICS_ALLOWED_IPS, requests with the header
+# 'Authorization: Bearer <METRICS_TOKEN>' and logged in staff users, everyone else is refused
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+METRICS_TOKEN = os.environ.get('SPOTIFYPARTY_METRICS_TOKEN')
+# consumer handlers exceeding their query budget raise instead of printing a warning (enabled by the tests)
+QUERY_BUDGETS_ENFORCED = False
+# run the consumers' database writes on a single writer thread that commits them in batches,
+# also switches sqlite to WAL mode, recommended for busy sqlite deployments
+DATABASE_WRITE_QUEUE = False
+DATABASE_WRITE_BATCH_SIZE = 100
+# redis url of the room state shared by several worker processes, e.g. 'redis://127.0.0.1:6379/1',
+# None keeps vote tallies and room states in the memory of a single process
+ROOM_STORE_URL = None
+# ids of all worker processes, enables room affinity: every party-session is owned by one worker (consistent hashing),
+# which runs its round scheduler and vote tally, the other workers forward votes to it over the channel layer,
+# requires the redis channel layer and ROOM_STORE_URL, e.g. 'worker-1,worker-2,worker-3'
+ROOM_AFFINITY_WORKERS = [worker for worker in os.environ.get('SPOTIFYPARTY_WORKERS', '').split(',') if worker]
+# id of this worker process, one of ROOM_AFFINITY_WORKERS
+ROOM_AFFINITY_WORKER_ID = os.environ.get('SPOTIFYPARTY_WORKER_ID')
+
+
+# guests without a spotify account are identified by a signed cookie instead of a user account and a login session,
+# joining a party-session writes nothing to the database, False creates a user and a session for every guest
+SIGNED_GUESTS = True
+# seconds for which a guest keeps its identity, every visit of a party-session renews the cookie
+GUEST_COOKIE_MAX_AGE = 60 * 60 * 24 * 30
 
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases